@@ -0,0 +1,149 @@
+'''
+Benchmarks for the data layer and web routes. Seeds a scratch database
+(which is wiped!) with synthetic users for each population size, then
+times each operation and counts the Redis round trips it makes:
+
+    python bench.py [--db 15] [--sizes 1000,10000,100000] [--repeat 20]
+        [--output results.json] [--thresholds bench_thresholds.json]
+
+Results are written as JSON. With --thresholds, any operation whose median
+time or round trip count exceeds its threshold is reported and the exit
+status is 1, so runs before and after a change can be compared.
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import redis
+from dbroster import Roster
+from dbsite import Site
+from dbtools import DB
+from dbuser import User
+from hashpool import HashPool
+import hscpcweb
+
+PASSWORD = 'benchpass'
+
+class RoundTrips(object):
+    '''
+    Counts packets sent to Redis. A single command and a whole pipeline are
+    each one round trip.
+    '''
+    count = 0
+    _send = redis.connection.Connection.send_packed_command
+
+    @classmethod
+    def install(cls):
+        def send_packed_command(connection, command):
+            cls.count += 1
+            return cls._send(connection, command)
+        redis.connection.Connection.send_packed_command = send_packed_command
+
+def seed(dbnumber, size):
+    '''
+    Wipe dbnumber and fill it with size users, one in ten of them coaches
+    '''
+    with DB(dbnumber) as db:
+        db.reset(wait=True)
+    Site(dbnumber).start()
+    passwordhash = HashPool.generate(PASSWORD)
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    with os.fdopen(fd, 'w') as f:
+        for i in range(size):
+            f.write(json.dumps({'username':'user%d' % i,
+                'email':'user%d@example.com' % i,
+                'realname':'User Number %d' % i,
+                'passwordhash':passwordhash,
+                'level':User.LEVEL_COACH if i % 10 == 0 else User.LEVEL_CONTESTANT})
+                + '\n')
+    try:
+        Roster.importfile(dbnumber, path, restart=True)
+    finally:
+        os.remove(path)
+
+def operations(dbnumber, size):
+    '''
+    Return a list of (name, function) to benchmark; each function takes the
+    iteration number
+    '''
+    client = hscpcweb.app.test_client()
+    def login(i):
+        client.post('/login', data=dict(username='user%d' % (i % size),
+            password=PASSWORD), environ_base={'REMOTE_ADDR':'10.%d.0.1' % i})
+    return [('getuserscount', lambda i: User.getuserscount(dbnumber)),
+        ('getusers', lambda i: User.getusers(dbnumber)),
+        ('getusers_coach',
+            lambda i: User.getusers(dbnumber, levelspec=User.LEVEL_COACH)),
+        ('user_byname', lambda i: User(dbnumber, username='user%d' % (i % size))),
+        ('route_root', lambda i: client.get('/')),
+        ('route_login', login)]
+
+def measure(func, repeat):
+    times = []
+    trips = []
+    for i in range(repeat):
+        RoundTrips.count = 0
+        start = time.time()
+        func(i)
+        times.append((time.time() - start) * 1000)
+        trips.append(RoundTrips.count)
+    times.sort()
+    return {'ms_min':round(times[0], 3),
+        'ms_median':round(times[len(times) // 2], 3),
+        'ms_max':round(times[-1], 3),
+        'roundtrips':max(trips)}
+
+def check(results, thresholds):
+    '''
+    Return a list of descriptions of results exceeding thresholds, which
+    map size -> operation -> {'ms_median':..., 'roundtrips':...}
+    '''
+    failures = []
+    for size, ops in sorted(results.items()):
+        for name, result in sorted(ops.items()):
+            limits = thresholds.get(size, {}).get(name, {})
+            for measure, limit in sorted(limits.items()):
+                if result[measure] > limit:
+                    failures.append('%s users, %s: %s %s > %s' %
+                        (size, name, measure, result[measure], limit))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HSCPC benchmarks')
+    parser.add_argument('--db', type=int, default=15,
+        help='scratch redis database number; it will be wiped')
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', default='-')
+    parser.add_argument('--thresholds')
+    args = parser.parse_args(argv)
+    RoundTrips.install()
+    hscpcweb.app.config['db'] = args.db
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        start = time.time()
+        seed(args.db, size)
+        sys.stderr.write('seeded %d users in %.1fs\n' % (size, time.time() - start))
+        results[str(size)] = dict((name, measure(func, args.repeat))
+            for name, func in operations(args.db, size))
+    with DB(args.db) as db:
+        db.reset(wait=True)
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    if args.thresholds:
+        with open(args.thresholds) as f:
+            failures = check(results, json.load(f))
+        for failure in failures:
+            sys.stderr.write('REGRESSION %s\n' % failure)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
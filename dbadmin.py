@@ -0,0 +1,207 @@
+'''
+Command line maintenance for the HSCPC data store. Run from the project
+directory with the same environment (REDISTOGO_URL etc.) as the web app:
+
+    python dbadmin.py [--db N] verifyindexes
+    python dbadmin.py [--db N] rebuildindexes
+    python dbadmin.py [--db N] import [--batchsize N] [--restart] ROSTER
+    python dbadmin.py [--db N] export [FILE]
+    python dbadmin.py [--db N] migratelayout {keys,buckets}
+    python dbadmin.py [--db N] memoryreport [--compare SCRATCHDB] [--sample N]
+    python dbadmin.py [--db N] reset [--yes]
+    python dbadmin.py [--db N] findusers [--by {username,realname}] [--count N]
+                                         [--cursor CURSOR] [PREFIX]
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+from dbcontest import Contest
+from dbjudge import JudgeQueue
+from dbroster import Roster
+from dbtools import DB
+from dbuser import User
+
+
+def verifyindexes(args):
+    problems = User.verifyindexes(args.db)
+    for problem in problems:
+        print(problem)
+    print('%d problem(s) found' % len(problems))
+    return 1 if problems else 0
+
+def rebuildindexes(args):
+    User.rebuildindexes(args.db)
+    print('%d user(s) indexed' % User.getuserscount(args.db))
+    return 0
+
+def importroster(args):
+    imported, rejected = Roster.importfile(args.db, args.roster, 
+        batchsize=args.batchsize, restart=args.restart)
+    for number, record in rejected:
+        print('line %d rejected: %s' % (number, 
+            record.get('username') if isinstance(record, dict) else record))
+    print('%d user(s) imported, %d rejected' % (imported, len(rejected)))
+    return 1 if rejected else 0
+
+def exportroster(args):
+    if args.file == '-':
+        count = Roster.exportfile(args.db, sys.stdout)
+    else:
+        with open(args.file, 'w') as out:
+            count = Roster.exportfile(args.db, out)
+    sys.stderr.write('%d user(s) exported\n' % count)
+    return 0
+
+def migratelayout(args):
+    stats = JudgeQueue.getstats(args.db)
+    if stats['depth'] or stats['judging']:
+        print('%d submission(s) waiting to be judged; stop the site and let the '
+            'judges finish first' % (stats['depth'] + stats['judging']))
+        return 1
+    try:
+        uidmap = User.migratelayout(args.db, args.layout, force=args.force)
+    except ValueError as e:
+        print('not migrating: %s; raise them with CONFIG SET (and in redis.conf) '
+            'or add --force' % e)
+        return 1
+    Contest.remapusers(args.db, uidmap)
+    JudgeQueue.remapusers(args.db, uidmap)
+    User.clearuidmap(args.db)
+    print('%d user(s) in %s layout, %d uid(s) changed' % 
+        (User.getuserscount(args.db), args.layout, len(uidmap)))
+    return 0
+
+def comparelayout(args, layout):
+    '''
+    Copy up to args.sample users into the scratch db in layout and return
+    its memory report
+    '''
+    with DB(args.compare) as db:
+        db.reset(wait=True)
+    User.migratelayout(args.compare, layout, force=True)
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            Roster.exportfile(args.db, out, limit=args.sample)
+        Roster.importfile(args.compare, path, restart=True)
+        return User.memoryusage(args.compare)
+    finally:
+        os.remove(path)
+        with DB(args.compare) as db:
+            db.reset(wait=True)
+
+def memoryreport(args):
+    if args.compare == args.db:
+        print('--compare must name a scratch db, not db %d itself' % args.db)
+        return 1
+    if args.compare is not None and not args.yes:
+        print('this deletes every key in namespace "%s" of db %d; add --yes' % 
+            (DB.getsetting('namespace'), args.compare))
+        return 1
+    reports = [User.memoryusage(args.db)]
+    if args.compare is not None:
+        other = User.LAYOUT_BUCKETS if reports[0]['layout'] == User.LAYOUT_KEYS \
+            else User.LAYOUT_KEYS
+        reports.append(comparelayout(args, other))
+    users = reports[0]['users']
+    print('%-10s %8s %12s %12s %12s %12s %10s %14s' % ('layout', 'users', 'records',
+        'lookups', 'indexes', 'total', 'per user', 'projected'))
+    for report in reports:
+        peruser = report['total'] / float(report['users'] or 1)
+        print('%-10s %8d %12d %12d %12d %12d %10.1f %14d' % (report['layout'], 
+            report['users'], report['records'], report['lookups'], report['indexes'],
+            report['total'], peruser, peruser * users))
+        print('%-10s user hash encodings: %s' % ('', ', '.join('%s %d' % item 
+            for item in sorted(report['encodings'].items()))))
+    buckets = [report for report in reports if report['layout'] == User.LAYOUT_BUCKETS]
+    problems = User.checkbuckets(args.db)
+    if buckets and buckets[0]['encodings'].get('hashtable') and problems:
+        print('Some buckets are not compactly encoded: %s' % '; '.join(problems))
+    return 0
+
+def reset(args):
+    if not args.yes:
+        print('this deletes every key in namespace "%s" of db %d; add --yes' % 
+            (DB.getsetting('namespace'), args.db))
+        return 1
+    with DB(args.db) as db:
+        generation = db.reset()
+        while True:
+            progress = db.getresetprogress()
+            if progress.get('generation') != generation:
+                print('another reset has taken over')
+                return 1
+            print('%d key(s) scanned, %d deleted' % (progress['scanned'], 
+                progress['deleted']))
+            if progress['finished']:
+                return 0
+            time.sleep(1)
+
+def findusers(args):
+    users, cursor = User.findusers(args.db, args.prefix, by=args.by, 
+        count=args.count, cursor=args.cursor)
+    for user in users:
+        print('%-20s %-30s %s' % (user.username, user.realname, user.levelstring()))
+    if cursor is not None:
+        print('more: add --cursor %s' % cursor)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HSCPC data store maintenance')
+    parser.add_argument('--db', type=int, default=DB.DBN,
+        help='redis database number')
+    commands = parser.add_subparsers()
+    command = commands.add_parser('verifyindexes',
+        help='check the user index sets against the user records')
+    command.set_defaults(func=verifyindexes)
+    command = commands.add_parser('rebuildindexes',
+        help='rebuild the user index sets from the user records')
+    command.set_defaults(func=rebuildindexes)
+    command = commands.add_parser('import',
+        help='create users from a .csv or .jsonl roster file')
+    command.add_argument('roster')
+    command.add_argument('--batchsize', type=int, default=Roster.BATCHSIZE)
+    command.add_argument('--restart', action='store_true',
+        help='ignore progress saved by an interrupted import')
+    command.set_defaults(func=importroster)
+    command = commands.add_parser('export',
+        help='write every user to a .jsonl file')
+    command.add_argument('file', nargs='?', default='-')
+    command.set_defaults(func=exportroster)
+    command = commands.add_parser('migratelayout',
+        help='move users to another storage layout; stop the site first')
+    command.add_argument('layout', choices=[User.LAYOUT_KEYS, User.LAYOUT_BUCKETS])
+    command.add_argument('--force', action='store_true',
+        help='move to buckets even if the server would not keep them compact')
+    command.set_defaults(func=migratelayout)
+    command = commands.add_parser('memoryreport',
+        help='report memory used by users, optionally compared with the other '
+            'layout')
+    command.add_argument('--compare', type=int, metavar='SCRATCHDB',
+        help='scratch redis database number to build the other layout in; '
+            'it will be wiped')
+    command.add_argument('--sample', type=int, default=10000,
+        help='users to copy into the scratch database')
+    command.add_argument('--yes', action='store_true',
+        help='confirm wiping the scratch database')
+    command.set_defaults(func=memoryreport)
+    command = commands.add_parser('reset',
+        help='delete all site data, reporting progress as it is swept away')
+    command.add_argument('--yes', action='store_true',
+        help='confirm the reset')
+    command.set_defaults(func=reset)
+    command = commands.add_parser('findusers',
+        help='list users whose name starts with a prefix, a page at a time')
+    command.add_argument('prefix', nargs='?', default='')
+    command.add_argument('--by', choices=list(User.NAME_INDEXES), default='username')
+    command.add_argument('--count', type=int, default=User.PAGESIZE)
+    command.add_argument('--cursor', help='where the previous page ended')
+    command.set_defaults(func=findusers)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
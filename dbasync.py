@@ -0,0 +1,256 @@
+import os
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+import dbuser
+from dbsite import Site
+from dbtools import DB
+from dbuser import User
+
+class Result(object):
+    '''
+    The eventual value of an asynchronous call. get() waits for it (up to
+    timeout seconds) and re-raises any exception the call raised; callbacks
+    added with addcallback run, with the Result, once it is ready.
+    '''
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def ready(self):
+        return self._event.is_set()
+
+    def get(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('timed out waiting for result')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def addcallback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set(self, value=None, error=None):
+        with self._lock:
+            self._value = value
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def gather(results, combine=list):
+    '''
+    Return a Result for combine(list of values of results), failing with the
+    first error among them
+    '''
+    gathered = Result()
+    values = [None] * len(results)
+    pending = [len(results)]
+    lock = threading.Lock()
+    def done(i, result):
+        with lock:
+            if gathered.ready():
+                return
+            if result._error is not None:
+                gathered._set(error=result._error)
+                return
+            values[i] = result._value
+            pending[0] -= 1
+            if pending[0]:
+                return
+        try:
+            gathered._set(combine(values))
+        except Exception as e:
+            gathered._set(error=e)
+    if not results:
+        gathered._set(combine([]))
+    for i, result in enumerate(results):
+        result.addcallback(lambda result, i=i: done(i, result))
+    return gathered
+
+
+class Executor(object):
+    '''
+    Thread pool that runs the synchronous data layer off the caller's
+    thread. Its threads use their own Redis connection pool ('async').
+    Under a gevent or eventlet gunicorn worker the threads and sockets are
+    cooperative, so many requests can wait on Redis at once.
+    '''
+    THREADS = 8
+    POOLNAME = 'async'
+
+    _pool = None
+    _poolpid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def submit(cls, func, *args, **kwargs):
+        '''
+        Run func(*args, **kwargs) on the pool and return its Result
+        '''
+        result = Result()
+        cls._getpool().apply_async(cls._call, (result, func, args, kwargs))
+        return result
+
+    @staticmethod
+    def _call(result, func, args, kwargs):
+        try:
+            value = func(*args, **kwargs)
+        except Exception as e:
+            result._set(error=e)
+        else:
+            result._set(value)
+
+    @classmethod
+    def _getpool(cls):
+        with cls._lock:
+            if cls._poolpid != os.getpid():
+                cls._pool = None     # its threads weren't forked with us
+                cls._poolpid = os.getpid()
+            if cls._pool is None:
+                cls._pool = ThreadPool(cls.THREADS, DB.usepool, (cls.POOLNAME,))
+            return cls._pool
+
+
+class AsyncUser(object):
+    '''
+    Asynchronous counterpart of User: each call returns a Result instead of
+    blocking. Listings fetch their batches concurrently on the Executor.
+    '''
+    @classmethod
+    def load(cls, dbnumber, **kwargs):
+        '''
+        Result of User(dbnumber, **kwargs)
+        '''
+        return Executor.submit(User, dbnumber, **kwargs)
+
+    @classmethod
+    def getuserscount(cls, dbnumber):
+        return Executor.submit(User.getuserscount, dbnumber)
+
+    @classmethod
+    def getcredversions(cls, dbnumber, userids):
+        return Executor.submit(User.getcredversions, dbnumber, userids)
+
+    @classmethod
+    def getusers(cls, dbnumber, **kwargs):
+        '''
+        Result of User.getusers(dbnumber, **kwargs). The uid index is walked
+        first, then every batch of users is fetched in parallel.
+        '''
+        levelspec = kwargs.get('levelspec', User.LEVEL_ANY)
+        batchsize = kwargs.get('batchsize', User.BATCHSIZE)
+        fields = User._projection(kwargs.get('fields', User.LIST_FIELDS))
+        def combine(batches):
+            users = {}
+            for batch in batches:
+                for user in batch:
+                    if levelspec == User.LEVEL_ANY or user.level == levelspec:
+                        users[user.userid] = user
+            return users.values()
+        def walk():
+            with DB(dbnumber) as db:
+                uids = db.ro.sscan_iter(User.LEVEL_KEYS[levelspec], count=batchsize)
+                return list(User._batches(uids, batchsize))
+        result = Result()
+        def fetch(walked):
+            if walked._error is not None:
+                result._set(error=walked._error)
+                return
+            gather([Executor.submit(cls._loadusers, dbnumber, uids, fields)
+                for uids in walked._value], combine).addcallback(
+                lambda gathered: result._set(gathered._value, gathered._error))
+        Executor.submit(walk).addcallback(fetch)
+        return result
+
+    @staticmethod
+    def _loadusers(dbnumber, uids, fields):
+        with DB(dbnumber) as db:
+            return User._loadusers(db, dbnumber, uids, fields)
+
+
+class AsyncSite(object):
+    '''
+    Asynchronous counterpart of Site
+    '''
+    @classmethod
+    def start(cls, dbnumber):
+        '''
+        Result of a started Site(dbnumber)
+        '''
+        def start():
+            site = Site(dbnumber)
+            site.start()
+            return site
+        return Executor.submit(start)
+
+
+
+class AsyncBackedUser(User):
+    '''
+    User whose construction, listings and counts go through AsyncUser, so
+    the User test suite also exercises the asynchronous layer
+    '''
+    __slots__ = ()
+
+    def __init__(self, dbnumber, **kwargs):
+        Executor.submit(User.__init__, self, dbnumber, **kwargs).get(10)
+
+    @classmethod
+    def getusers(cls, dbnumber, **kwargs):
+        return AsyncUser.getusers(dbnumber, **kwargs).get(10)
+
+    @classmethod
+    def getuserscount(cls, dbnumber):
+        return AsyncUser.getuserscount(dbnumber).get(10)
+
+    @classmethod
+    def getcredversions(cls, dbnumber, userids):
+        return AsyncUser.getcredversions(dbnumber, userids).get(10)
+
+
+class TestSequenceFunctions(dbuser.TestSequenceFunctions):
+
+    '''
+    The User suite, run with User swapped for AsyncBackedUser, plus tests
+    of the asynchronous API itself
+    '''
+    User = AsyncBackedUser
+
+    def test_asyncload(self):
+        s = User(DB.DBNTEST)
+        s.setproperties(username='alice', email='alice@gmail.com')
+        results = [AsyncUser.load(DB.DBNTEST, username='alice'),
+            AsyncUser.load(DB.DBNTEST, email='alice@gmail.com'),
+            AsyncUser.getuserscount(DB.DBNTEST),
+            AsyncSite.start(DB.DBNTEST)]
+        alice, alice2, count, site = gather(results).get(10)
+        self.assertEqual(alice.userid, s.userid)
+        self.assertEqual(alice2.userid, s.userid)
+        self.assertEqual(count, 1)
+        self.assertEqual(site.name, Site.VALUE_SITE_DEFAULTNAME)
+        self.assertTrue([p for p in DB.poolstats() if p['pool'] == Executor.POOLNAME])
+
+    def test_asyncerror(self):
+        result = AsyncUser.getusers(DB.DBNTEST, levelspec=99)
+        self.assertRaises(KeyError, result.get, 10)
+
+    def test_executorafterfork(self):
+        pool = Executor._getpool()
+        Executor._poolpid = -1  # as seen from a freshly forked child
+        self.assertIsNot(pool, Executor._getpool())
+        self.assertEqual(AsyncUser.getuserscount(DB.DBNTEST).get(10), 0)
+        pool.terminate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,384 @@
+import threading
+import time
+import unittest
+from dbevents import EventHub
+from dbtools import DB, Invalidator, LocalCache, Metrics, Script
+from dbuser import User
+
+class Contest(object):
+    '''
+    A contest and its scoring. Each contest/<cid> has
+
+        name-><string>
+        start-><float>          unix time the contest started
+
+    and its scores are kept in
+
+        contest/<cid>/rank      sorted set of uid -> score
+        contest/<cid>/solves    hash of uid/puzzle -> seconds into the contest
+        contest/<cid>/attempts  hash of uid/puzzle -> rejected attempts
+        contest/<cid>/names     hash of uid -> username, for the scoreboard
+        contest/<cid>/recorded  set of attempt ids already scored
+        contest/<cid>/puzzles   hash of puzzle -> expected answer
+
+    A score is solved * SCALE - penalty, where the penalty is the seconds
+    into the contest of each solve plus PENALTY for every rejected attempt
+    on a solved puzzle. So the sorted set orders contestants by puzzles
+    solved and, among equals, by who got there first; each attempt is an
+    O(log n) ZINCRBY, and the top of the board and any one contestant's
+    rank come back from a single script call.
+
+    Rendered scoreboards are shared: one process rebuilds the page at most
+    every BOARD_INTERVAL seconds and stores it in contest/<cid>/board for
+    every other process, which keeps its own copy for up to a second. 
+    Changes in between are pushed to live viewers as 'score' events, keyed
+    by contest and uid, and 'announce' events; the page is rendered with 
+    the time its rows were read, so a viewer can ask for the events since
+    (see EventHub.connect).
+    '''
+    KEY_CONTEST = 'contest/'    # append cid
+    KEY_RANK = '/rank'          # append to contest key
+    KEY_SOLVES = '/solves'
+    KEY_ATTEMPTS = '/attempts'
+    KEY_NAMES = '/names'
+    KEY_RECORDED = '/recorded'
+    KEY_PUZZLES = '/puzzles'
+    KEY_BOARD = '/board'
+    KEY_BOARDLOCK = '/board/lock'
+    KEY_SITE_CONTESTS = User.KEY_SITE_CONTESTS
+    HKEY_NAME = 'n'
+    HKEY_START = 's'
+
+    SCALE = 10 ** 9         # more seconds of penalty than any contest runs
+    PENALTY = 20 * 60       # seconds per rejected attempt on a solved puzzle
+    BOARD_SIZE = 100
+    BOARD_INTERVAL = 5
+
+    # Record one attempt at a puzzle; attempts after it is solved, or with
+    # an attempt id that was already recorded, change nothing. Returns the
+    # contestant's new score.
+    # KEYS: solves hash, attempts hash, rank set, names hash, recorded set
+    # ARGV: uid/puzzle, uid, username, seconds into contest, correct (1/0),
+    #       penalty per rejected attempt, scale, attempt id (or '')
+    SCRIPT_ATTEMPT = Script('''
+        redis.call('HSET', KEYS[4], ARGV[2], ARGV[3])
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 or
+            (ARGV[8] ~= '' and redis.call('SADD', KEYS[5], ARGV[8]) == 0) then
+            return redis.call('ZSCORE', KEYS[3], ARGV[2])
+        end
+        if ARGV[5] == '0' then
+            redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+            return redis.call('ZINCRBY', KEYS[3], 0, ARGV[2])
+        end
+        local rejected = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0)
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[4])
+        return redis.call('ZINCRBY', KEYS[3],
+            ARGV[7] - ARGV[4] - rejected * ARGV[6], ARGV[2])
+        ''')
+
+    # The top of the board and one contestant's place.
+    # KEYS: rank set, names hash
+    # ARGV: count, uid (or '')
+    # Returns {uid, score, ...}, {username, ...}, score or '', rank or 0
+    # where rank counts 1 + contestants with a higher score.
+    SCRIPT_STANDINGS = Script('''
+        local top = {}
+        local usernames = {}
+        if tonumber(ARGV[1]) > 0 then
+            top = redis.call('ZREVRANGE', KEYS[1], 0, ARGV[1] - 1, 'WITHSCORES')
+        end
+        if #top > 0 then
+            local uids = {}
+            for i = 1, #top, 2 do
+                uids[#uids+1] = top[i]
+            end
+            usernames = redis.call('HMGET', KEYS[2], unpack(uids))
+            for i = 1, #usernames do
+                usernames[i] = usernames[i] or ''
+            end
+        end
+        local score = ARGV[2] ~= '' and redis.call('ZSCORE', KEYS[1], ARGV[2])
+        if not score then
+            return {top, usernames, '', 0}
+        end
+        return {top, usernames, score,
+            redis.call('ZCOUNT', KEYS[1], '(' .. score, '+inf') + 1}
+        ''')
+
+    CACHE_BOARD = 'scoreboard'
+    _boards = Invalidator.register(CACHE_BOARD, LocalCache(maxsize=64, ttl=1))
+    _boardlock = threading.Lock()
+
+    @classmethod
+    def create(cls, dbnumber, name, start=None):
+        '''
+        Create a contest starting at start (default now) and return it
+        '''
+        with DB(dbnumber) as db:
+            contest = cls.__new__(cls)
+            contest.dbnumber = dbnumber
+            contest.contestid = db.getuniqueid()
+            contest.key = cls.KEY_CONTEST + contest.contestid
+            contest.name = name
+            contest.start = time.time() if start is None else start
+            pipe = db.r.pipeline()
+            pipe.hmset(contest.key, {cls.HKEY_NAME:name, cls.HKEY_START:contest.start})
+            pipe.rpush(cls.KEY_SITE_CONTESTS, contest.contestid)
+            pipe.execute()
+        return contest
+
+    @classmethod
+    def remapusers(cls, dbnumber, uidmap):
+        '''
+        Replace old uids with new ones (uidmap, as returned by 
+        User.migratelayout) in every contest's scores
+        '''
+        if not uidmap:
+            return
+        with DB(dbnumber) as db:
+            for contestid in db.r.lrange(cls.KEY_SITE_CONTESTS, 0, -1):
+                key = cls.KEY_CONTEST + contestid
+                pipe = db.r.pipeline()
+                for uid, score in db.r.zscan_iter(key + cls.KEY_RANK):
+                    if uid in uidmap:
+                        pipe.zrem(key + cls.KEY_RANK, uid)
+                        pipe.zadd(key + cls.KEY_RANK, **{uidmap[uid]:score})
+                for suffix in (cls.KEY_NAMES, cls.KEY_SOLVES, cls.KEY_ATTEMPTS):
+                    for field, value in db.r.hscan_iter(key + suffix):
+                        uid, slash, puzzle = field.partition('/')
+                        if uid in uidmap:
+                            pipe.hdel(key + suffix, field)
+                            pipe.hset(key + suffix, uidmap[uid] + slash + puzzle, value)
+                pipe.execute()
+
+    def __init__(self, dbnumber, contestid):
+        self.dbnumber = dbnumber
+        self.contestid = contestid
+        self.key = self.KEY_CONTEST + contestid
+        with DB(dbnumber) as db:
+            name, start = db.r.hmget(self.key, [self.HKEY_NAME, self.HKEY_START])
+        self.isvalid = name is not None
+        self.name = name or ''
+        self.start = float(start or 0)
+
+    def recordattempt(self, user, puzzle, correct, when=None, attemptid=''):
+        '''
+        Record user's attempt at puzzle, made at when (default now). An
+        attemptid makes recording it again harmless. Returns the user's 
+        (solved, penalty) afterwards.
+        '''
+        elapsed = int((time.time() if when is None else when) - self.start)
+        with DB(self.dbnumber) as db:
+            score = self.SCRIPT_ATTEMPT(db,
+                [self.key + self.KEY_SOLVES, self.key + self.KEY_ATTEMPTS,
+                    self.key + self.KEY_RANK, self.key + self.KEY_NAMES,
+                    self.key + self.KEY_RECORDED],
+                [user.userid + '/' + str(puzzle), user.userid, user.username,
+                    max(elapsed, 0), 1 if correct else 0, self.PENALTY, self.SCALE,
+                    attemptid])
+            solved, penalty = self._decode(score)
+            self._scored(db, user, solved, penalty)
+        return solved, penalty
+
+    def penalize(self, user, seconds):
+        '''
+        Add seconds of penalty to user's score
+        '''
+        with DB(self.dbnumber) as db:
+            pipe = db.r.pipeline()
+            pipe.hset(self.key + self.KEY_NAMES, user.userid, user.username)
+            pipe.zincrby(self.key + self.KEY_RANK, user.userid, -seconds)
+            solved, penalty = self._decode(pipe.execute()[-1])
+            self._scored(db, user, solved, penalty)
+        return solved, penalty
+
+    def setpuzzle(self, puzzle, answer):
+        '''
+        Add puzzle to the contest, or change its expected answer
+        '''
+        with DB(self.dbnumber) as db:
+            db.r.hset(self.key + self.KEY_PUZZLES, puzzle, answer)
+
+    def getanswer(self, puzzle):
+        '''
+        Return the expected answer to puzzle, or None if there is no such
+        puzzle
+        '''
+        with DB(self.dbnumber) as db:
+            return db.r.hget(self.key + self.KEY_PUZZLES, puzzle)
+
+    def announce(self, text):
+        '''
+        Push an announcement to everyone watching the contest
+        '''
+        with DB(self.dbnumber) as db:
+            EventHub.publish(db, 'announce', None, 
+                {'contest':self.contestid, 'text':text})
+
+    def standings(self, count=BOARD_SIZE, userid=''):
+        '''
+        Return (rows, mine): a row for each of the top count contestants and
+        one for userid (None if not ranked), in one round trip. Rows are
+        dicts of rank, userid, username, solved and penalty; tied
+        contestants share a rank.
+        '''
+        with DB(self.dbnumber) as db:
+            top, usernames, score, rank = self.SCRIPT_STANDINGS(db,
+                [self.key + self.KEY_RANK, self.key + self.KEY_NAMES],
+                [count, userid or ''])
+        rows = []
+        for i in range(0, len(top), 2):
+            solved, penalty = self._decode(top[i+1])
+            if rows and (solved, penalty) == (rows[-1]['solved'], rows[-1]['penalty']):
+                place = rows[-1]['rank']
+            else:
+                place = i // 2 + 1
+            rows.append(dict(rank=place, userid=top[i], username=usernames[i // 2],
+                solved=solved, penalty=penalty))
+        mine = None
+        if rank:
+            solved, penalty = self._decode(score)
+            mine = dict(rank=rank, userid=userid, solved=solved, penalty=penalty)
+        return rows, mine
+
+    def scoreboard(self, render):
+        '''
+        Return the rendered scoreboard: render(rows, built) for the top 
+        BOARD_SIZE rows and the unix time they were read, rebuilt at most 
+        once per BOARD_INTERVAL across all processes
+        '''
+        cachekey = (self.dbnumber, self.contestid)
+        page = self._boards.get(cachekey)
+        if page is not None:
+            return page
+        with self._boardlock:
+            page = self._boards.get(cachekey)
+            if page is None:
+                page = self._buildboard(render)
+                self._boards.put(cachekey, page)
+        return page
+
+    def _buildboard(self, render):
+        '''
+        Fetch the shared board, or rebuild it if no other process is. A
+        process that finds the rebuild taken waits briefly for the result.
+        '''
+        with DB(self.dbnumber) as db:
+            for i in range(20):
+                page = db.r.get(self.key + self.KEY_BOARD)
+                if page is not None:
+                    return page.decode('utf-8')
+                if db.r.set(self.key + self.KEY_BOARDLOCK, 1,
+                    ex=self.BOARD_INTERVAL, nx=True):
+                    break
+                time.sleep(0.05)
+            built = time.time()
+            page = render(self.standings()[0], built)
+            db.r.set(self.key + self.KEY_BOARD, page.encode('utf-8'),
+                ex=self.BOARD_INTERVAL)
+            Metrics.increment('hscpc_scoreboard_renders_total')
+        return page
+
+    def _scored(self, db, user, solved, penalty):
+        EventHub.publish(db, 'score', self.contestid + '/' + user.userid,
+            {'contest':self.contestid, 'userid':user.userid, 
+                'username':user.username, 'solved':solved, 'penalty':penalty})
+
+    @classmethod
+    def _decode(cls, score):
+        '''
+        Return (solved, penalty) from a stored score
+        '''
+        score = int(float(score or 0))
+        solved = -(-score // cls.SCALE)
+        return solved, solved * cls.SCALE - score
+
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def setUp(self):
+        self.users = []
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            u = User(DB.DBNTEST)
+            u.setproperties(username=name)
+            self.users.append(u)
+        self.contest = Contest.create(DB.DBNTEST, 'Spring', start=1000)
+
+    def tearDown(self):
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+
+    def test_create(self):
+        c = Contest(DB.DBNTEST, self.contest.contestid)
+        self.assertTrue(c.isvalid)
+        self.assertEqual((c.name, c.start), ('Spring', 1000))
+        self.assertFalse(Contest(DB.DBNTEST, 'nothing').isvalid)
+        with DB(DB.DBNTEST) as db:
+            self.assertEqual(db.r.lrange(Contest.KEY_SITE_CONTESTS, 0, -1),
+                [c.contestid])
+
+    def test_scoring(self):
+        alice, bob, carol, dave = self.users
+        c = self.contest
+        self.assertEqual(c.recordattempt(alice, 'p1', False, 1100), (0, 0))
+        self.assertEqual(c.recordattempt(alice, 'p1', True, 1200),
+            (1, 200 + Contest.PENALTY))
+        self.assertEqual(c.recordattempt(alice, 'p1', False, 1300),
+            (1, 200 + Contest.PENALTY))     # already solved
+        c.recordattempt(bob, 'p1', False, 1250, attemptid='s1')
+        c.recordattempt(bob, 'p1', False, 1250, attemptid='s1')   # redelivered
+        c.recordattempt(bob, 'p1', True, 1300)
+        c.recordattempt(bob, 'p2', True, 1400)
+        c.recordattempt(carol, 'p2', True, 1300)
+        c.recordattempt(dave, 'p1', True, 1300)
+        self.assertEqual(c.penalize(dave, 1100), (1, 1400))
+        rows, mine = c.standings(userid=carol.userid)
+        self.assertEqual([(r['rank'], r['solved'], r['penalty']) for r in rows],
+            [(1, 2, 1900), (2, 1, 300), (3, 1, 1400), (3, 1, 1400)])
+        self.assertEqual([r['username'] for r in rows[:2]], ['bob', 'carol'])
+        self.assertEqual(sorted(r['username'] for r in rows[2:]), ['alice', 'dave'])
+        self.assertEqual(mine, dict(rank=2, userid=carol.userid, solved=1, penalty=300))
+        rows, mine = c.standings(count=1, userid='nobody')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(mine, None)
+        rows, mine = c.standings(count=0, userid=alice.userid)
+        self.assertEqual((rows, mine['rank']), ([], 3))
+
+    def test_remapusers(self):
+        alice, bob, carol, dave = self.users
+        self.contest.recordattempt(alice, 'p1', False, 1100)
+        self.contest.recordattempt(alice, 'p1', True, 1200)
+        self.contest.recordattempt(bob, 'p1', True, 1300)
+        Contest.remapusers(DB.DBNTEST, {alice.userid:'a1'})
+        rows, mine = self.contest.standings(userid='a1')
+        self.assertEqual([(r['userid'], r['username']) for r in rows],
+            [(bob.userid, 'bob'), ('a1', 'alice')])
+        self.assertEqual(mine['penalty'], 200 + Contest.PENALTY)
+
+    def test_standingsroundtrip(self):
+        self.contest.recordattempt(self.users[0], 'p1', True)
+        Metrics.beginrequest()
+        self.contest.standings(userid=self.users[0].userid)
+        self.assertEqual([command for command, seconds in
+            Metrics.endrequest('test', 0)], ['EVALSHA'])
+
+    def test_scoreboard(self):
+        renders = []
+        def render(rows, built):
+            renders.append(rows)
+            return u'<table>%d \u2713</table>' % len(rows)
+        self.contest.recordattempt(self.users[0], 'p1', True)
+        for i in range(5):
+            self.assertEqual(self.contest.scoreboard(render), u'<table>1 \u2713</table>')
+        Contest._boards.clear()     # as if another process
+        self.assertEqual(self.contest.scoreboard(render), u'<table>1 \u2713</table>')
+        self.assertEqual(len(renders), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
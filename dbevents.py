@@ -0,0 +1,253 @@
+import itertools
+import json
+import os
+import Queue
+import threading
+import time
+import unittest
+import redis
+from collections import OrderedDict, deque
+from dbtools import DB, Metrics
+
+class EventClient(object):
+    '''
+    One connected event stream. Batches of events are queued for it by the
+    hub; if the queue fills up the client is dropped.
+    '''
+    def __init__(self, hub):
+        self.hub = hub
+        self.queue = Queue.Queue(hub.QUEUE_SIZE)
+        self.dropped = False
+
+    def stream(self):
+        '''
+        Generate server-sent-event text until the client is dropped or the
+        generator is closed. A comment is sent after HEARTBEAT idle seconds
+        so dead connections are noticed.
+        '''
+        try:
+            yield 'retry: %d\n\n' % (self.hub.RETRY * 1000)
+            while not self.dropped:
+                try:
+                    yield self.queue.get(timeout=self.hub.HEARTBEAT)
+                except Queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            self.hub.disconnect(self)
+
+
+class EventHub(object):
+    '''
+    Pushes live events (scoreboard changes, announcements) to connected
+    clients. Writers publish to events/<dbnumber>; each process holds one
+    subscription per db number, collects the events arriving within WINDOW
+    seconds, keeps only the latest event for each key, and queues the batch,
+    formatted once, for every client. A client more than QUEUE_SIZE batches
+    behind is dropped rather than buffered. A 'resync' event tells clients
+    that events may have been missed and they should reload what they show:
+    it follows a dropped subscription, and starts every stream, since a 
+    client has missed everything published before it connected. A client
+    that knows when what it shows was read (e.g. a scoreboard rendered some
+    seconds earlier) can connect with that time instead; the batches sent
+    since then are replayed to it, if they are from the last REPLAY seconds
+    and this process's subscription was up throughout, and it gets the
+    resync otherwise.
+    '''
+    CHANNEL = 'events/'     # append db number
+
+    WINDOW = 0.25       # seconds to coalesce events
+    QUEUE_SIZE = 32     # batches queued per client
+    HEARTBEAT = 15      # idle seconds between keepalives
+    RETRY = 3           # seconds clients wait to reconnect
+    REPLAY = 10         # seconds of batches kept for clients connecting late
+    SKEW = 1            # seconds of clock difference allowed between processes
+    RESYNC = {'kind':'resync', 'key':None, 'data':None}
+
+    _hubs = {}
+    _hubspid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def publish(cls, db, kind, key, data):
+        '''
+        Send an event to every client of db. A later event of the same kind
+        and key (None never matches) may replace it within the window.
+        '''
+        db.r.publish(db.channel(cls.CHANNEL + str(db.dbnumber)),
+            json.dumps({'kind':kind, 'key':key, 'data':data}))
+
+    @classmethod
+    def connect(cls, dbnumber, since=None):
+        '''
+        Return a new EventClient for dbnumber, starting this process's
+        subscription if needed. Its stream starts with the batches sent 
+        since the unix time since, or with a resync if they aren't all kept
+        (or since is None).
+        '''
+        with cls._lock:
+            if cls._hubspid != os.getpid():
+                cls._hubs = {}
+                cls._hubspid = os.getpid()
+            if dbnumber not in cls._hubs:
+                cls._hubs[dbnumber] = cls(dbnumber)
+            hub = cls._hubs[dbnumber]
+        client = EventClient(hub)
+        with hub._clientslock:
+            if since is None or hub._complete is None or \
+                    since - cls.SKEW < max(hub._complete, time.time() - cls.REPLAY):
+                client.queue.put_nowait(cls._format([cls.RESYNC]))
+            else:
+                client.queue.put_nowait(''.join(text 
+                    for sent, text in hub._recent if sent >= since - cls.SKEW))
+            hub._clients.add(client)
+        return client
+
+    def __init__(self, dbnumber):
+        self.dbnumber = dbnumber
+        self._clients = set()
+        self._clientslock = threading.Lock()
+        self._recent = deque()      # (time sent, text) of batches, oldest first
+        self._complete = None       # time since which _recent has every batch
+        ready = threading.Event()
+        thread = threading.Thread(target=self._listen, args=(ready,))
+        thread.daemon = True
+        thread.start()
+        ready.wait(1)
+
+    def disconnect(self, client):
+        with self._clientslock:
+            self._clients.discard(client)
+
+    def clientcount(self):
+        with self._clientslock:
+            return len(self._clients)
+
+    def _listen(self, ready):
+        counter = itertools.count()
+        while True:
+            pending = OrderedDict()
+            try:
+                with DB(self.dbnumber) as db:
+                    pubsub = db.r.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(db.channel(self.CHANNEL + str(self.dbnumber)))
+                    with self._clientslock:
+                        self._complete = time.time()
+                    ready.set()
+                    deadline = None
+                    while True:
+                        wait = 1 if deadline is None else max(deadline - time.time(), 0)
+                        message = pubsub.get_message(timeout=wait)
+                        if message is not None:
+                            event = json.loads(message['data'])
+                            key = (event['kind'], event['key']) \
+                                if event['key'] is not None else next(counter)
+                            pending.pop(key, None)
+                            pending[key] = event
+                            if deadline is None:
+                                deadline = time.time() + self.WINDOW
+                        if deadline is not None and time.time() >= deadline:
+                            self._fanout(pending.values())
+                            pending = OrderedDict()
+                            deadline = None
+            except redis.exceptions.RedisError:
+                pass
+            with self._clientslock:
+                self._complete = None
+                self._recent.clear()
+            self._fanout(pending.values() + [self.RESYNC])
+            time.sleep(1)
+
+    @staticmethod
+    def _format(events):
+        return ''.join('event: %s\ndata: %s\n\n' % (event['kind'],
+            json.dumps(event['data'])) for event in events)
+
+    def _fanout(self, events):
+        '''
+        Queue events for every client, dropping clients that are full, and
+        keep them to replay to clients that connect within REPLAY seconds
+        '''
+        text = self._format(events)
+        with self._clientslock:
+            clients = list(self._clients)
+            if self._complete is not None:
+                now = time.time()
+                self._recent.append((now, text))
+                while self._recent[0][0] < now - self.REPLAY:
+                    self._recent.popleft()
+        for client in clients:
+            try:
+                client.queue.put_nowait(text)
+            except Queue.Full:
+                client.dropped = True
+                self.disconnect(client)
+                Metrics.increment('hscpc_events_dropped_total')
+        Metrics.increment('hscpc_events_sent_total', len(events) * len(clients))
+
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def tearDown(self):
+        EventHub.QUEUE_SIZE = 32
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+
+    def test_fanout(self):
+        clients = [EventHub.connect(DB.DBNTEST) for i in range(2)]
+        streams = [client.stream() for client in clients]
+        for stream in streams:
+            self.assertEqual(next(stream), 'retry: 3000\n\n')
+            self.assertEqual(next(stream), 'event: resync\ndata: null\n\n')
+        with DB(DB.DBNTEST) as db:
+            for solved in range(3):
+                EventHub.publish(db, 'score', 'alice', {'solved':solved})
+            EventHub.publish(db, 'announce', None, {'text':'hello'})
+            EventHub.publish(db, 'announce', None, {'text':'again'})
+        for stream in streams:
+            self.assertEqual(next(stream), 'event: score\ndata: {"solved": 2}\n\n'
+                'event: announce\ndata: {"text": "hello"}\n\n'
+                'event: announce\ndata: {"text": "again"}\n\n')
+            stream.close()
+        self.assertEqual(clients[0].hub.clientcount(), 0)
+
+    def test_replay(self):
+        first = EventHub.connect(DB.DBNTEST).stream()
+        next(first)
+        next(first)
+        with DB(DB.DBNTEST) as db:
+            EventHub.publish(db, 'score', 'alice', {'solved':1})
+        self.assertEqual(next(first), 'event: score\ndata: {"solved": 1}\n\n')
+        hub = EventHub._hubs[DB.DBNTEST]
+        # what a page read once the subscription was up missed is replayed
+        late = EventHub.connect(DB.DBNTEST, hub._complete + EventHub.SKEW).stream()
+        next(late)
+        self.assertTrue(next(late).endswith('event: score\ndata: {"solved": 1}\n\n'))
+        # but not from before the subscription started, or too long ago
+        for since in (hub._complete - EventHub.SKEW - 1, 
+                time.time() - EventHub.REPLAY - EventHub.SKEW - 1):
+            stale = EventHub.connect(DB.DBNTEST, since).stream()
+            next(stale)
+            self.assertEqual(next(stale), 'event: resync\ndata: null\n\n')
+            stale.close()
+        for stream in (first, late):
+            stream.close()
+
+    def test_slowconsumer(self):
+        EventHub.QUEUE_SIZE = 2
+        slow = EventHub.connect(DB.DBNTEST)
+        with DB(DB.DBNTEST) as db:
+            for i in range(3):
+                EventHub.publish(db, 'announce', None, {'text':str(i)})
+                time.sleep(EventHub.WINDOW * 2)
+        self.assertTrue(slow.dropped)
+        self.assertEqual(list(slow.stream()), ['retry: 3000\n\n'])
+        self.assertEqual(slow.hub.clientcount(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
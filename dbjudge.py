@@ -0,0 +1,470 @@
+import logging
+import threading
+import time
+import unittest
+from dbcontest import Contest
+from dbtools import DB, Metrics, Script
+from dbuser import User
+
+class JudgeQueue(object):
+    '''
+    Queue of submissions waiting to be judged, consumed by judge.py worker
+    processes so that no web request waits on judging:
+
+        judge/sub/<sid>     hash: contest, uid, puzzle, answer, submitted,
+                            deliveries, status
+        judge/pending/<uid> list of one contestant's sids, oldest first; 
+                            the first stays there while it is judged
+        judge/ready         list of uids with a sid to take, in turn order
+        judge/leases        sorted set of sids being judged, scored by the
+                            time their lease runs out
+        judge/dead          list of sids that could not be judged
+        judge/depth         number of waiting submissions
+        judge/signal        wakes idle workers
+        judge/stats         hash of outcome counts, seconds spent waiting
+                            and judging, and judging times counted in 
+                            Metrics.BUCKETS (fields le:<bound>)
+
+    Workers take the next contestant in turn, not the oldest submission,
+    so one contestant's burst can't starve the others. Each contestant has
+    at most one submission out at a time, and their next one is only ready
+    once it is finished, so attempts are scored in the order they were 
+    submitted. A taken submission is leased for LEASE seconds; if it isn't
+    acknowledged by then (the worker died or stalled) it is offered again,
+    and after MAXDELIVERIES attempts it goes to the dead list instead.
+    Delivery is at-least-once, so scoring uses the sid as the attempt id.
+    '''
+    KEY_SUBMISSION = 'judge/sub/'       # append sid
+    KEY_PENDING = 'judge/pending/'      # append uid
+    KEY_READY = 'judge/ready'
+    KEY_LEASES = 'judge/leases'
+    KEY_DEAD = 'judge/dead'
+    KEY_DEPTH = 'judge/depth'
+    KEY_SIGNAL = 'judge/signal'
+    KEY_STATS = 'judge/stats'
+    HKEY_STATS_BUCKET = 'le:'           # append bucket bound
+    HKEY_CONTEST = 'c'
+    HKEY_USERID = 'u'
+    HKEY_PUZZLE = 'p'
+    HKEY_ANSWER = 'a'
+    HKEY_SUBMITTED = 't'
+    HKEY_DELIVERIES = 'd'
+    HKEY_STATUS = 's'
+
+    STATUS_QUEUED = 'queued'
+    STATUS_JUDGING = 'judging'
+    STATUS_ACCEPTED = 'accepted'
+    STATUS_REJECTED = 'rejected'
+    STATUS_DEAD = 'dead'
+
+    LEASE = 30          # seconds to judge a submission before it is retried
+    MAXDELIVERIES = 3
+    SIGNALS = 100       # wake-ups kept for idle workers
+    IDLE = 1            # seconds an idle worker waits before checking again
+    BATCHSIZE = 500     # submissions per round trip in remapusers
+
+    # KEYS: submission hash, contestant's pending list, ready list, depth,
+    #       signal list
+    # ARGV: sid, uid, signals to keep, (field, value) pairs of the submission
+    SCRIPT_SUBMIT = Script('''
+        redis.call('HMSET', KEYS[1], unpack(ARGV, 4))
+        if redis.call('RPUSH', KEYS[2], ARGV[1]) == 1 then
+            redis.call('LPUSH', KEYS[3], ARGV[2])
+        end
+        redis.call('INCR', KEYS[4])
+        redis.call('LPUSH', KEYS[5], 1)
+        redis.call('LTRIM', KEYS[5], 0, ARGV[3] - 1)
+        ''')
+
+    # Take the next contestant's oldest submission and lease it, leaving it
+    # at the head of their pending list; they aren't ready again until it is
+    # finished. The contestant's pending list is found from the ready list,
+    # so its key can't be passed in KEYS (which rules out Redis Cluster).
+    # KEYS: ready list, leases, depth
+    # ARGV: pending prefix, submission prefix (both from db.key), lease
+    #       deadline, judging status
+    # Returns {sid, submission hash as field, value, ...} or nil
+    SCRIPT_TAKE = Script('''
+        local uid = redis.call('RPOP', KEYS[1])
+        if not uid then
+            return false
+        end
+        local sid = redis.call('LINDEX', ARGV[1] .. uid, 0)
+        redis.call('DECR', KEYS[3])
+        redis.call('ZADD', KEYS[2], ARGV[3], sid)
+        redis.call('HINCRBY', ARGV[2] .. sid, 'd', 1)
+        redis.call('HSET', ARGV[2] .. sid, 's', ARGV[4])
+        return {sid, redis.call('HGETALL', ARGV[2] .. sid)}
+        ''')
+
+    # Finish a leased submission, making its contestant ready again if they
+    # have more waiting. Returns 0 if the lease was lost.
+    # KEYS: leases, submission hash, stats, dead list, contestant's pending
+    #       list, ready list
+    # ARGV: sid, status, dead status, seconds waiting, seconds judging, uid,
+    #       stats field of the judging time's bucket
+    SCRIPT_ACK = Script('''
+        if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        redis.call('LREM', KEYS[5], 1, ARGV[1])
+        if redis.call('LLEN', KEYS[5]) > 0 then
+            redis.call('LPUSH', KEYS[6], ARGV[6])
+        end
+        redis.call('HSET', KEYS[2], 's', ARGV[2])
+        if ARGV[2] == ARGV[3] then
+            redis.call('LPUSH', KEYS[4], ARGV[1])
+        end
+        redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+        redis.call('HINCRBYFLOAT', KEYS[3], 'wait', ARGV[4])
+        redis.call('HINCRBYFLOAT', KEYS[3], 'judge', ARGV[5])
+        redis.call('HINCRBY', KEYS[3], ARGV[7], 1)
+        return 1
+        ''')
+
+    # Requeue (or give up on) submissions whose lease ran out. A requeued
+    # submission is still at the head of its contestant's pending list.
+    # KEYS: leases, ready list, dead list, depth, stats
+    # ARGV: now, max deliveries, pending prefix, submission prefix (both
+    #       from db.key), queued status, dead status
+    SCRIPT_RECLAIM = Script('''
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        for _, sid in ipairs(expired) do
+            redis.call('ZREM', KEYS[1], sid)
+            local submission = ARGV[4] .. sid
+            local uid = redis.call('HGET', submission, 'u')
+            if not uid or tonumber(redis.call('HGET', submission, 'd') or 0) >=
+                tonumber(ARGV[2]) then
+                redis.call('HSET', submission, 's', ARGV[6])
+                redis.call('LPUSH', KEYS[3], sid)
+                redis.call('HINCRBY', KEYS[5], ARGV[6], 1)
+                if uid then
+                    redis.call('LREM', ARGV[3] .. uid, 1, sid)
+                    if redis.call('LLEN', ARGV[3] .. uid) > 0 then
+                        redis.call('LPUSH', KEYS[2], uid)
+                    end
+                end
+            else
+                redis.call('HSET', submission, 's', ARGV[5])
+                redis.call('LPUSH', KEYS[2], uid)
+                redis.call('INCR', KEYS[4])
+            end
+        end
+        return #expired
+        ''')
+
+    @classmethod
+    def submit(cls, dbnumber, contestid, userid, puzzle, answer):
+        '''
+        Queue an answer to puzzle for judging and return its submission id
+        '''
+        with DB(dbnumber) as db:
+            sid = db.getuniqueid()
+            cls.SCRIPT_SUBMIT(db,
+                [cls.KEY_SUBMISSION + sid, cls.KEY_PENDING + userid, cls.KEY_READY,
+                    cls.KEY_DEPTH, cls.KEY_SIGNAL],
+                [sid, userid, cls.SIGNALS,
+                    cls.HKEY_CONTEST, contestid, cls.HKEY_USERID, userid,
+                    cls.HKEY_PUZZLE, puzzle, cls.HKEY_ANSWER, answer,
+                    cls.HKEY_SUBMITTED, time.time(), cls.HKEY_DELIVERIES, 0,
+                    cls.HKEY_STATUS, cls.STATUS_QUEUED])
+        return sid
+
+    @classmethod
+    def getsubmission(cls, dbnumber, sid):
+        '''
+        Return the submission's fields as a dict, empty if there is none
+        '''
+        with DB(dbnumber) as db:
+            return db.r.hgetall(cls.KEY_SUBMISSION + sid)
+
+    @classmethod
+    def remapusers(cls, dbnumber, uidmap):
+        '''
+        Replace old uids with new ones (uidmap, as returned by
+        User.migratelayout) as the owners of submissions. Run it with the
+        queue empty, as pending lists are not moved.
+        '''
+        if not uidmap:
+            return
+        with DB(dbnumber) as db:
+            keys = db.r.scan_iter(match=cls.KEY_SUBMISSION + '*', count=cls.BATCHSIZE)
+            for batch in User._batches(keys, cls.BATCHSIZE):
+                pipe = db.r.pipeline(transaction=False)
+                for key in batch:
+                    pipe.hget(key, cls.HKEY_USERID)
+                owners = pipe.execute()
+                pipe = db.r.pipeline(transaction=False)
+                for key, uid in zip(batch, owners):
+                    if uid in uidmap:
+                        pipe.hset(key, cls.HKEY_USERID, uidmap[uid])
+                pipe.execute()
+
+    @classmethod
+    def getstats(cls, dbnumber):
+        '''
+        Return a dict of queue depth, submissions being judged, dead
+        submissions, count per outcome, total seconds spent waiting and
+        judging, and 'seconds': a histogram of judging times in the form
+        Metrics.histogramlines takes. The stats are kept in Redis, so they
+        cover every judge process.
+        '''
+        with DB(dbnumber) as db:
+            pipe = db.r.pipeline(transaction=False)
+            pipe.get(cls.KEY_DEPTH)
+            pipe.zcard(cls.KEY_LEASES)
+            pipe.llen(cls.KEY_DEAD)
+            pipe.hgetall(cls.KEY_STATS)
+            depth, judging, dead, stats = pipe.execute()
+        stats = dict((name, float(value)) for name, value in stats.items())
+        buckets = [int(stats.pop(cls.HKEY_STATS_BUCKET + str(bound), 0)) 
+            for bound in Metrics.BUCKETS + ('+Inf',)]
+        histogram = [sum(buckets[:i + 1]) for i in range(len(Metrics.BUCKETS))]
+        stats.update(depth=int(depth or 0), judging=judging, dead=dead,
+            seconds=histogram + [stats.get('judge', 0.0), sum(buckets)])
+        return stats
+
+    @classmethod
+    def take(cls, dbnumber):
+        '''
+        Lease the next submission in turn. Returns (sid, submission dict) or
+        None if nothing is waiting.
+        '''
+        with DB(dbnumber) as db:
+            taken = cls.SCRIPT_TAKE(db, [cls.KEY_READY, cls.KEY_LEASES, cls.KEY_DEPTH],
+                [db.key(cls.KEY_PENDING), db.key(cls.KEY_SUBMISSION),
+                    time.time() + cls.LEASE,
+                    cls.STATUS_JUDGING])
+        if taken is None:
+            return None
+        sid, fields = taken
+        return sid, dict(zip(fields[::2], fields[1::2]))
+
+    @classmethod
+    def ack(cls, dbnumber, sid, submission, status, started):
+        '''
+        Record the outcome of a leased submission judged since started.
+        Returns False if its lease had already run out.
+        '''
+        now = time.time()
+        userid = submission[cls.HKEY_USERID]
+        bucket = cls.HKEY_STATS_BUCKET + Metrics.bucket(now - started)
+        with DB(dbnumber) as db:
+            return bool(cls.SCRIPT_ACK(db,
+                [cls.KEY_LEASES, cls.KEY_SUBMISSION + sid, cls.KEY_STATS, cls.KEY_DEAD,
+                    cls.KEY_PENDING + userid, cls.KEY_READY],
+                [sid, status, cls.STATUS_DEAD,
+                    started - float(submission[cls.HKEY_SUBMITTED]), now - started,
+                    userid, bucket]))
+
+    @classmethod
+    def reclaim(cls, dbnumber, now=None):
+        '''
+        Requeue submissions whose lease has run out, or move them to the
+        dead list after MAXDELIVERIES. Returns how many were found.
+        '''
+        with DB(dbnumber) as db:
+            return cls.SCRIPT_RECLAIM(db,
+                [cls.KEY_LEASES, cls.KEY_READY, cls.KEY_DEAD, cls.KEY_DEPTH,
+                    cls.KEY_STATS],
+                [time.time() if now is None else now, cls.MAXDELIVERIES,
+                    db.key(cls.KEY_PENDING), db.key(cls.KEY_SUBMISSION), cls.STATUS_QUEUED,
+                    cls.STATUS_DEAD])
+
+    @classmethod
+    def judgeone(cls, dbnumber):
+        '''
+        Take, judge and score one submission. Returns False if none was
+        waiting. A submission to a puzzle that doesn't exist goes straight
+        to the dead list; any other failure leaves it to be retried.
+        '''
+        taken = cls.take(dbnumber)
+        if taken is None:
+            return False
+        sid, submission = taken
+        started = time.time()
+        contest = Contest(dbnumber, submission[cls.HKEY_CONTEST])
+        expected = contest.getanswer(submission[cls.HKEY_PUZZLE])
+        if expected is None:
+            cls.ack(dbnumber, sid, submission, cls.STATUS_DEAD, started)
+            return True
+        correct = cls.check(expected, submission[cls.HKEY_ANSWER])
+        user = User(dbnumber, userid=submission[cls.HKEY_USERID])
+        contest.recordattempt(user, submission[cls.HKEY_PUZZLE], correct,
+            float(submission[cls.HKEY_SUBMITTED]), attemptid=sid)
+        status = cls.STATUS_ACCEPTED if correct else cls.STATUS_REJECTED
+        cls.ack(dbnumber, sid, submission, status, started)
+        return True
+
+    @staticmethod
+    def check(expected, answer):
+        '''
+        Return True if answer matches expected, ignoring differences in
+        whitespace
+        '''
+        return expected.split() == answer.split()
+
+    @classmethod
+    def work(cls, dbnumber, stop=None):
+        '''
+        Judge submissions until stop (a threading or multiprocessing Event)
+        is set, reclaiming expired leases as it goes
+        '''
+        stop = stop or threading.Event()
+        reclaimed = 0
+        while not stop.is_set():
+            try:
+                if time.time() - reclaimed > cls.LEASE / 3.0:
+                    cls.reclaim(dbnumber)
+                    reclaimed = time.time()
+                if not cls.judgeone(dbnumber):
+                    with DB(dbnumber) as db:
+                        db.r.brpop(cls.KEY_SIGNAL, cls.IDLE)
+            except Exception:
+                logging.exception('judging failed')
+                time.sleep(cls.IDLE)
+
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def setUp(self):
+        self.users = []
+        for name in ('alice', 'bob'):
+            u = User(DB.DBNTEST)
+            u.setproperties(username=name)
+            self.users.append(u)
+        self.contest = Contest.create(DB.DBNTEST, 'Spring')
+        self.contest.setpuzzle('p1', '42\n')
+
+    def tearDown(self):
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+
+    def submit(self, user, answer, puzzle='p1'):
+        return JudgeQueue.submit(DB.DBNTEST, self.contest.contestid, user.userid,
+            puzzle, answer)
+
+    def test_fairness(self):
+        alice, bob = self.users
+        sids = [self.submit(alice, str(i)) for i in range(3)] + [self.submit(bob, '0')]
+        self.assertEqual(JudgeQueue.getstats(DB.DBNTEST)['depth'], 4)
+        taken = []
+        for i in range(4):
+            sid, submission = JudgeQueue.take(DB.DBNTEST)
+            taken.append(sid)
+            JudgeQueue.ack(DB.DBNTEST, sid, submission, JudgeQueue.STATUS_REJECTED,
+                time.time())
+        self.assertEqual(taken, [sids[0], sids[3], sids[1], sids[2]])
+        self.assertEqual(JudgeQueue.take(DB.DBNTEST), None)
+        stats = JudgeQueue.getstats(DB.DBNTEST)
+        self.assertEqual((stats['depth'], stats['judging']), (0, 0))
+
+    def test_ordering(self):
+        alice, bob = self.users
+        sids = [self.submit(alice, '41'), self.submit(alice, '40'), 
+            self.submit(alice, '42'), self.submit(bob, '42')]
+        # two workers: the second can't take alice's next while the first
+        # is judging her last
+        first = JudgeQueue.take(DB.DBNTEST)
+        second = JudgeQueue.take(DB.DBNTEST)
+        self.assertEqual((first[0], second[0]), (sids[0], sids[3]))
+        self.assertEqual(JudgeQueue.take(DB.DBNTEST), None)
+        stats = JudgeQueue.getstats(DB.DBNTEST)
+        self.assertEqual((stats['depth'], stats['judging']), (2, 2))
+        JudgeQueue.ack(DB.DBNTEST, first[0], first[1], JudgeQueue.STATUS_REJECTED,
+            time.time())
+        self.assertEqual(JudgeQueue.take(DB.DBNTEST)[0], sids[1])
+
+    def test_parallelworkers(self):
+        alice, bob = self.users
+        for answer in ('41', '40', '42', '41'):
+            self.submit(alice, answer)
+        stop = threading.Event()
+        workers = [threading.Thread(target=JudgeQueue.work, args=(DB.DBNTEST, stop))
+            for i in range(2)]
+        for worker in workers:
+            worker.start()
+        try:
+            for i in range(200):
+                stats = JudgeQueue.getstats(DB.DBNTEST)
+                if stats.get('accepted', 0) + stats.get('rejected', 0) == 4:
+                    break
+                time.sleep(0.02)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        rows, mine = self.contest.standings(userid=alice.userid)
+        self.assertEqual(mine['solved'], 1)
+        self.assertTrue(2 * Contest.PENALTY <= mine['penalty'] < 3 * Contest.PENALTY)
+
+    def test_judge(self):
+        alice, bob = self.users
+        wrong = self.submit(alice, '41')
+        right = self.submit(alice, ' 42 ')
+        nopuzzle = self.submit(bob, '42', puzzle='p9')
+        while JudgeQueue.judgeone(DB.DBNTEST):
+            pass
+        status = [JudgeQueue.getsubmission(DB.DBNTEST, sid)[JudgeQueue.HKEY_STATUS]
+            for sid in (wrong, right, nopuzzle)]
+        self.assertEqual(status, ['rejected', 'accepted', 'dead'])
+        rows, mine = self.contest.standings(userid=alice.userid)
+        self.assertEqual((mine['solved'], mine['penalty'] >= Contest.PENALTY), (1, True))
+        stats = JudgeQueue.getstats(DB.DBNTEST)
+        self.assertEqual((stats['accepted'], stats['rejected'], stats['dead'],
+            stats['judging']), (1, 1, 1, 0))
+        histogram = stats['seconds']
+        self.assertEqual((histogram[-1], histogram[-3]), (3, 3))
+        self.assertEqual(histogram[-2], stats['judge'])
+        self.assertEqual(histogram[:-2], sorted(histogram[:-2]))
+
+    def test_redelivery(self):
+        alice, bob = self.users
+        sid = self.submit(alice, '41')
+        for delivery in range(JudgeQueue.MAXDELIVERIES):
+            taken, submission = JudgeQueue.take(DB.DBNTEST)
+            self.assertEqual(taken, sid)
+            started = time.time()
+            self.assertEqual(JudgeQueue.reclaim(DB.DBNTEST, time.time() +
+                JudgeQueue.LEASE + 1), 1)
+            self.assertFalse(JudgeQueue.ack(DB.DBNTEST, sid, submission,
+                JudgeQueue.STATUS_REJECTED, started))  # too late
+        self.assertEqual(JudgeQueue.take(DB.DBNTEST), None)
+        self.assertEqual(JudgeQueue.getsubmission(DB.DBNTEST, sid)[JudgeQueue.HKEY_STATUS],
+            JudgeQueue.STATUS_DEAD)
+        self.assertEqual(JudgeQueue.getstats(DB.DBNTEST)['dead'], 1)
+
+    def test_remapusers(self):
+        alice, bob = self.users
+        sids = [self.submit(alice, '42'), self.submit(bob, '42')]
+        while JudgeQueue.judgeone(DB.DBNTEST):
+            pass
+        JudgeQueue.remapusers(DB.DBNTEST, {alice.userid:'new'})
+        owners = [JudgeQueue.getsubmission(DB.DBNTEST, sid)[JudgeQueue.HKEY_USERID]
+            for sid in sids]
+        self.assertEqual(owners, ['new', bob.userid])
+
+    def test_work(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=JudgeQueue.work, args=(DB.DBNTEST, stop))
+        worker.start()
+        try:
+            sid = self.submit(self.users[0], '42')
+            for i in range(100):
+                status = JudgeQueue.getsubmission(DB.DBNTEST, sid)[JudgeQueue.HKEY_STATUS]
+                if status == JudgeQueue.STATUS_ACCEPTED:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(status, JudgeQueue.STATUS_ACCEPTED)
+        finally:
+            stop.set()
+            worker.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
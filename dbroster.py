@@ -0,0 +1,292 @@
+import csv
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import unittest
+from dbtools import DB, Invalidator, Script
+from dbuser import User
+from hashpool import HashPool
+
+class Roster(object):
+    '''
+    Bulk import and export of user records.
+
+    Import reads CSV (with a header row) or JSONL files with the fields
+    username, email, realname, password (or passwordhash, as written by
+    export) and level (number or name, default contestant). A record that
+    can't be parsed, isn't an object, or has a field of the wrong type is
+    rejected like one whose username is taken. Each batch of
+    records is hashed in parallel on the HashPool and written by one script
+    call that checks username/email uniqueness, creates the user hashes and
+    updates the indexes. Progress is kept in import/<file digest>, so an
+    interrupted import resumes after the last completed batch.
+
+    Export streams every user as one JSON object per line, walking the
+    uid index with SSCAN cursors a batch at a time.
+    '''
+    KEY_IMPORT_PROGRESS = 'import/'     # append sha1 of file contents
+
+    BATCHSIZE = 500
+
+    LEVEL_NAMES = {'root':User.LEVEL_ROOT,
+        'admin':User.LEVEL_ADMIN,
+        'coach':User.LEVEL_COACH,
+        'contestant':User.LEVEL_CONTESTANT,
+        'visitor':User.LEVEL_VISITOR}
+    EXPORT_FIELDS = ('username', 'email', 'realname', 'passwordhash', 'level')
+    TEXT_FIELDS = ('username', 'email', 'realname', 'password', 'passwordhash')
+
+    # Create users whose username and email are free. Returns the 1-based
+    # positions of records that were rejected.
+    # KEYS: usernames hash, emails hash, alluids set, username index, 
+    #       realname index, (user hash, level set) per record
+    # ARGV: username, email, realname, passwordhash and level field names,
+    #       (uid, field name prefix, username, email, realname, passwordhash,
+    #       level) per record
+    SCRIPT_IMPORT = Script('''
+        local rejected = {}
+        for i = 1, (#KEYS - 5) / 2 do
+            local userkey, levelkey = KEYS[2*i+4], KEYS[2*i+5]
+            local uid, prefix = ARGV[7*i-1], ARGV[7*i]
+            local username, email = ARGV[7*i+1], ARGV[7*i+2]
+            if username == '' or redis.call('HEXISTS', KEYS[1], username) == 1 or
+                (email ~= '' and redis.call('HEXISTS', KEYS[2], email) == 1) then
+                rejected[#rejected+1] = i
+            else
+                redis.call('HSET', KEYS[1], username, uid)
+                if email ~= '' then
+                    redis.call('HSET', KEYS[2], email, uid)
+                end
+                redis.call('HMSET', userkey, prefix .. ARGV[1], username,
+                    prefix .. ARGV[2], email, prefix .. ARGV[3], ARGV[7*i+3],
+                    prefix .. ARGV[4], ARGV[7*i+4], prefix .. ARGV[5], ARGV[7*i+5])
+                redis.call('ZADD', KEYS[4], 0, string.lower(username) .. '\\0' .. uid)
+                if ARGV[7*i+3] ~= '' then
+                    redis.call('ZADD', KEYS[5], 0, 
+                        string.lower(ARGV[7*i+3]) .. '\\0' .. uid)
+                end
+                redis.call('SADD', KEYS[3], uid)
+                redis.call('SADD', levelkey, uid)
+            end
+        end
+        return rejected
+        ''')
+
+    @classmethod
+    def importfile(cls, dbnumber, path, **kwargs):
+        '''
+        Import the roster at path. Returns (imported, rejected) where
+        rejected is a list of (line number, record) for records that were
+        malformed (with the line's text, or the parse error, for ones that
+        couldn't be parsed) or whose username or email was already taken.
+        '''
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        progresskey = cls.KEY_IMPORT_PROGRESS + cls._digest(path)
+        imported = 0
+        rejected = []
+        with DB(dbnumber) as db:
+            done = 0 if kwargs.get('restart') else int(db.r.get(progresskey) or 0)
+            records = itertools.islice(cls.readrecords(path), done, None)
+            batch = []
+            for number, (line, record) in enumerate(records, done + 1):
+                batch.append((line, record))
+                if len(batch) >= batchsize:
+                    imported += cls._importbatch(db, batch, rejected)
+                    db.r.set(progresskey, number)
+                    batch = []
+            if batch:
+                imported += cls._importbatch(db, batch, rejected)
+            db.r.delete(progresskey)
+            Invalidator.publish(db, User.CACHE_USERNAMES)
+        return imported, rejected
+
+    @classmethod
+    def exportfile(cls, dbnumber, out, **kwargs):
+        '''
+        Write every user (or the first limit users) to the file object out 
+        as JSON lines. Returns the number of users written.
+        '''
+        count = 0
+        limit = kwargs.pop('limit', None)
+        kwargs.setdefault('fields', cls.EXPORT_FIELDS)
+        for user in itertools.islice(User.iterusers(dbnumber, **kwargs), limit):
+            out.write(json.dumps(dict((field, getattr(user, field))
+                for field in cls.EXPORT_FIELDS)) + '\n')
+            count += 1
+        return count
+
+    @classmethod
+    def readrecords(cls, path):
+        '''
+        Generate (line number, record) for each record in a .csv or .jsonl
+        roster file: a dict, if the record parsed as one, else whatever it 
+        parsed as, the line's text, or the parse error
+        '''
+        with open(path) as f:
+            if path.endswith('.csv'):
+                reader = csv.DictReader(f)
+                while True:
+                    try:
+                        record = next(reader)
+                    except StopIteration:
+                        return
+                    except csv.Error as e:
+                        record = str(e)
+                    yield reader.line_num, record
+            else:
+                for number, line in enumerate(f, 1):
+                    if line.strip():
+                        try:
+                            yield number, json.loads(line)
+                        except ValueError:
+                            yield number, line.strip()
+
+    @classmethod
+    def _importbatch(cls, db, batch, rejected):
+        '''
+        Hash, check and write one batch of (number, record). Returns the
+        number of users created, appending failures to rejected.
+        '''
+        valid = []
+        for number, record in batch:
+            try:
+                cls._checkrecord(record)
+                valid.append((number, record))
+            except (KeyError, ValueError):
+                rejected.append((number, record))
+        topassword = [record for number, record in valid
+            if record.get('password') and not record.get('passwordhash')]
+        hashes = HashPool.generatemany([record['password'] for record in topassword])
+        for record, passwordhash in zip(topassword, hashes):
+            record['passwordhash'] = passwordhash
+        keys = [User.KEY_SITE_USERNAMES, User.KEY_SITE_EMAILS, User.KEY_SITE_ALLUIDS,
+            User.KEY_SITE_USERNAMEINDEX, User.KEY_SITE_REALNAMEINDEX]
+        args = [User.HKEY_USERNAME, User.HKEY_EMAIL, User.HKEY_REALNAME,
+            User.HKEY_PASSWORDHASH, User.HKEY_LEVEL]
+        if not valid:
+            return 0
+        layout = User._getlayout(db)
+        for (number, record), uid in zip(valid, 
+            User._newuserids(db, layout, len(valid))):
+            key, prefix = User._locate(layout, uid)
+            keys += [key, User.LEVEL_KEYS[record['level']]]
+            args += [uid, prefix, record.get('username') or '', 
+                record.get('email') or '', record.get('realname') or '', 
+                record.get('passwordhash') or '', record['level']]
+        failed = cls.SCRIPT_IMPORT(db, keys, args)
+        rejected.extend(valid[i-1] for i in failed)
+        return len(valid) - len(failed)
+
+    @classmethod
+    def _checkrecord(cls, record):
+        '''
+        Raise ValueError unless record is a dict of text fields with a valid
+        level, which is replaced by its number
+        '''
+        if not isinstance(record, dict):
+            raise ValueError(record)
+        for field in cls.TEXT_FIELDS:
+            if not isinstance(record.get(field) or '', basestring):
+                raise ValueError(field)
+        record['level'] = cls._parselevel(record.get('level'))
+
+    @classmethod
+    def _parselevel(cls, level):
+        if isinstance(level, bool) or \
+                not isinstance(level, (basestring, int, long, type(None))):
+            raise ValueError(level)
+        if not level:
+            return User.LEVEL_CONTESTANT
+        if str(level).lower() in cls.LEVEL_NAMES:
+            return cls.LEVEL_NAMES[str(level).lower()]
+        level = int(level)
+        if level not in User.LEVEL_STRINGS:
+            raise ValueError(level)
+        return level
+
+    @staticmethod
+    def _digest(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('username,email,realname,password,level\n')
+            f.write('alice,alice@gmail.com,Alice,letmein,coach\n')
+            f.write('bob,bob@gmail.com,Bob,letmeintoo,\n')
+            f.write('alice,alice2@gmail.com,Alice Again,x,contestant\n')
+            f.write('carol,,Carol,,4\n')
+            f.write('dave,dave@gmail.com,Dave,x,wizard\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+
+    def test_import(self):
+        imported, rejected = Roster.importfile(DB.DBNTEST, self.path, batchsize=2)
+        self.assertEqual(imported, 3)
+        self.assertEqual(sorted(number for number, record in rejected), [4, 6])
+        self.assertEqual(User.getuserscount(DB.DBNTEST), 3)
+        self.assertEqual(User.verifyindexes(DB.DBNTEST), [])
+        alice = User(DB.DBNTEST, username='alice')
+        self.assertEqual(alice.level, User.LEVEL_COACH)
+        self.assertTrue(alice.checkpassword('letmein'))
+        self.assertEqual(User(DB.DBNTEST, username='carol').passwordhash, '')
+
+    def test_resume(self):
+        with DB(DB.DBNTEST) as db:
+            db.r.set(Roster.KEY_IMPORT_PROGRESS + Roster._digest(self.path), 2)
+        imported, rejected = Roster.importfile(DB.DBNTEST, self.path)
+        self.assertEqual(imported, 2)
+        self.assertEqual(sorted(u.username for u in User.getusers(DB.DBNTEST)),
+            ['alice', 'carol'])
+
+    def test_malformed(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            f.write('{"username": "alice", "password": "letmein"}\n')
+            f.write('{"username": "bob", \n')
+            f.write('\n')
+            f.write('["carol"]\n')
+            f.write('{"username": "dave", "level": [1]}\n')
+            f.write('{"username": "erin", "password": 42}\n')
+            f.write('{"username": "frank", "level": "coach"}\n')
+        try:
+            imported, rejected = Roster.importfile(DB.DBNTEST, path, batchsize=2)
+        finally:
+            os.remove(path)
+        self.assertEqual(imported, 2)
+        self.assertEqual([number for number, record in rejected], [2, 4, 5, 6])
+        self.assertEqual(rejected[0][1], '{"username": "bob",')
+        self.assertEqual(User(DB.DBNTEST, username='frank').level, User.LEVEL_COACH)
+
+    def test_exportimport(self):
+        Roster.importfile(DB.DBNTEST, self.path)
+        fd, exportpath = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(fd, 'w') as f:
+            self.assertEqual(Roster.exportfile(DB.DBNTEST, f, batchsize=2), 3)
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+        imported, rejected = Roster.importfile(DB.DBNTEST, exportpath)
+        os.remove(exportpath)
+        self.assertEqual((imported, rejected), (3, []))
+        self.assertTrue(User(DB.DBNTEST, username='bob').checkpassword('letmeintoo'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,6 @@
 import redis
 import unittest
-from dbtools import DB
+from dbtools import DB, Invalidator, LocalCache
 
 class Site(object):
     '''
@@ -12,15 +12,21 @@ class Site(object):
     Default site data include:
     
         root user id: site/rootuid -> 'uuid' or '' if none
-        site name: site/name -> site name string
+        site name: s/n -> site name string
+        site version: s/v -> integer, incremented on every site change 
+            (and restarted by a reset, so it is only unique together with 
+            the db's generation, which start() also reads)
         contests: site/contests -> list of contest 'uuid'
         
         user info..        
         user info hashes: user/<uuid> -> hash of attributes
-        admin user id list: site/adminuids -> list of 'uuid'
-        coach user id list: site/coachuids -> list of 'uuid'
-        contestant user id list: site/contestantuids -> list of 'uuid'
-        alluser id list: site/alluids -> list of 'uuid'
+        root user id set: site/rootuids -> set of 'uuid'
+        admin user id set: site/adminuids -> set of 'uuid'
+        coach user id set: site/coachuids -> set of 'uuid'
+        contestant user id set: site/contestantuids -> set of 'uuid'
+        visitor user id set: site/visitoruids -> set of 'uuid'
+        pending user id set: site/pendinguids -> set of 'uuid'
+        alluser id set: site/alluids -> set of 'uuid'
         username hashes: site/usernames -> hash of username->uuid
         email hashes: site/emails -> hash of email->uuid
         
@@ -31,30 +37,70 @@ class Site(object):
         puzzle info..
         puzzle info hashes: puzzle/<uuid> -> hash of attributes
         
+    Site data are cached in each process for CACHE_TTL seconds, so start() 
+    normally makes no database calls. Any change bumps the site version and
+    invalidates the cached copy in every process.
+    
     '''
     
     KEY_SITE_NAME = 's/n'
+    KEY_SITE_VERSION = 's/v'
     
     VALUE_SITE_DEFAULTNAME = 'HSCPC'
     
+    CACHE_NAME = 'site'
+    CACHE_TTL = 300
+    _cache = Invalidator.register(CACHE_NAME, LocalCache(maxsize=16, ttl=CACHE_TTL))
+    
     def __init__(self, dbnumber):
         self.dbnumber = dbnumber
                 
     def start(self):
+        cached = self._cache.get((self.dbnumber, self.CACHE_NAME))
+        if cached is None:
+            with DB(self.dbnumber) as db:
+                Invalidator.listen(self.dbnumber)
+                if not self._exists(db):
+                    self._createdefault(db)
+                stamp = self._cache.stamp()
+                self._loadsite(db)
+            self._cache.put((self.dbnumber, self.CACHE_NAME), 
+                (self.name, self.version, self.generation), stamp)
+        else:
+            self.name, self.version, self.generation = cached
+            
+    def setname(self, name):
         with DB(self.dbnumber) as db:
-            if not self._exists(db):
-                self._createdefault(db)
-            self._loadsite(db)
+            pipe = db.r.pipeline()
+            pipe.set(self.KEY_SITE_NAME, name)
+            self._changed(db, pipe)
+        self.name = name
                 
     def _exists(self, db):
         return db.r.exists(self.KEY_SITE_NAME)
     
     def _createdefault(self, db):
         db.reset()
-        db.r.set(self.KEY_SITE_NAME, self.VALUE_SITE_DEFAULTNAME)
+        pipe = db.r.pipeline()
+        pipe.set(self.KEY_SITE_NAME, self.VALUE_SITE_DEFAULTNAME)
+        self._changed(db, pipe)
+        
+    def _changed(self, db, pipe):
+        '''
+        Bump the site version with the changes queued on pipe, execute it,
+        and invalidate the site cache in every process
+        '''
+        pipe.incr(self.KEY_SITE_VERSION)
+        pipe.execute()
+        Invalidator.publish(db, self.CACHE_NAME, self.CACHE_NAME)
         
     def _loadsite(self, db):
-        self.name = db.r.get(self.KEY_SITE_NAME)
+        pipe = db.ro.pipeline(transaction=False)
+        pipe.get(self.KEY_SITE_NAME)
+        pipe.get(self.KEY_SITE_VERSION)
+        self.name, version = pipe.execute()
+        self.version = int(version or 0)
+        self.generation = db.generation
         
         
                 
@@ -75,6 +121,20 @@ class TestSequenceFunctions(unittest.TestCase):
         s = Site(DB.DBNTEST) # select DB 1 for testing
         s.start()
         self.assertEquals(s.name, Site.VALUE_SITE_DEFAULTNAME)
+        
+    def test_sitecache(self):
+        s = Site(DB.DBNTEST)
+        s.start()
+        with DB(DB.DBNTEST) as db:
+            db.r.set(Site.KEY_SITE_NAME, 'changed behind our back')
+        s2 = Site(DB.DBNTEST)
+        s2.start()
+        self.assertEqual(s2.name, Site.VALUE_SITE_DEFAULTNAME)
+        s.setname('Renamed')
+        s3 = Site(DB.DBNTEST)
+        s3.start()
+        self.assertEqual(s3.name, 'Renamed')
+        self.assertEqual(s3.version, s.version + 1)
 
         
 if __name__ == '__main__':
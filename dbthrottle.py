@@ -0,0 +1,211 @@
+import os
+import time
+import unittest
+import uuid
+from dbtools import DB, Invalidator, LocalCache, Script
+from dbuser import User
+
+class LoginThrottle(object):
+    '''
+    Limits failed login attempts with sliding windows kept in Redis, one 
+    per username and one per client address:
+
+        login/u/<username> -> sorted set of attempt ids scored by time (ms)
+        login/ip/<address> -> sorted set of attempt ids scored by time (ms)
+        login/stats -> hash of allowed/blocked/unknown attempt counts
+
+    Each attempt is checked, recorded and counted by one script call, which
+    also reports usernames that don't exist. An attempt counts against both
+    windows until it is known to have succeeded: succeeded() then takes it
+    off the address window and clears the username's, so only failures 
+    (and logins still being checked) use up the limits. Usernames that
+    don't exist are remembered in a short-lived process-local negative 
+    cache (dropped whenever the username is claimed), so repeated bogus 
+    logins cost no Redis calls, user loads or password hashing at all.
+
+    The limits come from the environment unless overridden with 
+    LoginThrottle.configure:
+
+        LOGIN_WINDOW            seconds a failed attempt is counted for
+        LOGIN_USERNAME_LIMIT    failed attempts per username per window
+        LOGIN_ADDRESS_LIMIT     failed attempts per client address per window
+    '''
+    KEY_LOGIN_USERNAME = 'login/u/'    # append username
+    KEY_LOGIN_ADDRESS = 'login/ip/'    # append address
+    KEY_LOGIN_STATS = 'login/stats'
+    
+    ALLOWED = 0
+    BLOCKED = 1
+    UNKNOWN = 2
+    
+    NEGATIVE_TTL = 60       # seconds to remember a nonexistent username
+    
+    DEFAULTS = {'window':('LOGIN_WINDOW', 300),
+        'usernamelimit':('LOGIN_USERNAME_LIMIT', 10),
+        'addresslimit':('LOGIN_ADDRESS_LIMIT', 50)}
+    
+    # KEYS: username window, address window, stats hash, site usernames hash
+    # ARGV: now (ms), window (ms), username limit, address limit, attempt id,
+    #       username
+    SCRIPT_ATTEMPT = Script('''
+        local now, window = tonumber(ARGV[1]), tonumber(ARGV[2])
+        local limits = {tonumber(ARGV[3]), tonumber(ARGV[4])}
+        for i = 1, 2 do
+            redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', now - window)
+            if redis.call('ZCARD', KEYS[i]) >= limits[i] then
+                redis.call('HINCRBY', KEYS[3], 'blocked', 1)
+                return 1
+            end
+        end
+        for i = 1, 2 do
+            redis.call('ZADD', KEYS[i], now, ARGV[5])
+            redis.call('PEXPIRE', KEYS[i], window)
+        end
+        if redis.call('HEXISTS', KEYS[4], ARGV[6]) == 0 then
+            redis.call('HINCRBY', KEYS[3], 'unknown', 1)
+            return 2
+        end
+        redis.call('HINCRBY', KEYS[3], 'allowed', 1)
+        return 0
+        ''')
+    
+    _config = {}
+    _nousers = Invalidator.register(User.CACHE_USERNAMES, 
+        LocalCache(maxsize=10000, ttl=NEGATIVE_TTL))
+    _localunknown = 0
+    
+    @classmethod
+    def configure(cls, **kwargs):
+        '''
+        Override settings (window, usernamelimit, addresslimit)
+        '''
+        cls._config.update(kwargs)
+    
+    @classmethod
+    def getsetting(cls, name):
+        if name in cls._config:
+            return cls._config[name]
+        envname, default = cls.DEFAULTS[name]
+        value = os.getenv(envname)
+        return default if value is None else int(value)
+    
+    @classmethod
+    def attempt(cls, dbnumber, username, address):
+        '''
+        Record a login attempt and return (ALLOWED, BLOCKED or UNKNOWN, the
+        attempt id to pass to succeeded if the password turns out right)
+        '''
+        if cls._nousers.get((dbnumber, username)):
+            cls._localunknown += 1
+            return cls.UNKNOWN, None
+        attemptid = uuid.uuid4().hex
+        with DB(dbnumber) as db:
+            Invalidator.listen(dbnumber)
+            result = cls.SCRIPT_ATTEMPT(db, 
+                [cls.KEY_LOGIN_USERNAME + username, cls.KEY_LOGIN_ADDRESS + address,
+                    cls.KEY_LOGIN_STATS, User.KEY_SITE_USERNAMES],
+                [int(time.time() * 1000), cls.getsetting('window') * 1000, 
+                    cls.getsetting('usernamelimit'), cls.getsetting('addresslimit'),
+                    attemptid, username])
+        if result == cls.UNKNOWN:
+            cls._nousers.put((dbnumber, username), True)
+        return result, attemptid
+    
+    @classmethod
+    def succeeded(cls, dbnumber, username, address, attemptid):
+        '''
+        Stop counting an attempt that logged in, and forget the username's
+        earlier failures
+        '''
+        with DB(dbnumber) as db:
+            pipe = db.r.pipeline()
+            pipe.zrem(cls.KEY_LOGIN_ADDRESS + address, attemptid)
+            pipe.delete(cls.KEY_LOGIN_USERNAME + username)
+            pipe.execute()
+    
+    @classmethod
+    def getstats(cls, dbnumber):
+        '''
+        Return a dict of attempt counts: allowed, blocked and unknown across 
+        all processes, plus unknowncached rejected by this process's cache
+        '''
+        with DB(dbnumber) as db:
+            stats = db.r.hgetall(cls.KEY_LOGIN_STATS)
+        result = dict((name, int(stats.get(name, 0))) 
+            for name in ('allowed', 'blocked', 'unknown'))
+        result['unknowncached'] = cls._localunknown
+        return result
+        
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def setUp(self):
+        u = User(DB.DBNTEST)
+        u.setproperties(username='alice', password='letmein')
+
+    def tearDown(self):
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+
+    def test_usernamelimit(self):
+        for i in range(LoginThrottle.getsetting('usernamelimit')):
+            self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', 
+                '10.0.0.%d' % i)[0], LoginThrottle.ALLOWED)
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.1.1')[0],
+            LoginThrottle.BLOCKED)
+        stats = LoginThrottle.getstats(DB.DBNTEST)
+        self.assertEqual((stats['allowed'], stats['blocked']), 
+            (LoginThrottle.getsetting('usernamelimit'), 1))
+
+    def test_addresslimit(self):
+        for i in range(LoginThrottle.getsetting('addresslimit')):
+            LoginThrottle.attempt(DB.DBNTEST, 'user%d' % i, '10.0.0.1')
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.0.1')[0],
+            LoginThrottle.BLOCKED)
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.0.2')[0],
+            LoginThrottle.ALLOWED)
+
+    def test_succeeded(self):
+        LoginThrottle.configure(usernamelimit=3, addresslimit=3)
+        try:
+            for i in range(2):
+                LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.0.1')
+            result, attemptid = LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.0.2')
+            LoginThrottle.succeeded(DB.DBNTEST, 'alice', '10.0.0.2', attemptid)
+            # successes don't use up either window
+            for i in range(3):
+                result, attemptid = LoginThrottle.attempt(DB.DBNTEST, 'alice', 
+                    '10.0.0.2')
+                self.assertEqual(result, LoginThrottle.ALLOWED)
+                LoginThrottle.succeeded(DB.DBNTEST, 'alice', '10.0.0.2', attemptid)
+            # and the failures before them were forgotten
+            for i in range(3):
+                self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', 
+                    '10.0.1.%d' % i)[0], LoginThrottle.ALLOWED)
+            self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'alice', '10.0.1.9')[0],
+                LoginThrottle.BLOCKED)
+        finally:
+            LoginThrottle.configure(usernamelimit=LoginThrottle.DEFAULTS[
+                'usernamelimit'][1], addresslimit=LoginThrottle.DEFAULTS[
+                'addresslimit'][1])
+
+    def test_unknown(self):
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'bob', '10.0.0.1')[0],
+            LoginThrottle.UNKNOWN)
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'bob', '10.0.0.1')[0],
+            LoginThrottle.UNKNOWN)
+        stats = LoginThrottle.getstats(DB.DBNTEST)
+        self.assertEqual(stats['unknown'], 1)
+        u = User(DB.DBNTEST)
+        u.setproperties(username='bob')
+        self.assertEqual(LoginThrottle.attempt(DB.DBNTEST, 'bob', '10.0.0.1')[0],
+            LoginThrottle.ALLOWED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,43 +1,920 @@
+import hashlib
 import os
+import random
 import redis
+import subprocess
+import threading
+import time
 import unittest
 import uuid
+from collections import OrderedDict
 
 class DB(object):
     '''
     Class to represent the database connection with Redis server. The member
     variable, r, points to the redis instance.
+
+    Connections are checked out of a process-wide pool, one per (url, db
+    number). The pools are discarded and rebuilt after a fork, so gunicorn
+    workers never share sockets with the master. Pool sizing and timeouts
+    come from the environment unless overridden with DB.configure:
+
+        REDISTOGO_URL           redis server url
+        REDIS_MAX_CONNECTIONS   connections per pool
+        REDIS_POOL_TIMEOUT      seconds to wait for a free connection
+        REDIS_SOCKET_TIMEOUT    seconds to wait on a command reply
+        REDIS_CONNECT_TIMEOUT   seconds to wait when connecting
+        REDIS_NAMESPACE         prefix for every key and channel, so 
+                                several sites or test runs can share a db
+                                number (not all digits, and no ':', '/' or
+                                glob characters)
+        REDIS_REPLICA_URLS      comma separated urls of read replicas
+        REDIS_REPLICA_LAG       seconds after a cache invalidation during 
+                                which reads stay on the primary
+
+    Keys live under "<namespace>:<generation>:" (just "<namespace>:" for
+    generation 0, so existing data is found). r adds the prefix to every
+    key it sends, so code and scripts use bare key names; only key prefixes
+    passed to scripts as ARGV need db.key(). The empty namespace owns every
+    key outside the named ones; its own key names all have a '/' before any
+    ':', which a namespace can't, so they can't be mistaken for another's.
+    
+    Each process learns of a reset elsewhere from the Invalidator, whose
+    listener every DB starts, so it stops writing to the old generation
+    before that is swept.
+    
+    Writes go to r, on the primary; reads that can tolerate replication lag
+    go to ro, a replica when there are any. Between beginsession() and
+    endsession() the current thread's writes are noticed, and its reads go
+    to the primary until a replica has caught up with them.
     '''
     DBN = 0
     DBNTEST = 1
+    BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    
+    # namespace keys, outside every generation
+    KEY_GENERATION = 'generation'
+    KEY_RESET = 'reset'     # hash of the last reset's progress
+    
+    CACHE_GENERATIONS = 'generations'
+    SWEEP_BATCH = 500       # keys scanned per step of a reset's sweep
+    REPLICA_RETRY = 5       # seconds a replica that failed is left out of reads
+    
+    SETTINGS = ('url', 'maxconnections', 'pooltimeout', 'sockettimeout', 
+        'connecttimeout', 'namespace', 'replicas', 'replicalag')
+    
+    _config = {}
+    _pools = {}
+    _poolspid = None
+    _poolslock = threading.Lock()
+    _poolname = threading.local()
+    _generations = None     # LocalCache, set once Invalidator is defined
+    _session = threading.local()
+    _replicaoffsets = {}    # replica url -> replication offset last seen
+    _replicafailures = {}   # replica url -> time it last failed
+    _invalidated = 0        # time of the last cache invalidation
+    
+    @classmethod
+    def configure(cls, **kwargs):
+        '''
+        Override any of the SETTINGS. Existing pools are discarded.
+        '''
+        with cls._poolslock:
+            cls._config.update(kwargs)
+            cls._pools = {}
+    
+    @classmethod
+    def getsetting(cls, name):
+        '''
+        Return a pool setting from configure() or the environment.
+        '''
+        if name in cls._config:
+            return cls._config[name]
+        if name == 'url':
+            return os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
+        if name == 'namespace':
+            return os.getenv('REDIS_NAMESPACE', '')
+        if name == 'replicas':
+            return [url for url in os.getenv('REDIS_REPLICA_URLS', '').split(',') if url]
+        if name == 'replicalag':
+            return float(os.getenv('REDIS_REPLICA_LAG', 1))
+        envnames = {'maxconnections':('REDIS_MAX_CONNECTIONS', 20),
+            'pooltimeout':('REDIS_POOL_TIMEOUT', 5),
+            'sockettimeout':('REDIS_SOCKET_TIMEOUT', None),
+            'connecttimeout':('REDIS_CONNECT_TIMEOUT', None)}
+        envname, default = envnames[name]
+        value = os.getenv(envname)
+        if value is None:
+            return default
+        return int(value) if name == 'maxconnections' else float(value)
+    
+    @classmethod
+    def getnamespace(cls):
+        '''
+        Return the namespace setting as a key prefix ('' or ending in ':')
+        '''
+        namespace = cls.getsetting('namespace')
+        if namespace and not namespace.endswith(':'):
+            namespace += ':'
+        if namespace and (namespace[:-1].isdigit() or 
+            any(c in namespace[:-1] for c in ':/*?[]\\')):
+            raise ValueError('invalid namespace %r' % namespace[:-1])
+        return namespace
+    @classmethod
+    def usepool(cls, name):
+        '''
+        Make DBs opened by the current thread use the pool called name, so a
+        group of threads (e.g. an executor) can have pools of its own
+        '''
+        cls._poolname.name = name
+    
+    @classmethod
+    def getpool(cls, dbnumber, url=None):
+        '''
+        Return the shared connection pool for dbnumber on url (default, the
+        primary), creating it (and forgetting any pools inherited from a 
+        parent process) if needed.
+        '''
+        pid = os.getpid()
+        url = url or cls.getsetting('url')
+        name = getattr(cls._poolname, 'name', 'default')
+        with cls._poolslock:
+            if cls._poolspid != pid:
+                cls._pools = {}
+                cls._poolspid = pid
+            pool = cls._pools.get((url, dbnumber, name))
+            if pool is None:
+                pool = redis.BlockingConnectionPool.from_url(url, 
+                    db=dbnumber,
+                    max_connections=cls.getsetting('maxconnections'),
+                    timeout=cls.getsetting('pooltimeout'),
+                    socket_timeout=cls.getsetting('sockettimeout'),
+                    socket_connect_timeout=cls.getsetting('connecttimeout'))
+                cls._pools[(url, dbnumber, name)] = pool
+            return pool
+    
+    @classmethod
+    def poolstats(cls):
+        '''
+        Return a list of dicts describing each pool in this process.
+        '''
+        with cls._poolslock:
+            pools = cls._pools.items() if cls._poolspid == os.getpid() else []
+        stats = []
+        for (url, dbnumber, name), pool in pools:
+            created = len(pool._connections)
+            idle = len([c for c in list(pool.pool.queue) if c is not None])
+            stats.append({'url':url, 
+                'db':dbnumber, 
+                'pool':name,
+                'max':pool.max_connections,
+                'created':created,
+                'idle':idle,
+                'inuse':created - idle})
+        return stats
+    
+    @classmethod
+    def beginsession(cls, position=None):
+        '''
+        Start noticing the current thread's writes. position is what 
+        endsession() returned at the end of the session's previous request:
+        until a replica has reached it, reads use the primary.
+        '''
+        cls._session.active = True
+        cls._session.position = position
+        cls._session.wrote = None
+    
+    @classmethod
+    def endsession(cls):
+        '''
+        Stop noticing writes and return the replication position the 
+        session's later reads must see (the primary's offset, if this 
+        request wrote), or None if there is none or every replica has it
+        '''
+        position = getattr(cls._session, 'position', None)
+        wrote = getattr(cls._session, 'wrote', None)
+        cls._session.active = False
+        cls._session.position = cls._session.wrote = None
+        replicas = cls.getsetting('replicas')
+        if not replicas:
+            return None
+        if wrote is not None:
+            return InstrumentedRedis(connection_pool=wrote).info('replication')\
+                ['master_repl_offset']
+        if position is not None and all(cls._replicaoffsets.get(url, -1) >= position
+                for url in replicas):
+            return None
+        return position
+    
+    @classmethod
+    def notewrite(cls, pool):
+        '''
+        Record that the current thread wrote to the primary through pool
+        '''
+        if getattr(cls._session, 'active', False):
+            cls._session.wrote = pool
+    
+    @classmethod
+    def _replicaoffset(cls, url, position):
+        '''
+        Return how far the replica at url has replicated, asking it only if
+        it wasn't already known to have reached position; -1 if it is down
+        or not replicating
+        '''
+        offset = cls._replicaoffsets.get(url, -1)
+        if offset < position:
+            try:
+                info = InstrumentedRedis(connection_pool=cls.getpool(cls.DBN, url))\
+                    .info('replication')
+            except redis.exceptions.RedisError:
+                info = {}
+            offset = info['slave_repl_offset'] if info.get('role') == 'slave' and \
+                info.get('master_link_status') == 'up' else -1
+            cls._replicaoffsets[url] = offset
+        return offset
     
     def __init__(self, dbnumber):
         self.dbnumber = dbnumber
+        self.namespace = None
+        self.generation = None
         self.r = None
+        self._replica = None
         pass
             
     def __enter__(self):
-        redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
-        self.r = redis.from_url(redis_url, self.dbnumber)
+        pool = self.getpool(self.dbnumber)
+        self.namespace = self.getnamespace()
+        Invalidator.listen(self.dbnumber)
+        generation = self._generations.get((self.dbnumber, self.namespace))
+        if generation is None:
+            generation = int(self._root(pool).get(self.KEY_GENERATION) or 0)
+            self._generations.put((self.dbnumber, self.namespace), generation)
+        self.generation = generation
+        self.r = InstrumentedRedis(connection_pool=pool, 
+            prefix=self._generationprefix(generation))
         return self
         
     def __exit__(self, type, value, traceback):
-        self.r = None
+        self.r = self._replica = None
         return
+    
+    @property
+    def ro(self):
+        '''
+        Client for reads that a replica may serve: one of the replicas, 
+        picked at random, or r if there are none, if this session has 
+        written and a replica may not have its writes yet, or within 
+        REDIS_REPLICA_LAG seconds of a cache invalidation (so caches aren't 
+        refilled with stale data). A replica that can't be reached is left
+        out for REPLICA_RETRY seconds, and the read goes to r instead.
+        '''
+        now = time.time()
+        replicas = [url for url in self.getsetting('replicas') 
+            if now - DB._replicafailures.get(url, 0) >= self.REPLICA_RETRY]
+        if not replicas or getattr(self._session, 'wrote', None) is not None or \
+            now - DB._invalidated < self.getsetting('replicalag'):
+            return self.r
+        if self._replica is None:
+            url = random.choice(replicas)
+            position = getattr(self._session, 'position', None)
+            if position is not None and self._replicaoffset(url, position) < position:
+                return self.r
+            self._replica = InstrumentedRedis(prefix=self.r.prefix,
+                connection_pool=self.getpool(self.dbnumber, url),
+                fallback=lambda: self._replicafailed(url))
+        return self._replica
+    
+    def _replicafailed(self, url):
+        '''
+        Leave the replica at url out of reads for a while, and return r for
+        this and the rest of this DB's reads
+        '''
+        DB._replicafailures[url] = time.time()
+        DB._replicaoffsets.pop(url, None)
+        self._replica = self.r
+        return self.r
+    
+    def key(self, name):
+        '''
+        Return the full name of key name, for passing key prefixes to scripts
+        '''
+        return self.r.prefix + name
+    
+    def channel(self, name):
+        '''
+        Return the full name of pub/sub channel name. Channels are only 
+        namespaced, so they carry on across resets.
+        '''
+        return self.namespace + name
                     
-    def reset(self):    
+    def reset(self, wait=False):    
+        '''
+        Clear all data from the namespace without blocking the server. The
+        namespace moves to a new, empty generation at once (other processes
+        follow as their caches are invalidated), and the keys of older 
+        generations are then deleted a batch at a time with SCAN and UNLINK.
+        Only the first batch is swept before returning, unless wait is true;
+        the rest are swept on a background thread, and getresetprogress() 
+        reports on them. Returns the new generation number.
+        '''
+        root = self._root(self.r.connection_pool)
+        generation = root.incr(self.KEY_GENERATION)
+        root.hmset(self.KEY_RESET, {'generation':generation, 'scanned':0, 
+            'deleted':0, 'started':time.time(), 'finished':''})
+        self.generation = generation
+        self.r = InstrumentedRedis(connection_pool=self.r.connection_pool,
+            prefix=self._generationprefix(generation))
+        self._replica = None
+        Invalidator.publish(self)
+        self._generations.put((self.dbnumber, self.namespace), generation)
+        cursor = self._sweep(self.dbnumber, generation, 
+            steps=None if wait else 1)
+        if cursor:
+            thread = threading.Thread(target=self._sweep, 
+                args=(self.dbnumber, generation, cursor))
+            thread.daemon = True
+            thread.start()
+        return generation
+    
+    def getresetprogress(self):
+        '''
+        Return a dict of the last reset's generation, keys scanned and 
+        deleted so far, and start and finish times (finished is None while
+        it runs); empty if there has been no reset
+        '''
+        progress = self._root(self.r.connection_pool).hgetall(self.KEY_RESET)
+        if not progress:
+            return {}
+        return {'generation':int(progress['generation']),
+            'scanned':int(progress['scanned']),
+            'deleted':int(progress['deleted']),
+            'started':float(progress['started']),
+            'finished':float(progress['finished']) if progress['finished'] else None}
+    
+    @classmethod
+    def _sweep(cls, dbnumber, generation, cursor=0, steps=None):
+        '''
+        Delete the namespace's keys outside the current generation, for up
+        to steps SCAN batches from cursor, reporting progress while 
+        generation is still the current one. Keys of named namespaces are
+        left alone when sweeping the empty one. Returns the cursor to carry
+        on from, 0 once the sweep is complete.
+        '''
+        with cls(dbnumber) as db:
+            pool = db.r.connection_pool
+            root = db._root(pool)
+            raw = InstrumentedRedis(connection_pool=pool)
+            keep = set(db.namespace + name for name in (cls.KEY_GENERATION, cls.KEY_RESET))
+            step = 0
+            while steps is None or step < steps:
+                cursor, keys = raw.scan(cursor, match=db.namespace + '*',
+                    count=cls.SWEEP_BATCH)
+                current = int(root.get(cls.KEY_GENERATION) or 0)
+                prefix = db._generationprefix(current)
+                doomed = [key for key in keys if key not in keep and 
+                    not key.startswith(prefix) and 
+                    (db.namespace or not cls._namespaced(key))]
+                if doomed:
+                    raw.execute_command('UNLINK', *doomed)
+                if current == generation:
+                    pipe = root.pipeline(transaction=False)
+                    pipe.hincrby(cls.KEY_RESET, 'scanned', len(keys))
+                    pipe.hincrby(cls.KEY_RESET, 'deleted', len(doomed))
+                    if not cursor:
+                        pipe.hset(cls.KEY_RESET, 'finished', time.time())
+                    pipe.execute()
+                if not cursor:
+                    break
+                step += 1
+            return cursor
+    
+    @staticmethod
+    def _namespaced(key):
+        '''
+        Return True if key belongs to a named namespace
         '''
-        Clear all data from the data store.
+        head, colon, rest = key.partition(':')
+        return bool(colon) and '/' not in head and not head.isdigit()
+    
+    def _root(self, pool):
         '''
-        self.r.flushdb()
+        Return a client for the namespace's own keys
+        '''
+        return InstrumentedRedis(connection_pool=pool, prefix=self.namespace)
+    
+    def _generationprefix(self, generation):
+        return self.namespace + ('%d:' % generation if generation else '')
+        
         
     def getuniqueid(self):
         '''
         Return a unique identifier 
         '''
         return str(uuid.uuid1())
+
+    def getcompactids(self, counterkey, count=1):
+        '''
+        Return a list of count short unique identifiers, base62 numbers 
+        taken from the counter at counterkey
+        '''
+        last = self.r.incrby(counterkey, count)
+        return [self.tobase62(n) for n in range(last - count + 1, last + 1)]
+    
+    @classmethod
+    def tobase62(cls, number):
+        digits = []
+        while True:
+            number, digit = divmod(number, 62)
+            digits.append(cls.BASE62[digit])
+            if not number:
+                return ''.join(reversed(digits))
+    
+    @classmethod
+    def frombase62(cls, digits):
+        '''
+        Return the number a base62 string represents; ValueError if it isn't
+        one
+        '''
+        if not digits:
+            raise ValueError(digits)
+        number = 0
+        for digit in digits:
+            number = number * 62 + cls.BASE62.index(digit)
+        return number
+        
+    def loadscripts(self):
+        '''
+        Load every registered Lua script into the server in one round trip
+        '''
+        pipe = self.r.pipeline(transaction=False)
+        for script in Script.registered:
+            pipe.script_load(script.source)
+        pipe.execute()
         
 
+class Metrics(object):
+    '''
+    Process-wide latency histograms and counters, rendered in Prometheus 
+    text format. Each gunicorn worker keeps its own numbers and renders 
+    them with a worker="<pid>" label, so a scrape behind the router sees 
+    whichever worker answered: sum by the other labels over workers 
+    (e.g. sum without (worker) (rate(...))) to get site-wide figures.
+    Numbers that must cover the whole site are kept in Redis instead (see
+    JudgeQueue.getstats and LoginThrottle.getstats).
+
+    Between beginrequest() and endrequest() every Redis command and pipeline
+    run by the current thread is also recorded, so a request can report 
+    what it cost.
+    '''
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 
+        0.5, 1, 2.5, 5, 10)
+    
+    _histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+    _counters = {}      # (name, labels) -> value
+    _lock = threading.Lock()
+    _local = threading.local()
+    
+    @classmethod
+    def observe(cls, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            histogram = cls._histograms.get(key)
+            if histogram is None:
+                histogram = cls._histograms[key] = [0] * (len(cls.BUCKETS) + 2)
+            for i, bound in enumerate(cls.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            
+    @classmethod
+    def increment(cls, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with cls._lock:
+            cls._counters[key] = cls._counters.get(key, 0) + amount
+    
+    @classmethod
+    def command(cls, command, seconds):
+        '''
+        Record one round trip to Redis
+        '''
+        cls.observe('hscpc_redis_command_seconds', seconds, command=command)
+        commands = getattr(cls._local, 'commands', None)
+        if commands is not None:
+            commands.append((command, seconds))
+    
+    @classmethod
+    def beginrequest(cls):
+        cls._local.commands = []
+        
+    @classmethod
+    def endrequest(cls, route, seconds):
+        '''
+        Record a finished request and return the list of (command, seconds)
+        it ran
+        '''
+        commands = getattr(cls._local, 'commands', None) or []
+        cls._local.commands = None
+        cls.observe('hscpc_request_seconds', seconds, route=route)
+        cls.increment('hscpc_request_redis_commands_total', len(commands), route=route)
+        cls.increment('hscpc_request_redis_seconds_total', 
+            sum(seconds for command, seconds in commands), route=route)
+        return commands
+    
+    @classmethod
+    def bucket(cls, seconds):
+        '''
+        Return the upper bound of the smallest bucket seconds falls in, as
+        rendered in its le label
+        '''
+        for bound in cls.BUCKETS:
+            if seconds <= bound:
+                return str(bound)
+        return '+Inf'
+    
+    @staticmethod
+    def labeltext(labels, **extra):
+        labels = list(labels) + sorted(extra.items())
+        return '{%s}' % ','.join('%s="%s"' % (name, value) 
+            for name, value in labels) if labels else ''
+    
+    @classmethod
+    def histogramlines(cls, name, histogram, labels=()):
+        '''
+        Return the Prometheus lines of histogram ([cumulative bucket 
+        counts..., sum, count])
+        '''
+        lines = ['%s_bucket%s %s' % (name, cls.labeltext(labels, le=bound), count)
+            for bound, count in zip(cls.BUCKETS + ('+Inf',), histogram[:-2] + [histogram[-1]])]
+        lines.append('%s_sum%s %s' % (name, cls.labeltext(labels), histogram[-2]))
+        lines.append('%s_count%s %s' % (name, cls.labeltext(labels), histogram[-1]))
+        return lines
+    
+    @classmethod
+    def render(cls):
+        '''
+        Return every metric, plus connection pool gauges, as Prometheus text
+        labelled with this process's worker pid
+        '''
+        worker = ('worker', os.getpid())
+        lines = []
+        with cls._lock:
+            histograms = sorted(cls._histograms.items())
+            counters = sorted(cls._counters.items())
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            lines.extend(cls.histogramlines(name, histogram, sorted(labels + (worker,))))
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE %s counter' % name)
+                typed.add(name)
+            lines.append('%s%s %s' % (name, cls.labeltext(sorted(labels + (worker,))), 
+                value))
+        lines.append('# TYPE hscpc_redis_pool_connections gauge')
+        for pool in DB.poolstats():
+            for state in ('max', 'created', 'idle', 'inuse'):
+                lines.append('hscpc_redis_pool_connections{db="%s",pool="%s",state="%s",'
+                    'worker="%s"} %s' % (pool['db'], pool['pool'], state, worker[1], 
+                    pool[state]))
+        return '\n'.join(lines) + '\n'
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    '''
+    Pipeline that prefixes keys like the client it came from, reports each 
+    execute to Metrics as one round trip, and runs callbacks added with 
+    afterexecute once it has succeeded
+    '''
+    prefix = ''
+    fallback = None
+    
+    def afterexecute(self, callback):
+        self.__dict__.setdefault('_callbacks', []).append(callback)
+    
+    def execute_command(self, *args, **kwargs):
+        return super(InstrumentedPipeline, self).execute_command(
+            *InstrumentedRedis.addprefix(self.prefix, args), **kwargs)
+    
+    def execute(self, raise_on_error=True):
+        command = 'MULTI' if self.transaction else 'PIPELINE'
+        callbacks = self.__dict__.pop('_callbacks', [])
+        if any(InstrumentedRedis.commandname(args) not in InstrumentedRedis.READS 
+                for args, options in self.command_stack):
+            DB.notewrite(self.connection_pool)
+        stack = list(self.command_stack)
+        start = time.time()
+        try:
+            results = super(InstrumentedPipeline, self).execute(raise_on_error)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            if self.fallback is None:
+                raise
+            pipe = self.fallback().pipeline(self.transaction)
+            pipe.command_stack = stack  # already prefixed
+            results = pipe.execute(raise_on_error)
+        finally:
+            Metrics.command(command, time.time() - start)
+        for callback in callbacks:
+            callback()
+        return results
+
+
+class InstrumentedRedis(redis.Redis):
+    '''
+    Redis client that reports every command and pipeline to Metrics. With a
+    prefix, it is put in front of every key sent (found from KEYARGS) and
+    taken off the keys SCAN and BRPOP return. A command that isn't in 
+    KEYARGS or KEYLESS is refused rather than sent unprefixed. With a 
+    fallback, a command or pipeline that can't reach the server is sent 
+    again to the client that fallback() returns.
+    '''
+    # command -> positions of its key arguments (EVAL, EVALSHA and SCAN are
+    # handled in addprefix)
+    KEYARGS = dict([(command, (1,)) for command in (
+        'GET SET SETEX PSETEX SETNX GETSET APPEND STRLEN INCR INCRBY '
+        'INCRBYFLOAT DECR DECRBY EXPIRE EXPIREAT PEXPIRE PEXPIREAT TTL PTTL '
+        'PERSIST TYPE HGET HSET HSETNX HMSET HMGET HGETALL HDEL HEXISTS '
+        'HINCRBY HINCRBYFLOAT HKEYS HVALS HLEN HSCAN SADD SREM SISMEMBER SCARD '
+        'SMEMBERS SPOP SRANDMEMBER SSCAN ZADD ZREM ZINCRBY ZSCORE ZRANK '
+        'ZREVRANK ZCARD ZCOUNT ZLEXCOUNT ZRANGE ZREVRANGE ZRANGEBYSCORE '
+        'ZREVRANGEBYSCORE ZRANGEBYLEX ZREVRANGEBYLEX ZREMRANGEBYRANK '
+        'ZREMRANGEBYSCORE ZREMRANGEBYLEX ZSCAN LPUSH RPUSH LPUSHX RPUSHX LPOP '
+        'RPOP LLEN LRANGE LINDEX LSET LINSERT LTRIM LREM').split()] +
+        [(command, slice(1, None)) for command in 
+            'DEL UNLINK EXISTS MGET WATCH SUNION SINTER SDIFF'.split()] +
+        [(command, (1, 2)) for command in 
+            'RENAME RENAMENX RPOPLPUSH BRPOPLPUSH SMOVE'.split()] +
+        [(command, slice(1, -1)) for command in 'BLPOP BRPOP'.split()] +
+        [(command, (2,)) for command in 'OBJECT MEMORY'.split()])
+    KEYLESS = set('PUBLISH SCRIPT PING ECHO INFO CONFIG TIME DBSIZE FLUSHDB '
+        'SELECT CLIENT MULTI EXEC DISCARD UNWATCH'.split())
+    # commands that don't change data; any other is noted as a write
+    READS = set('GET STRLEN TTL PTTL TYPE EXISTS MGET HGET HMGET HGETALL '
+        'HEXISTS HKEYS HVALS HLEN HSCAN SISMEMBER SCARD SMEMBERS SRANDMEMBER '
+        'SSCAN SUNION SINTER SDIFF ZSCORE ZRANK ZREVRANK ZCARD ZCOUNT ZLEXCOUNT '
+        'ZRANGE ZREVRANGE ZRANGEBYSCORE ZREVRANGEBYSCORE ZRANGEBYLEX '
+        'ZREVRANGEBYLEX ZSCAN LLEN LRANGE LINDEX SCAN OBJECT MEMORY PUBLISH '
+        'SCRIPT PING ECHO INFO CONFIG TIME DBSIZE SELECT CLIENT WATCH MULTI '
+        'EXEC DISCARD UNWATCH'.split())
+    
+    def __init__(self, *args, **kwargs):
+        self.prefix = kwargs.pop('prefix', '')
+        self.fallback = kwargs.pop('fallback', None)
+        super(InstrumentedRedis, self).__init__(*args, **kwargs)
+        if self.prefix:
+            scan = self.response_callbacks['SCAN']
+            pop = self.response_callbacks['BRPOP']
+            self.set_response_callback('SCAN', lambda response, **options:
+                self._unprefixscan(scan(response, **options)))
+            for command in ('BLPOP', 'BRPOP'):
+                self.set_response_callback(command, lambda response, **options:
+                    self._unprefixpop(pop(response, **options)))
+    
+    @classmethod
+    def addprefix(cls, prefix, args):
+        '''
+        Return the command args with prefix put in front of each key
+        '''
+        if not prefix:
+            return args
+        command = cls.commandname(args)
+        args = list(args)
+        if command in ('EVAL', 'EVALSHA'):
+            positions = range(3, 3 + int(args[2]))
+        elif command == 'SCAN':
+            words = [str(arg).upper() for arg in args]
+            if 'MATCH' in words:
+                positions = (words.index('MATCH') + 1,)
+            else:
+                positions = ()
+                args += ['MATCH', prefix + '*']
+        elif command in cls.KEYLESS:
+            positions = ()
+        elif command in cls.KEYARGS:
+            positions = cls.KEYARGS[command]
+            if isinstance(positions, slice):
+                positions = range(len(args))[positions]
+        else:
+            raise redis.exceptions.DataError(
+                'key positions of %s are unknown; add it to KEYARGS' % command)
+        for i in positions:
+            args[i] = prefix + args[i]
+        return args
+    
+    @staticmethod
+    def commandname(args):
+        return str(args[0]).split(' ')[0].upper()
+    
+    def _unprefixscan(self, response):
+        cursor, keys = response
+        return cursor, [key[len(self.prefix):] for key in keys]
+    
+    def _unprefixpop(self, response):
+        return response and (response[0][len(self.prefix):], response[1])
+    
+    def execute_command(self, *args, **options):
+        command = self.commandname(args)
+        if command not in self.READS:
+            DB.notewrite(self.connection_pool)
+        start = time.time()
+        try:
+            return super(InstrumentedRedis, self).execute_command(
+                *self.addprefix(self.prefix, args), **options)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            if self.fallback is None:
+                raise
+            return self.fallback().execute_command(*args, **options)
+        finally:
+            Metrics.command(command, time.time() - start)
+            
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+            transaction, shard_hint)
+        pipe.prefix = self.prefix
+        pipe.fallback = self.fallback
+        return pipe
+
+
+class LocalCache(object):
+    '''
+    Process-local, thread-safe LRU cache whose entries expire after ttl
+    seconds. Keys should include the db number, since caches are shared by
+    every DB in the process.
+    
+    To fill the cache from a read that an invalidation may overtake, take
+    stamp() before the read and pass it to put(), which then does nothing
+    if anything was invalidated in between.
+    '''
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return default
+            self._entries[key] = entry  # most recently used goes last
+            return entry[1]
+            
+    def stamp(self):
+        with self._lock:
+            return self._invalidations
+        
+    def put(self, key, value, stamp=None):
+        with self._lock:
+            if stamp is not None and stamp != self._invalidations:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._invalidations += 1
+            
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._invalidations += 1
+            
+
+class Invalidator(object):
+    '''
+    Keeps LocalCaches coherent across processes. Each process runs one 
+    listener thread per db number, subscribed to invalidate/<dbnumber>. 
+    Writers publish "<cachename> <key>" to drop one entry everywhere, or 
+    "<cachename>" (or nothing) to clear a whole cache (or all of them).
+    If the subscription drops, every cache is cleared before resubscribing,
+    since invalidations may have been missed.
+    
+    A process invalidates its own caches as it publishes (and again once
+    a pipeline carrying the message has run), so messages are prefixed 
+    with "@<origin>" and the listener skips its own; otherwise they would
+    arrive late and needlessly drop entries cached in the meantime.
+    '''
+    CHANNEL = 'invalidate/'     # append db number
+    
+    caches = {}     # cache name -> list of LocalCache
+    _listeners = {}
+    _listenerspid = None
+    _origin = None
+    _lock = threading.Lock()
+    
+    @classmethod
+    def register(cls, name, cache):
+        cls.caches.setdefault(name, []).append(cache)
+        return cache
+    
+    @classmethod
+    def listen(cls, dbnumber):
+        '''
+        Start this process's listener for dbnumber if it isn't running
+        '''
+        if cls._listenerspid == os.getpid() and dbnumber in cls._listeners:
+            return
+        with cls._lock:
+            if cls._listenerspid != os.getpid():
+                cls._listeners = {}
+                cls._listenerspid = os.getpid()
+                cls._origin = uuid.uuid4().hex
+            if dbnumber not in cls._listeners:
+                ready = threading.Event()
+                thread = threading.Thread(target=cls._listen, 
+                    args=(dbnumber, ready))
+                thread.daemon = True
+                cls._listeners[dbnumber] = thread  # before its own DB() calls listen
+                thread.start()
+                ready.wait(1)
+    
+    @classmethod
+    def publish(cls, db, name=None, key=None, pipe=None):
+        '''
+        Drop a cache entry (or cache, or all caches) here and in every other
+        process using db. With pipe, the message is queued on it, so other
+        processes only see it once the pipeline's writes have been made.
+        '''
+        message = ' '.join(str(part) for part in (name, key) if part is not None)
+        cls._invalidate(db.dbnumber, message)
+        if pipe is not None:
+            pipe.afterexecute(lambda: cls._invalidate(db.dbnumber, message))
+        if cls._listenerspid == os.getpid():
+            message = '@%s %s' % (cls._origin, message)
+        (pipe or db.r).publish(db.channel(cls.CHANNEL + str(db.dbnumber)), message)
+    
+    @classmethod
+    def publishmany(cls, db, entries):
+        '''
+        Publish a (name, key) pair for each entry in one round trip
+        '''
+        pipe = db.r.pipeline(transaction=False)
+        for name, key in entries:
+            cls.publish(db, name, key, pipe)
+        pipe.execute()
+    
+    @classmethod
+    def _invalidate(cls, dbnumber, message):
+        DB._invalidated = time.time()
+        parts = message.split(' ', 1)
+        names = [parts[0]] if parts[0] in cls.caches else cls.caches.keys()
+        for cache in [cache for name in names for cache in cls.caches[name]]:
+            if len(parts) == 2:
+                cache.pop((dbnumber, parts[1]))
+            else:
+                cache.clear()
+    
+    @classmethod
+    def _listen(cls, dbnumber, ready):
+        while True:
+            try:
+                with DB(dbnumber) as db:
+                    pubsub = db.r.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(db.channel(cls.CHANNEL + str(dbnumber)))
+                    ready.set()
+                    for message in pubsub.listen():
+                        data = message['data']
+                        if data.startswith('@'):
+                            origin, data = (data[1:].split(' ', 1) + [''])[:2]
+                            if origin == cls._origin:
+                                continue
+                        cls._invalidate(dbnumber, data)
+            except redis.exceptions.RedisError:
+                pass
+            cls._invalidate(dbnumber, '')
+            time.sleep(1)
+
+
+DB._generations = Invalidator.register(DB.CACHE_GENERATIONS, LocalCache(ttl=10))
+
+
+class Script(object):
+    '''
+    A server-side Lua script, registered when its class is defined and run 
+    with EVALSHA. The source is only sent to the server when it answers 
+    NOSCRIPT (first use, or after a restart), so a call costs one round trip.
+    '''
+    registered = []
+    
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        Script.registered.append(self)
+        
+    def __call__(self, db, keys=[], args=[]):
+        keysandargs = list(keys) + list(args)
+        try:
+            return db.r.evalsha(self.sha, len(keys), *keysandargs)
+        except redis.exceptions.NoScriptError:
+            db.r.script_load(self.source)
+            return db.r.evalsha(self.sha, len(keys), *keysandargs)
+
 
 
 class TestSequenceFunctions(unittest.TestCase):
@@ -50,6 +927,7 @@ class TestSequenceFunctions(unittest.TestCase):
         pass
     
     def tearDown(self):
+        DB.SWEEP_BATCH = 500
         with DB(DB.DBNTEST) as db:
             db.reset()
 
@@ -66,12 +944,227 @@ class TestSequenceFunctions(unittest.TestCase):
             result = db.r.get('test')
             self.assertIs(None, result)
             
+    def test_backgroundreset(self):
+        DB.SWEEP_BATCH = 2
+        with DB(DB.DBNTEST) as db:
+            pipe = db.r.pipeline(transaction=False)
+            for i in range(50):
+                pipe.set('old/%d' % i, i)
+            pipe.execute()
+            generation = db.reset()
+            db.r.set('new', 'value')
+            for i in range(100):
+                progress = db.getresetprogress()
+                if progress['finished']:
+                    break
+                time.sleep(0.01)
+            self.assertEqual((progress['generation'], progress['deleted']), 
+                (generation, 50))
+            self.assertEqual(list(db.r.scan_iter()), ['new'])
+            
+    def test_namespace(self):
+        with DB(DB.DBNTEST) as db:
+            db.r.set('test', 'mine')
+        namespace = DB.getsetting('namespace')
+        DB.configure(namespace='test-other')
+        try:
+            with DB(DB.DBNTEST) as db:
+                pipe = db.r.pipeline()
+                pipe.set('test', 'theirs')
+                pipe.rpush('list', 'value')
+                pipe.execute()
+                self.assertEqual(list(db.r.scan_iter(match='t*')), ['test'])
+                raw = redis.Redis(connection_pool=db.r.connection_pool)
+                self.assertTrue(db.key('test').startswith('test-other:'))
+                self.assertEqual(raw.get(db.key('test')), 'theirs')
+                db.reset(wait=True)
+                self.assertIs(db.r.get('test'), None)
+                self.assertEqual(db.getresetprogress()['deleted'], 2)
+                self.assertRaises(redis.exceptions.DataError, 
+                    db.r.execute_command, 'SORT', 'list')
+                db.r.set('test', 'theirs')
+        finally:
+            DB.configure(namespace=namespace)
+        with DB(DB.DBNTEST) as db:
+            self.assertEqual(db.r.get('test'), 'mine')
+            if not db.namespace:
+                db.reset(wait=True)     # must leave test-other alone
+            other = [key for key in raw.scan_iter(match='test-other:*')]
+            self.assertTrue('test-other:1:test' in other)
+            raw.delete(*other)
+        DB.configure(namespace='1')
+        try:
+            self.assertRaises(ValueError, DB(DB.DBNTEST).__enter__)
+            self.assertRaises(ValueError, DB.getnamespace)
+        finally:
+            DB.configure(namespace=namespace)
+            
+    def test_resetelsewhere(self):
+        with DB(DB.DBNTEST) as db:
+            db.r.set('test', 'old')
+            # another process resets the namespace
+            root = db._root(db.r.connection_pool)
+            root.incr(DB.KEY_GENERATION)
+            root.publish(db.channel(Invalidator.CHANNEL + str(DB.DBNTEST)), 
+                DB.CACHE_GENERATIONS)
+        for i in range(100):
+            with DB(DB.DBNTEST) as db:
+                value = db.r.get('test')
+            if value is None:
+                break
+            time.sleep(0.01)
+        self.assertIs(value, None)
+            
+    def test_replicas(self):
+        port = DB.getpool(DB.DBNTEST).connection_kwargs['port']
+        replicaurl = 'redis://localhost:%d' % (port + 11)
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen(['redis-server', '--port', str(port + 11),
+                '--slaveof', 'localhost', str(port), '--save', '', 
+                '--appendonly', 'no'], stdout=devnull)
+        replicas, lag = DB.getsetting('replicas'), DB.getsetting('replicalag')
+        DB.configure(replicas=[replicaurl], replicalag=0)
+        try:
+            replica = redis.Redis.from_url(replicaurl, db=DB.DBNTEST)
+            with DB(DB.DBNTEST) as db:
+                db.r.set('test', 'old')
+                for i in range(500):
+                    try:
+                        if replica.get(db.key('test')) == 'old':
+                            break
+                    except redis.exceptions.ConnectionError:
+                        pass
+                    time.sleep(0.01)
+                replica.slaveof()   # stop replicating: the replica lags
+                db.r.set('test', 'new')
+                self.assertEqual(db.ro.get('test'), 'old')
+            DB.beginsession()
+            with DB(DB.DBNTEST) as db:
+                db.r.set('test', 'newer')
+                self.assertEqual(db.ro.get('test'), 'newer')
+            position = DB.endsession()
+            DB.beginsession(position)
+            with DB(DB.DBNTEST) as db:
+                self.assertEqual(db.ro.get('test'), 'newer')
+            self.assertEqual(DB.endsession(), position)
+            with DB(DB.DBNTEST) as db:
+                self.assertEqual(db.ro.get('test'), 'old')
+        finally:
+            DB.configure(replicas=replicas, replicalag=lag)
+            server.terminate()
+            server.wait()
+            
+    def test_replicadown(self):
+        port = DB.getpool(DB.DBNTEST).connection_kwargs['port']
+        replicaurl = 'redis://localhost:%d' % (port + 12)     # nothing listening
+        replicas, lag = DB.getsetting('replicas'), DB.getsetting('replicalag')
+        DB.configure(replicas=[replicaurl], replicalag=0)
+        try:
+            with DB(DB.DBNTEST) as db:
+                db.r.set('test', 'value')
+                pipe = db.ro.pipeline()
+                pipe.get('test')
+                self.assertEqual(pipe.execute(), ['value'])
+                self.assertTrue(db.ro is db.r)
+            with DB(DB.DBNTEST) as db:
+                self.assertTrue(db.ro is db.r)
+            DB._replicafailures[replicaurl] -= DB.REPLICA_RETRY
+            with DB(DB.DBNTEST) as db:
+                self.assertFalse(db.ro is db.r)
+                self.assertEqual(db.ro.get('test'), 'value')
+                self.assertTrue(db.ro is db.r)
+        finally:
+            DB.configure(replicas=replicas, replicalag=lag)
+            DB._replicafailures.pop(replicaurl, None)
+            
     def test_uniqueid(self):
         with DB(DB.DBNTEST) as db:
             u1 = db.getuniqueid()
             u2 = db.getuniqueid()
             self.assertNotEqual(u1, u2)
             
+    def test_compactids(self):
+        with DB(DB.DBNTEST) as db:
+            ids = db.getcompactids('test/counter', 70)
+            self.assertEqual(ids[:2] + ids[59:62], ['1', '2', 'y', 'z', '10'])
+            self.assertEqual(db.getcompactids('test/counter'), ['19'])
+            self.assertEqual(DB.frombase62(DB.tobase62(123456789)), 123456789)
+            self.assertRaises(ValueError, DB.frombase62, 'not-base62')
+            
+    def test_metrics(self):
+        Metrics.beginrequest()
+        with DB(DB.DBNTEST) as db:
+            db.r.set('test', 'value')
+            pipe = db.r.pipeline()
+            pipe.get('test')
+            pipe.get('test')
+            pipe.execute()
+        commands = Metrics.endrequest('test', 0.01)
+        self.assertEqual([command for command, seconds in commands], ['SET', 'MULTI'])
+        text = Metrics.render()
+        self.assertTrue('hscpc_request_seconds_bucket{route="test",worker="%d",le="0.01"}' % 
+            os.getpid() in text)
+        self.assertTrue('hscpc_redis_command_seconds_count{command="SET",worker="%d"}' % 
+            os.getpid() in text)
+        self.assertTrue('hscpc_redis_pool_connections{db="1",pool="default",state="max",'
+            'worker="%d"}' % os.getpid() in text)
+        
+    def test_localcache(self):
+        cache = LocalCache(maxsize=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), None)
+        cache.ttl = -1
+        cache.put('d', 4)
+        self.assertIs(cache.get('d'), None)
+        cache.ttl = 60
+        stamp = cache.stamp()
+        cache.pop('a')      # an invalidation overtaking the read
+        cache.put('e', 5, stamp)
+        self.assertIs(cache.get('e'), None)
+        cache.put('e', 5, cache.stamp())
+        self.assertEqual(cache.get('e'), 5)
+
+    def test_invalidator(self):
+        cache = Invalidator.register('test', LocalCache())
+        cache.put((DB.DBNTEST, 'k'), 'v')
+        Invalidator.listen(DB.DBNTEST)
+        with DB(DB.DBNTEST) as db:
+            db.r.publish(db.channel(Invalidator.CHANNEL + str(DB.DBNTEST)), 'test k')
+        for i in range(100):
+            if cache.get((DB.DBNTEST, 'k')) is None:
+                break
+            time.sleep(0.01)
+        self.assertIs(cache.get((DB.DBNTEST, 'k')), None)
+        Invalidator.caches['test'].remove(cache)
+        
+    def test_script(self):
+        script = Script("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+        Script.registered.remove(script)
+        with DB(DB.DBNTEST) as db:
+            db.r.script_flush()
+            self.assertEqual(script(db, ['test'], [2]), 2)
+            self.assertEqual(script(db, ['test'], [3]), 5)
+            
+    def test_sharedpool(self):
+        with DB(DB.DBNTEST) as db:
+            db.r.ping()
+            pool = db.r.connection_pool
+        with DB(DB.DBNTEST) as db:
+            self.assertIs(pool, db.r.connection_pool)
+        stats = [p for p in DB.poolstats() if p['db'] == DB.DBNTEST]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['inuse'], 0)
+        self.assertTrue(stats[0]['created'] >= 1)
+            
+    def test_poolafterfork(self):
+        pool = DB.getpool(DB.DBNTEST)
+        DB._poolspid = -1   # as seen from a freshly forked child
+        self.assertIsNot(pool, DB.getpool(DB.DBNTEST))
+            
             
 if __name__ == '__main__':
     unittest.main()
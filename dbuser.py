@@ -1,7 +1,12 @@
+import base64
+import itertools
+import os
 import redis
+import time
 import unittest
-from dbtools import DB
-from werkzeug.security import generate_password_hash, check_password_hash
+from collections import OrderedDict
+from dbtools import DB, InstrumentedRedis, Invalidator, LocalCache, Metrics, Script
+from hashpool import HashPool
 
 class User(object):
     '''
@@ -13,20 +18,74 @@ class User(object):
         realname-><string>, 
         passwordhash-><string>
         level-><integer>        1 = root, 2 = admin, 3 = coach, 4 = contestant, 5 = visitor
+        credversion-><integer>  bumped when password or level change, so 
+                                sessions holding an older value are revoked
+    
+    That is the 'keys' layout. In the optional 'buckets' layout uids are
+    short base62 numbers from site/lastuid, and each run of BUCKETUSERS
+    users shares one hash, ub/<uid number // BUCKETUSERS>, with fields 
+    named <uid>:<field>, so small hashes stay in Redis's compact encoding
+    and the per-key overhead is shared. A db's layout is recorded in 
+    site/userlayout and changed with migratelayout, which refuses to move
+    to buckets while the server's hash-max-ziplist settings are too low 
+    to keep them compact.
+    
+    Users are compact __slots__ objects. Loads fetch only the requested 
+    fields (DEFAULT_FIELDS unless fields= is given) with HMGET; any other
+    field, such as passwordhash, is fetched from the store on first access.
+    
+    An optional near cache (off unless USER_CACHE_SIZE is set, or enabled
+    with User.configurecache) keeps username/email->uid lookups and the
+    fetched fields of user hashes in process memory. Every write publishes
+    an invalidation, so other workers drop their copies; entries also
+    expire after USER_CACHE_TTL seconds.
         
     '''
+    __slots__ = ('isvalid', 'dbnumber', 'userid', 'key', 'fieldprefix', 'username',
+        'email', 'realname', 'passwordhash', 'level', 'credversion', '_dirty')
+    
     KEY_USER_UID = 'u/' # append uid
+    KEY_USER_BUCKET = 'ub/' # append base62 bucket number
     HKEY_USERNAME = 'u'
     HKEY_EMAIL = 'e'
     HKEY_REALNAME = 'r'
     HKEY_PASSWORDHASH = 'p'
     HKEY_LEVEL = 'l'
+    HKEY_CREDVERSION = 'v'
+    HKEY_FIELDS = {HKEY_USERNAME:'username', 
+        HKEY_EMAIL:'email', 
+        HKEY_REALNAME:'realname', 
+        HKEY_PASSWORDHASH:'passwordhash', 
+        HKEY_LEVEL:'level'}
+    FIELD_HKEYS = {'username':HKEY_USERNAME,
+        'email':HKEY_EMAIL,
+        'realname':HKEY_REALNAME,
+        'passwordhash':HKEY_PASSWORDHASH,
+        'level':HKEY_LEVEL,
+        'credversion':HKEY_CREDVERSION}
+    ALL_FIELDS = ('username', 'email', 'realname', 'passwordhash', 'level', 'credversion')
+    DEFAULT_FIELDS = ('username', 'email', 'realname', 'level', 'credversion')
+    LIST_FIELDS = ('username', 'realname', 'level')
+    KEY_SITE_ALLUIDS = 'site/alluids'   # set of every uid
+    KEY_SITE_ROOTUIDS = 'site/rootuids'
     KEY_SITE_ADMINUIDS = 'site/adminuids'
     KEY_SITE_COACHUIDS = 'site/coachuids'
     KEY_SITE_CONTESTANTUIDS = 'site/contestantuids'
+    KEY_SITE_VISITORUIDS = 'site/visitoruids'
+    KEY_SITE_PENDINGUIDS = 'site/pendinguids'
     KEY_SITE_USERNAMES = 'site/usernames'  # hash of username->uid
     KEY_SITE_EMAILS = 'site/emails'     # hash of email->uid
     KEY_SITE_CONTESTS = 'site/contests'
+    KEY_SITE_USERLAYOUT = 'site/userlayout'
+    KEY_SITE_LASTUID = 'site/lastuid'   # counter for compact uids
+    KEY_SITE_UIDMAP = 'site/uidmap'     # hash of old->new uid during migration
+    KEY_SITE_USERNAMEINDEX = 'site/usernameindex'   # sorted set, see NAME_INDEXES
+    KEY_SITE_REALNAMEINDEX = 'site/realnameindex'
+    
+    LAYOUT_KEYS = 'keys'
+    LAYOUT_BUCKETS = 'buckets'
+    BUCKETUSERS = 64    # users per bucket hash; keep fields under hash-max-ziplist-entries
+    BUCKETVALUE = 128   # hash-max-ziplist-value buckets need: password hashes are ~66 bytes
     
     LEVEL_ANY = 0
     LEVEL_ROOT = 1
@@ -41,113 +100,721 @@ class User(object):
         LEVEL_CONTESTANT:'Contestant',
         LEVEL_VISITOR:'Visitor',
         LEVEL_PENDING:'Pending'}
+    # Names in lexicographic order, as members "<name, ASCII lowercased>\0<uid>"
+    # of sorted sets with every score 0, so ZRANGEBYLEX finds a prefix
+    NAME_INDEXES = OrderedDict([('username', KEY_SITE_USERNAMEINDEX),
+        ('realname', KEY_SITE_REALNAMEINDEX)])
+    PAGESIZE = 50
+    
+    LEVEL_KEYS = {LEVEL_ANY:KEY_SITE_ALLUIDS,
+        LEVEL_ROOT:KEY_SITE_ROOTUIDS,
+        LEVEL_ADMIN:KEY_SITE_ADMINUIDS,
+        LEVEL_COACH:KEY_SITE_COACHUIDS,
+        LEVEL_CONTESTANT:KEY_SITE_CONTESTANTUIDS,
+        LEVEL_VISITOR:KEY_SITE_VISITORUIDS,
+        LEVEL_PENDING:KEY_SITE_PENDINGUIDS}
+
+    # Claim, rename or release (empty value) unique names for a uid, set the
+    # remaining fields, optionally increment one, and move the uid within 
+    # the name indexes of fields that changed. Returns 1/0 for each claim,
+    # followed by the incremented value if any.
+    # KEYS: user hash, one lookup hash per claim, one name index per field
+    # ARGV: uid, number of claims, field to increment or '', number of name
+    #       indexes, (field, value) per claim, field per name index, 
+    #       (field, value)...
+    SCRIPT_CLAIM = Script('''
+        local uid, nclaims, incrfield = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+        local nindexes, indexed = tonumber(ARGV[4]), 2*tonumber(ARGV[2]) + 5
+        local before = {}
+        for j = 1, nindexes do
+            before[j] = redis.call('HGET', KEYS[1], ARGV[indexed+j-1]) or ''
+        end
+        local results = {}
+        for i = 1, nclaims do
+            local lookup, field, value = KEYS[i+1], ARGV[2*i+3], ARGV[2*i+4]
+            local owner = redis.call('HGET', lookup, value)
+            if value ~= '' and owner and owner ~= uid then
+                results[i] = 0
+            else
+                local old = redis.call('HGET', KEYS[1], field)
+                if old and old ~= value and redis.call('HGET', lookup, old) == uid then
+                    redis.call('HDEL', lookup, old)
+                end
+                if value ~= '' then
+                    redis.call('HSET', lookup, value, uid)
+                end
+                redis.call('HSET', KEYS[1], field, value)
+                results[i] = 1
+            end
+        end
+        for i = indexed + nindexes, #ARGV, 2 do
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i+1])
+        end
+        for j = 1, nindexes do
+            local index = KEYS[nclaims+j+1]
+            local after = redis.call('HGET', KEYS[1], ARGV[indexed+j-1]) or ''
+            if after ~= before[j] then
+                if before[j] ~= '' then
+                    redis.call('ZREM', index, string.lower(before[j]) .. '\\0' .. uid)
+                end
+                if after ~= '' then
+                    redis.call('ZADD', index, 0, string.lower(after) .. '\\0' .. uid)
+                end
+            end
+        end
+        if incrfield ~= '' then
+            results[nclaims+1] = redis.call('HINCRBY', KEYS[1], incrfield, 1)
+        end
+        return results
+        ''')
+    
+    # Delete a user hash, its username and email claims and index entries.
+    # KEYS: user hash, usernames hash, emails hash, username index, realname
+    #       index, index sets...
+    # ARGV: uid, username field, email field, realname field, and if the 
+    #       user shares its hash, every field to delete from it
+    # Returns the removed {username, email}, '' where there was none.
+    SCRIPT_REMOVE = Script('''
+        local removed = {'', ''}
+        for i = 2, 3 do
+            local value = redis.call('HGET', KEYS[1], ARGV[i])
+            if value then
+                removed[i-1] = value
+                if redis.call('HGET', KEYS[i], value) == ARGV[1] then
+                    redis.call('HDEL', KEYS[i], value)
+                end
+            end
+        end
+        for i, field in ipairs({ARGV[2], ARGV[4]}) do
+            local name = redis.call('HGET', KEYS[1], field)
+            if name and name ~= '' then
+                redis.call('ZREM', KEYS[i+3], string.lower(name) .. '\\0' .. ARGV[1])
+            end
+        end
+        for i = 6, #KEYS do
+            redis.call('SREM', KEYS[i], ARGV[1])
+        end
+        if #ARGV > 4 then
+            redis.call('HDEL', KEYS[1], unpack(ARGV, 5))
+        else
+            redis.call('DEL', KEYS[1])
+        end
+        return removed
+        ''')
+    
+    BATCHSIZE = 500    # keys per SCAN cursor step and per pipelined fetch
+    
+    CACHE_CREDVERSIONS = 'credversion'
+    CACHE_USERNAMES = 'usernames'   # keyed by username
+    CACHE_EMAILS = 'emails'         # keyed by email
+    CACHE_USERS = 'users'           # keyed by uid
+    CACHE_LAYOUT = 'userlayout'
+    _credversions = Invalidator.register(CACHE_CREDVERSIONS, 
+        LocalCache(maxsize=10000, ttl=30))
+    _usernames = Invalidator.register(CACHE_USERNAMES, 
+        LocalCache(maxsize=int(os.getenv('USER_CACHE_SIZE', 0)), 
+            ttl=int(os.getenv('USER_CACHE_TTL', 60))))
+    _emails = Invalidator.register(CACHE_EMAILS, 
+        LocalCache(maxsize=_usernames.maxsize, ttl=_usernames.ttl))
+    _records = Invalidator.register(CACHE_USERS, 
+        LocalCache(maxsize=_usernames.maxsize, ttl=_usernames.ttl))
+    _layouts = Invalidator.register(CACHE_LAYOUT, LocalCache(maxsize=16, ttl=60))
+
+    @classmethod
+    def configurecache(cls, maxsize, ttl=60):
+        '''
+        Set the size (entries per cache, 0 to disable) and ttl of the near
+        cache, dropping whatever it holds
+        '''
+        for cache in (cls._usernames, cls._emails, cls._records):
+            cache.maxsize = maxsize
+            cache.ttl = ttl
+            cache.clear()
+
+    @classmethod
+    def getcredversions(cls, dbnumber, userids):
+        '''
+        Return a dict of userid->credential version (None for users that no
+        longer exist). Versions are cached per process and invalidated when 
+        they change; any that aren't cached are fetched in one pipeline.
+        '''
+        versions = {}
+        missing = []
+        for userid in userids:
+            version = cls._credversions.get((dbnumber, userid))
+            if version is None:
+                missing.append(userid)
+            else:
+                versions[userid] = version
+        if missing:
+            with DB(dbnumber) as db:
+                Invalidator.listen(dbnumber)
+                stamp = cls._credversions.stamp()
+                layout = cls._getlayout(db)
+                pipe = db.r.pipeline(transaction=False)
+                for userid in missing:
+                    key, prefix = cls._locate(layout, userid)
+                    pipe.hget(key, prefix + cls.HKEY_CREDVERSION)
+                    pipe.hexists(key, prefix + cls.HKEY_USERNAME)
+                fetched = pipe.execute()
+            for i, userid in enumerate(missing):
+                if fetched[2*i+1]:
+                    versions[userid] = int(fetched[2*i] or 0)
+                    cls._credversions.put((dbnumber, userid), versions[userid], 
+                        stamp)
+                else:
+                    versions[userid] = None
+        return versions
 
     @classmethod
     def getusers(cls, dbnumber, **kwargs):
+        '''
+        Return a list of users, optionally filtered by levelspec. Accepts
+        the same arguments as iterusers.
+        '''
+        return list(cls.iterusers(dbnumber, **kwargs))
+    
+    @classmethod
+    def iterusers(cls, dbnumber, **kwargs):
+        '''
+        Generate users a batch at a time: the uid index set for levelspec is
+        walked with SSCAN and each batch of user hashes is fetched in a single
+        pipeline, so memory stays bounded by batchsize no matter how many 
+        users exist, apart from the set of uids already seen: SSCAN may 
+        return a member more than once, and each user is yielded only once.
+        Only the given fields (default LIST_FIELDS) are fetched.
+        '''
         levelspec = kwargs.get('levelspec', cls.LEVEL_ANY)
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        fields = cls._projection(kwargs.get('fields', cls.LIST_FIELDS))
+        seen = set()
         with DB(dbnumber) as db:
-            alluserkeys = cls._getallusers(db)
-            alluserkeys = [key[len(cls.KEY_USER_UID):] for key in alluserkeys]
-            users = [User(dbnumber, userid=key) for key in alluserkeys]
-            users = [user for user in users 
-                if levelspec == cls.LEVEL_ANY or user.level == levelspec]
-            return users    
+            uids = (uid for uid in db.ro.sscan_iter(cls.LEVEL_KEYS[levelspec], 
+                count=batchsize) if not (uid in seen or seen.add(uid)))
+            for batch in cls._batches(uids, batchsize):
+                for user in cls._loadusers(db, dbnumber, batch, fields):
+                    if levelspec == cls.LEVEL_ANY or user.level == levelspec:
+                        yield user
     
     @classmethod
     def getuserscount(cls, dbnumber):
         with DB(dbnumber) as db:
-            return len(cls._getallusers(db))
+            return db.ro.scard(cls.KEY_SITE_ALLUIDS)
+    
+    @classmethod
+    def findusers(cls, dbnumber, prefix='', **kwargs):
+        '''
+        Return (users, cursor): a page of up to count (default PAGESIZE) 
+        users whose username, or realname with by='realname', starts with
+        prefix (ignoring ASCII case), in name order. Pass cursor back for the
+        next page; it is None after the last. The page is found with 
+        ZRANGEBYLEX and its users fetched, with only the given fields 
+        (default LIST_FIELDS), in one pipeline.
+        '''
+        index = cls.NAME_INDEXES[kwargs.get('by', 'username')]
+        count = kwargs.get('count', cls.PAGESIZE)
+        cursor = kwargs.get('cursor')
+        fields = cls._projection(kwargs.get('fields', cls.LIST_FIELDS))
+        prefix = cls._foldname(prefix)
+        start = '(' + base64.urlsafe_b64decode(str(cursor)) if cursor else '[' + prefix
+        with DB(dbnumber) as db:
+            members = db.ro.zrangebylex(index, start, '[' + prefix + '\xff', 0, count + 1)
+            page = members[:count]
+            users = cls._loadusers(db, dbnumber, 
+                [member.rsplit('\0', 1)[1] for member in page], fields)
+        if len(members) <= count:
+            return users, None
+        return users, base64.urlsafe_b64encode(page[-1])
+    
+    @classmethod
+    def verifyindexes(cls, dbnumber, **kwargs):
+        '''
+        Compare the uid index sets and name indexes against the user hashes.
+        Return a list of problem descriptions, empty if the indexes are 
+        consistent.
+        '''
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        problems = []
+        with DB(dbnumber) as db:
+            layout = cls._getlayout(db)
+            for uids in cls._scanuserids(db, layout, batchsize):
+                # skip users removed since the scan found them
+                users = [(uid, record) for uid, record in 
+                    zip(uids, cls._getindexed(db, layout, uids)) 
+                    if record[0] is not None]
+                pipe = db.r.pipeline(transaction=False)
+                for uid, record in users:
+                    for setkey in (cls.KEY_SITE_ALLUIDS, cls.LEVEL_KEYS[int(record[0])]):
+                        pipe.sismember(setkey, uid)
+                    for index, name in zip(cls.NAME_INDEXES.values(), record[1:]):
+                        pipe.zscore(index, cls._indexentry(name or '', uid))
+                found = pipe.execute()
+                for i, (uid, record) in enumerate(users):
+                    if not (found[4*i] and found[4*i+1]):
+                        problems.append('user %s missing from index' % uid)
+                    for index, name, score in zip(cls.NAME_INDEXES.values(), 
+                        record[1:], found[4*i+2:4*i+4]):
+                        if name and score is None:
+                            problems.append('user %s missing from %s' % (uid, index))
+            for level, setkey in cls.LEVEL_KEYS.items():
+                uids = db.r.sscan_iter(setkey, count=batchsize)
+                for batch in cls._batches(uids, batchsize):
+                    for uid, record in zip(batch, cls._getindexed(db, layout, batch)):
+                        if record[0] is None or \
+                            level not in (cls.LEVEL_ANY, int(record[0])):
+                            problems.append('%s has stale uid %s' % (setkey, uid))
+            for i, index in enumerate(cls.NAME_INDEXES.values()):
+                members = (member for member, score in 
+                    db.r.zscan_iter(index, count=batchsize))
+                for batch in cls._batches(members, batchsize):
+                    uids = [member.rsplit('\0', 1)[1] for member in batch]
+                    for member, uid, record in zip(batch, uids, 
+                        cls._getindexed(db, layout, uids)):
+                        if member != cls._indexentry(record[i+1] or '', uid):
+                            problems.append('%s has stale entry for uid %s' % (index, uid))
+        return problems
+    
+    @classmethod
+    def rebuildindexes(cls, dbnumber, **kwargs):
+        '''
+        Rebuild every uid index set and name index from the user hashes. The
+        new indexes are built under temporary keys and swapped in atomically.
+        '''
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        tmpkeys = dict((key, key + '/rebuild') for key in 
+            cls.LEVEL_KEYS.values() + cls.NAME_INDEXES.values())
+        with DB(dbnumber) as db:
+            db.r.delete(*tmpkeys.values())
+            layout = cls._getlayout(db)
+            for uids in cls._scanuserids(db, layout, batchsize):
+                records = cls._getindexed(db, layout, uids)
+                pipe = db.r.pipeline(transaction=False)
+                for uid, record in zip(uids, records):
+                    if record[0] is not None:
+                        pipe.sadd(tmpkeys[cls.KEY_SITE_ALLUIDS], uid)
+                        pipe.sadd(tmpkeys[cls.LEVEL_KEYS[int(record[0])]], uid)
+                        for index, name in zip(cls.NAME_INDEXES.values(), record[1:]):
+                            if name:
+                                pipe.zadd(tmpkeys[index], **{cls._indexentry(name, uid):0})
+                pipe.execute()
+            pipe = db.r.pipeline()
+            for setkey, tmpkey in tmpkeys.items():
+                pipe.exists(tmpkey)
+            present = pipe.execute()
+            pipe = db.r.pipeline()
+            for (setkey, tmpkey), exists in zip(tmpkeys.items(), present):
+                if exists:
+                    pipe.rename(tmpkey, setkey)
+                else:
+                    pipe.delete(setkey)
+            pipe.execute()
+    
+    @classmethod
+    def migratelayout(cls, dbnumber, layout, **kwargs):
+        '''
+        Move every user to layout (LAYOUT_KEYS or LAYOUT_BUCKETS). Moving 
+        to buckets gives each user a compact uid, and the username, email
+        and index entries follow; returns the dict of old->new uid so other
+        records of uids (contests, submissions) can be updated too. The old->new map is
+        also kept in site/uidmap until clearuidmap, so an interrupted 
+        migration can simply be run again. Run it with the site stopped:
+        sessions of users whose uid changes end. Raises ValueError rather
+        than move to buckets while the server would store them as 
+        hashtables (see checkbuckets), unless force=True.
+        '''
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        hkeys = [cls.FIELD_HKEYS[field] for field in cls.ALL_FIELDS]
+        if layout == cls.LAYOUT_BUCKETS and not kwargs.get('force'):
+            problems = cls.checkbuckets(dbnumber)
+            if problems:
+                raise ValueError('; '.join(problems))
+        with DB(dbnumber) as db:
+            current = cls._getlayout(db)
+            if current != layout:
+                for uids in cls._scanuserids(db, current, batchsize):
+                    pipe = db.r.pipeline(transaction=False)
+                    for uid in uids:
+                        key, prefix = cls._locate(current, uid)
+                        pipe.hmget(key, [prefix + hkey for hkey in hkeys])
+                    records = pipe.execute()
+                    newuids = list(uids)
+                    if layout == cls.LAYOUT_BUCKETS:
+                        newuids = [uid if cls._iscompact(uid) else newuid for uid, newuid
+                            in zip(uids, db.getcompactids(cls.KEY_SITE_LASTUID, len(uids)))]
+                    pipe = db.r.pipeline()
+                    for uid, newuid, values in zip(uids, newuids, records):
+                        key, prefix = cls._locate(layout, newuid)
+                        pipe.hmset(key, dict((prefix + hkey, value) 
+                            for hkey, value in zip(hkeys, values) if value is not None))
+                        key, prefix = cls._locate(current, uid)
+                        if prefix:
+                            pipe.hdel(key, *[prefix + hkey for hkey in hkeys])
+                        else:
+                            pipe.delete(key)
+                        if newuid != uid:
+                            pipe.hset(cls.KEY_SITE_UIDMAP, uid, newuid)
+                    pipe.execute()
+                db.r.set(cls.KEY_SITE_USERLAYOUT, layout)
+                Invalidator.publish(db)
+            uidmap = dict(db.r.hscan_iter(cls.KEY_SITE_UIDMAP, count=batchsize))
+            for lookup in (cls.KEY_SITE_USERNAMES, cls.KEY_SITE_EMAILS):
+                for names in cls._batches(db.r.hscan_iter(lookup, count=batchsize), 
+                    batchsize):
+                    renamed = dict((name, uidmap[uid]) for name, uid in names 
+                        if uid in uidmap)
+                    if renamed:
+                        db.r.hmset(lookup, renamed)
+        cls.rebuildindexes(dbnumber, batchsize=batchsize)
+        return uidmap
+    
+    @classmethod
+    def checkbuckets(cls, dbnumber):
+        '''
+        Return a list of reasons the server would not keep bucket hashes
+        compactly encoded: hash-max-ziplist-entries must hold a bucket's 
+        fields and hash-max-ziplist-value a password hash. Empty if fine
+        '''
+        needed = {'hash-max-ziplist-entries':cls.BUCKETUSERS * len(cls.ALL_FIELDS),
+            'hash-max-ziplist-value':cls.BUCKETVALUE}
+        with DB(dbnumber) as db:
+            try:
+                config = db.r.config_get('hash-max-ziplist-*')
+            except redis.exceptions.ResponseError as e:
+                return ['cannot read the hash-max-ziplist settings (%s)' % e]
+        return ['%s is %s; buckets need at least %d' % (name, config.get(name), 
+            least) for name, least in sorted(needed.items()) 
+            if int(config.get(name) or 0) < least]
+    
+    @classmethod
+    def clearuidmap(cls, dbnumber):
+        '''
+        Forget the old->new uid map of the last migration
+        '''
+        with DB(dbnumber) as db:
+            db.r.delete(cls.KEY_SITE_UIDMAP)
+    
+    @classmethod
+    def memoryusage(cls, dbnumber, **kwargs):
+        '''
+        Return a dict describing the memory used by users: the layout, the 
+        number of users, bytes used by user records, name lookups and index
+        sets, the count of user hashes in each encoding, and the server's 
+        hash-max-ziplist settings
+        '''
+        batchsize = kwargs.get('batchsize', cls.BATCHSIZE)
+        report = {'records':0, 'lookups':0, 'indexes':0, 'encodings':{}}
+        with DB(dbnumber) as db:
+            layout = cls._getlayout(db)
+            pattern = cls.KEY_USER_BUCKET if layout == cls.LAYOUT_BUCKETS \
+                else cls.KEY_USER_UID
+            groups = [('records', db.r.scan_iter(match=pattern + '*', count=batchsize)),
+                ('lookups', [cls.KEY_SITE_USERNAMES, cls.KEY_SITE_EMAILS]),
+                ('indexes', cls.LEVEL_KEYS.values())]
+            for group, keys in groups:
+                for batch in cls._batches(keys, batchsize):
+                    pipe = db.r.pipeline(transaction=False)
+                    for key in batch:
+                        pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', 0)
+                        pipe.object('encoding', key)
+                    results = pipe.execute()
+                    report[group] += sum(used or 0 for used in results[::2])
+                    if group == 'records':
+                        for encoding in results[1::2]:
+                            report['encodings'][encoding] = \
+                                report['encodings'].get(encoding, 0) + 1
+            report['users'] = db.r.scard(cls.KEY_SITE_ALLUIDS)
+            report.update(db.r.config_get('hash-max-*'))
+        report['layout'] = layout
+        report['total'] = report['records'] + report['lookups'] + report['indexes']
+        return report
+    
+    @classmethod
+    def _getlayout(cls, db):
+        layout = cls._layouts.get((db.dbnumber, cls.CACHE_LAYOUT))
+        if layout is None:
+            layout = db.r.get(cls.KEY_SITE_USERLAYOUT) or cls.LAYOUT_KEYS
+            Invalidator.listen(db.dbnumber)
+            cls._layouts.put((db.dbnumber, cls.CACHE_LAYOUT), layout)
+        return layout
+    
+    @classmethod
+    def _locate(cls, layout, userid):
+        '''
+        Return (key of the hash holding userid's fields, prefix of their
+        field names) in layout. A uid that can't be in buckets maps to a
+        key that doesn't exist.
+        '''
+        if layout == cls.LAYOUT_BUCKETS and cls._iscompact(userid):
+            bucket = DB.frombase62(userid) // cls.BUCKETUSERS
+            return cls.KEY_USER_BUCKET + DB.tobase62(bucket), userid + ':'
+        return cls.KEY_USER_UID + userid, ''
+    
+    @staticmethod
+    def _iscompact(userid):
+        try:
+            DB.frombase62(userid)
+            return True
+        except ValueError:
+            return False
+    
+    @classmethod
+    def _newuserids(cls, db, layout, count):
+        if layout == cls.LAYOUT_BUCKETS:
+            return db.getcompactids(cls.KEY_SITE_LASTUID, count)
+        return [db.getuniqueid() for i in range(count)]
+    
+    @classmethod
+    def _scanuserids(cls, db, layout, batchsize):
+        '''
+        Generate lists of up to batchsize uids of stored users, found with
+        SCAN cursors over the user hashes
+        '''
+        if layout != cls.LAYOUT_BUCKETS:
+            keys = db.r.scan_iter(match=cls.KEY_USER_UID + '*', count=batchsize)
+            return cls._batches((key[len(cls.KEY_USER_UID):] for key in keys), 
+                batchsize)
+        suffix = ':' + cls.HKEY_USERNAME
+        buckets = db.r.scan_iter(match=cls.KEY_USER_BUCKET + '*', count=batchsize)
+        return cls._batches((field[:-len(suffix)] for bucket in buckets
+            for field in db.r.hkeys(bucket) if field.endswith(suffix)), batchsize)
+    
+    @classmethod
+    def _getindexed(cls, db, layout, uids):
+        '''
+        Return the stored [level, username, realname] of each of uids, all
+        None for missing users
+        '''
+        hkeys = [cls.HKEY_LEVEL] + [cls.FIELD_HKEYS[attr] for attr in cls.NAME_INDEXES]
+        pipe = db.r.pipeline(transaction=False)
+        for uid in uids:
+            key, prefix = cls._locate(layout, uid)
+            pipe.hmget(key, [prefix + hkey for hkey in hkeys])
+        return pipe.execute()
+    
+    @staticmethod
+    def _foldname(name):
+        '''
+        Return name as the index stores it: UTF-8, with ASCII letters 
+        lowercased as Lua's string.lower does
+        '''
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        return name.lower()
     
     @classmethod
-    def _getallusers(cls, db):
-        return db.r.keys(cls.KEY_USER_UID + '*')
+    def _indexentry(cls, name, uid):
+        return cls._foldname(name) + '\0' + uid
+    
+    @staticmethod
+    def _batches(iterable, batchsize):
+        '''
+        Generate lists of up to batchsize items from iterable
+        '''
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) >= batchsize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    @classmethod
+    def _loadusers(cls, db, dbnumber, uids, fields):
+        '''
+        Fetch fields of the users with uids in one round trip and return the
+        users that still exist
+        '''
+        layout = cls._getlayout(db)
+        pipe = db.ro.pipeline(transaction=False)
+        hkeys = [cls.FIELD_HKEYS[field] for field in fields]
+        for uid in uids:
+            key, prefix = cls._locate(layout, uid)
+            pipe.hmget(key, [prefix + hkey for hkey in hkeys])
+        users = []
+        for uid, values in zip(uids, pipe.execute()):
+            if values[0] is not None:
+                users.append(cls._fromdata(dbnumber, layout, uid, fields, values))
+        return users
+    
+    @classmethod
+    def _fromdata(cls, dbnumber, layout, userid, fields, values):
+        '''
+        Build a user from already fetched field values, without touching the
+        store
+        '''
+        user = cls.__new__(cls)
+        user.dbnumber = dbnumber
+        user.userid = userid
+        user.key, user.fieldprefix = cls._locate(layout, userid)
+        user._dirty = set()
+        user._setdata(fields, values)
+        user.isvalid = bool(user.username)
+        return user
+    
+    @classmethod
+    def _projection(cls, fields):
+        '''
+        Return fields as a tuple starting with username, which every load 
+        needs to tell whether the user exists
+        '''
+        return ('username',) + tuple(field for field in fields if field != 'username')
     
     def __init__(self, dbnumber, **kwargs):
         self.isvalid = False
         self.dbnumber = dbnumber
-        self.username = kwargs.get('username', '')
         self.userid = kwargs.get('userid', '')
-        self.email = kwargs.get('email', '')
-        self.realname = ''
-        self.passwordhash = ''
-        self.level = self.LEVEL_PENDING
+        self._dirty = set()
+        username = kwargs.get('username', '')
+        email = kwargs.get('email', '')
         with DB(self.dbnumber) as db:
-            if not (self.username or self.userid or self.email):
+            layout = self._getlayout(db)
+            if not (username or self.userid or email):
                 # Creating empty user from nothing
-                self.userid = db.getuniqueid()
-                self.key = self._userkey()
+                self.userid = self._newuserids(db, layout, 1)[0]
+                self.key, self.fieldprefix = self._locate(layout, self.userid)
                 self._createuser(db)
             else:
-                if self.username:
-                    self.userid = db.r.hget(self.KEY_SITE_USERNAMES, self.username)
-                elif self.email: 
-                    self.userid = db.r.hget(self.KEY_SITE_EMAILS, self.email)
+                if username:
+                    self.userid = self._lookup(db, self._usernames, 
+                        self.KEY_SITE_USERNAMES, username)
+                elif email: 
+                    self.userid = self._lookup(db, self._emails, 
+                        self.KEY_SITE_EMAILS, email)
                 if self.userid:
-                    self.key = self._userkey()
-                    self._loaduser(db)
+                    self.key, self.fieldprefix = self._locate(layout, self.userid)
+                    self._loaduser(db, 
+                        self._projection(kwargs.get('fields', self.DEFAULT_FIELDS)))
                     if self.username:
                         self.isvalid = True
+                else:
+                    self._setdata(self.ALL_FIELDS, [None] * len(self.ALL_FIELDS))
+                    self.username = username
+                    self.email = email
+                    
+    def __getattr__(self, name):
+        '''
+        Fetch a field that was left out when this user was loaded
+        '''
+        if name not in self.FIELD_HKEYS or not hasattr(self, 'key'):
+            raise AttributeError(name)
+        with DB(self.dbnumber) as db:
+            self._loaduser(db, (name,))
+        return object.__getattribute__(self, name)
 
 
     def setproperties(self, **kwargs):
-        if kwargs.has_key('username'):
-            self.setusername(kwargs['username'])
-        if kwargs.has_key('email'):
-            self.setemail(kwargs['email'])
-        with DB(self.dbnumber) as db:
-            self.realname = kwargs.get('realname', self.realname)
-            if kwargs.has_key('password'):
-                self.passwordhash = generate_password_hash(kwargs['password'])
-            self._updateuser(db)
+        '''
+        Set any of username, email, realname and password. Names are claimed
+        and the changed fields written by one atomic script call. A username
+        or email that belongs to another user is ignored.
+        '''
+        claims = [(field, lookup, kwargs[self.HKEY_FIELDS[field]]) 
+            for field, lookup in ((self.HKEY_USERNAME, self.KEY_SITE_USERNAMES), 
+                (self.HKEY_EMAIL, self.KEY_SITE_EMAILS))
+            if kwargs.has_key(self.HKEY_FIELDS[field]) and 
+                kwargs[self.HKEY_FIELDS[field]] != getattr(self, self.HKEY_FIELDS[field])]
+        if kwargs.has_key('realname'):
+            self._setfield(self.HKEY_REALNAME, kwargs['realname'])
+        if kwargs.has_key('password'):
+            self._setfield(self.HKEY_PASSWORDHASH, 
+                HashPool.generate(kwargs['password']))
+        if claims or self._dirty:
+            revoke = self.HKEY_PASSWORDHASH in self._dirty
+            keys = [self.key] + [lookup for field, lookup, value in claims] + \
+                self.NAME_INDEXES.values()
+            args = [self.userid, len(claims), 
+                self.fieldprefix + self.HKEY_CREDVERSION if revoke else '',
+                len(self.NAME_INDEXES)]
+            for field, lookup, value in claims:
+                args += [self.fieldprefix + field, value]
+            args += [self.fieldprefix + self.FIELD_HKEYS[attr] for attr in self.NAME_INDEXES]
+            for field in self._dirty:
+                args += [self.fieldprefix + field, getattr(self, self.HKEY_FIELDS[field])]
+            with DB(self.dbnumber) as db:
+                results = self.SCRIPT_CLAIM(db, keys, args)
+                entries = [(self.CACHE_USERS, self.userid)]
+                if revoke:
+                    self.credversion = results.pop()
+                    entries.append((self.CACHE_CREDVERSIONS, self.userid))
+                for (field, lookup, value), claimed in zip(claims, results):
+                    if claimed:
+                        attr = self.HKEY_FIELDS[field]
+                        cache = self.CACHE_USERNAMES if attr == 'username' \
+                            else self.CACHE_EMAILS
+                        entries += [(cache, name) 
+                            for name in (getattr(self, attr), value) if name]
+                        setattr(self, attr, value)
+                Invalidator.publishmany(db, entries)
+            self._dirty = set()
+        if self.username:
+            self.isvalid = True
 
             
     def checkpassword(self, password):
         '''
-        Return True if password hash matches stored.
+        Return True if password hash matches stored. A matching hash made
+        with outdated parameters is replaced, without revoking sessions.
         '''
-        return check_password_hash(self.passwordhash, password)
+        if not HashPool.check(self.passwordhash, password):
+            return False
+        if HashPool.needsrehash(self.passwordhash):
+            self._setfield(self.HKEY_PASSWORDHASH, HashPool.generate(password))
+            with DB(self.dbnumber) as db:
+                pipe = db.r.pipeline()
+                self._updateuser(db, pipe)
+                pipe.execute()
+        return True
 
     def usernameexists(self, username):
         with DB(self.dbnumber) as db:
             return self._usernameexists(db, username)
             
     def setusername(self, username):
-        with DB(self.dbnumber) as db:
-            if not self._usernameexists(db, username):
-                db.r.hset(self.KEY_SITE_USERNAMES, username, self.userid)
-                self.username = username
-                if self.username:
-                    self.isvalid = True
+        self.setproperties(username=username)
             
     def emailexists(self, email):
         with DB(self.dbnumber) as db:
             return self._emailexists(db, email)
             
     def setemail(self, email):
-        with DB(self.dbnumber) as db:
-            if not self._emailexists(db, email):
-                db.r.hset(self.KEY_SITE_EMAILS, email, self.userid)
-                self.email = email
+        self.setproperties(email=email)
 
     def levelstring(self):
         return self.LEVEL_STRINGS[self.level]
         
     def setlevel(self, level):
         assert level <= self.LEVEL_VISITOR and level >= self.LEVEL_ROOT
-        self.level = level
+        self._setfield(self.HKEY_LEVEL, level)
         with DB(self.dbnumber) as db:
-            self._updateuser(db)
+            pipe = db.r.pipeline()
+            self._updateuser(db, pipe)
+            self._revoked(db, pipe)
+            pipe.hincrby(self.key, self.fieldprefix + self.HKEY_CREDVERSION, 1)
+            self.credversion = pipe.execute()[-1]
                  
     def remove(self):
         '''
         Remove and clean up the uid 
         '''
         with DB(self.dbnumber) as db:
-            if self.username:
-                db.r.hdel(self.KEY_SITE_USERNAMES, (self.username))
-            if self.email:
-                db.r.hdel(self.KEY_SITE_EMAILS, (self.email))
-            db.r.delete((self.key))
+            username, email = self.SCRIPT_REMOVE(db, 
+                [self.key, self.KEY_SITE_USERNAMES, self.KEY_SITE_EMAILS,
+                    self.KEY_SITE_USERNAMEINDEX, self.KEY_SITE_REALNAMEINDEX] + 
+                    list(self.LEVEL_KEYS.values()),
+                [self.userid, self.fieldprefix + self.HKEY_USERNAME, 
+                    self.fieldprefix + self.HKEY_EMAIL, 
+                    self.fieldprefix + self.HKEY_REALNAME] + 
+                    ([self.fieldprefix + hkey for hkey in self.FIELD_HKEYS.values()]
+                        if self.fieldprefix else []))
+            entries = [(self.CACHE_USERS, self.userid), 
+                (self.CACHE_CREDVERSIONS, self.userid)]
+            if username:
+                entries.append((self.CACHE_USERNAMES, username))
+            if email:
+                entries.append((self.CACHE_EMAILS, email))
+            Invalidator.publishmany(db, entries)
+        self.isvalid = False
         
             
     def _usernameexists(self, db, username):
@@ -155,47 +822,126 @@ class User(object):
          
     def _emailexists(self, db, email):
         return db.r.hexists(self.KEY_SITE_EMAILS, email)
-
-    def _userkey(self):
-        return self.KEY_USER_UID + self.userid
         
+    def _revoked(self, db, pipe=None):
+        '''
+        Drop the cached credential version in every process
+        '''
+        Invalidator.publish(db, self.CACHE_CREDVERSIONS, self.userid, pipe)
+        
+    def _lookup(self, db, cache, key, name):
+        '''
+        Return the uid that name maps to in the lookup hash key, from cache
+        when the near cache holds it. Only names that exist are cached.
+        '''
+        userid = cache.get((self.dbnumber, name))
+        if userid is None:
+            Invalidator.listen(self.dbnumber)
+            stamp = cache.stamp()
+            userid = db.ro.hget(key, name)
+            if userid and cache.maxsize:
+                cache.put((self.dbnumber, name), userid, stamp)
+        return userid
+        
+    def _setfield(self, field, value):
+        '''
+        Change a user attribute by hash field name, marking it for writing
+        '''
+        attr = self.HKEY_FIELDS[field]
+        if not self._isloaded(attr) or getattr(self, attr) != value:
+            setattr(self, attr, value)
+            self._dirty.add(field)
+            
+    def _isloaded(self, attr):
+        try:
+            object.__getattribute__(self, attr)
+            return True
+        except AttributeError:
+            return False
+
     def _createuser(self, db):
         '''
         Create all data objects for new user object
         '''
         # user records in u/uid - users have no username or email yet
-        self.username = self.email = self.realname = self.passwordhash = ''
-        self._updateuser(db)
+        self._setdata(self.ALL_FIELDS, [None] * len(self.ALL_FIELDS))
+        self._dirty = set(self.HKEY_FIELDS)
+        pipe = db.r.pipeline()
+        self._updateuser(db, pipe)
+        pipe.sadd(self.KEY_SITE_ALLUIDS, self.userid)
+        pipe.execute()
+        
+    def _updateuser(self, db, pipe):
+        '''
+        Queue storing the changed attributes to user object on pipe, moving 
+        the uid between level index sets if the level changed, and dropping
+        cached copies of the user hash
+        '''
+        if self._dirty:
+            pipe.hmset(self.key, dict((self.fieldprefix + field, 
+                getattr(self, self.HKEY_FIELDS[field])) for field in self._dirty))
+            if self.HKEY_LEVEL in self._dirty:
+                self._indexlevel(pipe)
+            Invalidator.publish(db, self.CACHE_USERS, self.userid, pipe)
+            self._dirty = set()
         
-    def _updateuser(self, db):
+    def _indexlevel(self, pipe):
         '''
-        Store all attributes to user object
+        Queue moving the uid into the index set for its current level
         '''
-        db.r.hset(self.key, self.HKEY_USERNAME, self.username)
-        db.r.hset(self.key, self.HKEY_EMAIL, self.email)
-        db.r.hset(self.key, self.HKEY_REALNAME, self.realname)
-        db.r.hset(self.key, self.HKEY_PASSWORDHASH, self.passwordhash)
-        db.r.hset(self.key, self.HKEY_LEVEL, self.level)
+        for level, setkey in self.LEVEL_KEYS.items():
+            if level not in (self.LEVEL_ANY, self.level):
+                pipe.srem(setkey, self.userid)
+        pipe.sadd(self.LEVEL_KEYS[self.level], self.userid)
         
     
-    def _loaduser(self, db):
+    def _loaduser(self, db, fields):
+        '''
+        Load the member variables in fields from the near cache if it holds
+        the user, else from the data store, using uid as key. The cache 
+        holds whole records, read at once, so an entry is never a mix of 
+        reads from before and after a change.
+        '''
+        hkeys = [self.FIELD_HKEYS[field] for field in fields]
+        record = self._records.get((self.dbnumber, self.userid))
+        if record is None and self._records.maxsize:
+            Invalidator.listen(self.dbnumber)
+            stamp = self._records.stamp()
+            allhkeys = [self.FIELD_HKEYS[field] for field in self.ALL_FIELDS]
+            record = dict(zip(allhkeys, db.ro.hmget(self.key, 
+                [self.fieldprefix + hkey for hkey in allhkeys])))
+            if record[self.HKEY_USERNAME] is not None:
+                self._records.put((self.dbnumber, self.userid), record, stamp)
+        if record is None:
+            values = db.ro.hmget(self.key, [self.fieldprefix + hkey for hkey in hkeys])
+        else:
+            values = [record[hkey] for hkey in hkeys]
+        self._setdata(fields, values)
+        
+    def _setdata(self, fields, values):
         '''
-        Load the member variables from the data store, using uid as key
+        Set the member variables in fields from stored values, using the 
+        empty default for any that are missing
         '''
-        data = db.r.hgetall(self.key)
-        self.username = data[self.HKEY_USERNAME]
-        self.email = data[self.HKEY_EMAIL]
-        self.passwordhash = data[self.HKEY_PASSWORDHASH]
-        self.realname = data[self.HKEY_REALNAME]
-        self.level = int(data[self.HKEY_LEVEL])
+        for field, value in zip(fields, values):
+            if field == 'level':
+                value = self.LEVEL_PENDING if value is None else int(value)
+            elif field == 'credversion':
+                value = int(value or 0)
+            elif value is None:
+                value = ''
+            setattr(self, field, value)
         
         
         
 class TestSequenceFunctions(unittest.TestCase):
 
     '''
-    Every method named test_<name> will be executed as a unit test
+    Every method named test_<name> will be executed as a unit test. They
+    construct users through self.User, so a subclass can run them against
+    another implementation.
     '''
+    User = User
 
     def setUp(self):
         pass
@@ -205,99 +951,332 @@ class TestSequenceFunctions(unittest.TestCase):
             db.reset()
     
     def test_usercreateempty(self):
-        s = User(DB.DBNTEST) # select DB 1 for testing
+        s = self.User(DB.DBNTEST) # select DB 1 for testing
         self.assertEquals(s.username, '')
         self.assertNotEquals(s.userid, '')
-        s2 = User(DB.DBNTEST, userid=s.userid)
+        s2 = self.User(DB.DBNTEST, userid=s.userid)
         self.assertNotEqual(s, s2)
         self.assertEqual(s.userid, s2.userid)
         
     def test_usercreatenamed(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setusername('fred')
-        s2 = User(DB.DBNTEST, username='fred')
+        s2 = self.User(DB.DBNTEST, username='fred')
         self.assertEqual(s.userid, s2.userid)
-        s3 = User(DB.DBNTEST, username='fred')
+        s3 = self.User(DB.DBNTEST, username='fred')
         self.assertEqual(s.userid, s3.userid)
         
     def test_usercreateemail(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setusername('alice')
         s.setemail('alice@gmail.com')
         self.assertEqual('alice', s.username)
         self.assertEqual('alice@gmail.com', s.email)
-        s2 = User(DB.DBNTEST, email='alice@gmail.com')
+        s2 = self.User(DB.DBNTEST, email='alice@gmail.com')
         self.assertEqual(s.userid, s2.userid)
         
     def test_usersetproperties(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setproperties(username='alice', 
             email='alice@gmail.com', 
             realname='alice in wonderland',
             password='letmein')
-        s2 = User(DB.DBNTEST, email='alice@gmail.com')
+        s2 = self.User(DB.DBNTEST, email='alice@gmail.com')
         self.assertEqual('alice in wonderland', s.realname)
         self.assertNotEqual('letmein', s.passwordhash)
         self.assertEqual(s2.realname, s.realname)
         self.assertEqual(s2.passwordhash, s.passwordhash)
         
     def test_userpasswords(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setproperties(username='alice', 
             email='alice@gmail.com', 
             realname='alice in wonderland',
             password='letmein')
         self.assertEqual(s.username, 'alice')
-        s2 = User(DB.DBNTEST, username='alice')
+        s2 = self.User(DB.DBNTEST, username='alice')
         self.assertTrue(s2.checkpassword('letmein'))
         self.assertFalse(s2.checkpassword('letmeinx'))
+        
+    def test_rehashonlogin(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', password='letmein')
+        HashPool.configure(method='pbkdf2:sha1:1500')
+        try:
+            s2 = self.User(DB.DBNTEST, username='alice')
+            self.assertTrue(s2.checkpassword('letmein'))
+            s3 = self.User(DB.DBNTEST, username='alice')
+            self.assertTrue(s3.passwordhash.startswith('pbkdf2:sha1:1500$'))
+            self.assertEqual(s3.credversion, s.credversion)
+            self.assertTrue(s3.checkpassword('letmein'))
+        finally:
+            HashPool.configure(method=HashPool.DEFAULTS['method'][1])
 
     def test_usermissing(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setproperties(username='alice',
             email='alice@gmail.com',
             realname='alice in wonderland',
             password='letmein')
         self.assertEqual(s.username, 'alice')
         self.assertTrue(s.isvalid)
-        s2 = User(DB.DBNTEST, email='fred@gmail.com')
+        s2 = self.User(DB.DBNTEST, email='fred@gmail.com')
         self.assertFalse(s2.isvalid)
         
     def test_remove(self):
-        s = User(DB.DBNTEST)
+        s = self.User(DB.DBNTEST)
         s.setproperties(username='alice',
             email='alice@gmail.com',
             realname='alice in wonderland',
             password='letmein')
         s.remove()
-        s2 = User(DB.DBNTEST, username='alice')
+        s2 = self.User(DB.DBNTEST, username='alice')
         self.assertFalse(s2.isvalid)
-        s3 = User(DB.DBNTEST, email='alice@gmail.com')
+        s3 = self.User(DB.DBNTEST, email='alice@gmail.com')
         self.assertFalse(s3.isvalid)
     
     def test_getusers(self):
-        self.assertFalse(User.getuserscount(DB.DBNTEST))
-        s = User(DB.DBNTEST)
+        self.assertFalse(self.User.getuserscount(DB.DBNTEST))
+        s = self.User(DB.DBNTEST)
         s.setproperties(username='alice',
             email='alice@gmail.com',
             realname='alice in wonderland',
             password='letmein')
-        s2 = User(DB.DBNTEST)
+        s2 = self.User(DB.DBNTEST)
         s2.setproperties(username='fred',
             email='fred@gmail.com',
             realname='fred in wonderland',
             password='letmeintoo')
-        s3 = User(DB.DBNTEST)
+        s3 = self.User(DB.DBNTEST)
         s3.setproperties(username='shrek',
             email='shrek@gmail.com',
             realname='shrek in wonderland',
             password='letmeinthree')
         s3.setlevel(User.LEVEL_CONTESTANT)
-        allusers = User.getusers(DB.DBNTEST)
+        allusers = self.User.getusers(DB.DBNTEST)
         self.assertEqual(len(allusers),3)
-        cusers = User.getusers(DB.DBNTEST, levelspec=User.LEVEL_CONTESTANT)
+        cusers = self.User.getusers(DB.DBNTEST, levelspec=User.LEVEL_CONTESTANT)
         self.assertEqual(len(cusers),1)
-        self.assertEqual(User.getuserscount(DB.DBNTEST), 3)
+        self.assertEqual(self.User.getuserscount(DB.DBNTEST), 3)
+        s3.remove()
+        self.assertEqual(self.User.getuserscount(DB.DBNTEST), 2)
+        self.assertFalse(self.User.getusers(DB.DBNTEST, levelspec=User.LEVEL_CONTESTANT))
+        
+    def test_dirtyfields(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', password='letmein')
+        with DB(DB.DBNTEST) as db:
+            db.r.hset(s.key, s.fieldprefix + User.HKEY_PASSWORDHASH, 'untouched')
+        s.setlevel(User.LEVEL_COACH)
+        s.setproperties(username='alice2')
+        s2 = self.User(DB.DBNTEST, username='alice2')
+        self.assertEqual(s2.passwordhash, 'untouched')
+        self.assertEqual(s2.level, User.LEVEL_COACH)
+        self.assertFalse(self.User(DB.DBNTEST, username='alice').isvalid)
+        t = self.User(DB.DBNTEST)
+        t.setproperties(username='alice2', realname='not alice')
+        self.assertEqual(t.username, '')
+        self.assertEqual(t.realname, 'not alice')
+        
+    def test_claims(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', email='alice@gmail.com')
+        t = self.User(DB.DBNTEST)
+        t.setproperties(username='alice', email='alice@gmail.com', realname='t')
+        self.assertEqual((t.username, t.email, t.realname), ('', '', 't'))
+        s.setproperties(email='')
+        t.setproperties(email='alice@gmail.com')
+        self.assertEqual(self.User(DB.DBNTEST, email='alice@gmail.com').userid, t.userid)
+        s.remove()
+        self.assertFalse(s.isvalid)
+        self.assertFalse(t.usernameexists('alice'))
+        self.assertTrue(t.emailexists('alice@gmail.com'))
+        self.assertEqual(self.User.getuserscount(DB.DBNTEST), 1)
+        
+    def test_credversions(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', password='letmein')
+        t = self.User(DB.DBNTEST)
+        t.setproperties(username='bob')
+        versions = self.User.getcredversions(DB.DBNTEST, [s.userid, t.userid, 'nobody'])
+        self.assertEqual(versions, {s.userid:1, t.userid:0, 'nobody':None})
+        s.setlevel(User.LEVEL_COACH)
+        s.setproperties(realname='alice')
+        self.assertEqual(self.User(DB.DBNTEST, username='alice').credversion, 2)
+        self.assertEqual(self.User.getcredversions(DB.DBNTEST, [s.userid])[s.userid], 2)
+        s.remove()
+        self.assertEqual(self.User.getcredversions(DB.DBNTEST, [s.userid])[s.userid], None)
+        
+    def test_projection(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', email='alice@gmail.com', password='letmein')
+        s2 = self.User(DB.DBNTEST, username='alice', fields=('level',))
+        self.assertFalse(s2._isloaded('passwordhash'))
+        self.assertFalse(s2._isloaded('email'))
+        self.assertEqual(s2.email, 'alice@gmail.com')   # fetched on access
+        self.assertTrue(s2.checkpassword('letmein'))
+        s2.setproperties(realname='Alice')
+        self.assertEqual(self.User(DB.DBNTEST, username='alice').realname, 'Alice')
+        users = self.User.getusers(DB.DBNTEST)
+        self.assertEqual(users[0].realname, 'Alice')
+        self.assertFalse(users[0]._isloaded('email'))
+        self.assertRaises(AttributeError, setattr, users[0], 'other', 1)
+        
+    def test_indexes(self):
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice')
+        s.setlevel(User.LEVEL_COACH)
+        s.setlevel(User.LEVEL_CONTESTANT)
+        self.assertEqual(self.User.verifyindexes(DB.DBNTEST), [])
+        with DB(DB.DBNTEST) as db:
+            db.r.delete(User.KEY_SITE_CONTESTANTUIDS)
+            db.r.sadd(User.KEY_SITE_COACHUIDS, s.userid)
+        self.assertEqual(len(self.User.verifyindexes(DB.DBNTEST)), 2)
+        self.User.rebuildindexes(DB.DBNTEST)
+        self.assertEqual(self.User.verifyindexes(DB.DBNTEST), [])
+        with DB(DB.DBNTEST) as db:
+            # as left by a user removed mid-scan
+            db.r.hset(User.KEY_USER_UID + 'gone', User.HKEY_USERNAME, 'gone')
+        self.assertEqual(self.User.verifyindexes(DB.DBNTEST), [])
+        self.User.rebuildindexes(DB.DBNTEST)
+        cusers = self.User.getusers(DB.DBNTEST, levelspec=User.LEVEL_CONTESTANT)
+        self.assertEqual([u.username for u in cusers], ['alice'])
+        
+    def test_iterusers(self):
+        for i in range(25):
+            s = self.User(DB.DBNTEST)
+            s.setproperties(username='user%d' % i)
+            if i % 5 == 0:
+                s.setlevel(User.LEVEL_COACH)
+        users = list(self.User.iterusers(DB.DBNTEST, batchsize=4))
+        self.assertEqual(len(set(u.userid for u in users)), 25)
+        sscan_iter = InstrumentedRedis.sscan_iter
+        InstrumentedRedis.sscan_iter = lambda self, *args, **kwargs: \
+            itertools.chain(sscan_iter(self, *args, **kwargs), 
+                sscan_iter(self, *args, **kwargs))
+        try:
+            repeated = list(self.User.iterusers(DB.DBNTEST, batchsize=4))
+        finally:
+            InstrumentedRedis.sscan_iter = sscan_iter
+        self.assertEqual(sorted(u.userid for u in repeated), 
+            sorted(u.userid for u in users))
+        self.assertTrue(all(u.isvalid for u in users))
+        coaches = self.User.getusers(DB.DBNTEST, levelspec=User.LEVEL_COACH, batchsize=4)
+        self.assertEqual(sorted(u.username for u in coaches), 
+            ['user0', 'user10', 'user15', 'user20', 'user5'])
+
+    def test_findusers(self):
+        for username, realname in (('alice', 'Alice Liddell'), ('Alan', 'Alan Turing'),
+            ('albert', ''), ('bob', 'Alan Partridge')):
+            self.User(DB.DBNTEST).setproperties(username=username, realname=realname)
+        users, cursor = self.User.findusers(DB.DBNTEST, 'AL', count=2)
+        self.assertEqual([u.username for u in users], ['Alan', 'albert'])
+        users, cursor = self.User.findusers(DB.DBNTEST, 'al', count=2, cursor=cursor)
+        self.assertEqual(([u.username for u in users], cursor), (['alice'], None))
+        users, cursor = self.User.findusers(DB.DBNTEST, 'alan ', by='realname')
+        self.assertEqual([u.realname for u in users], ['Alan Partridge', 'Alan Turing'])
+        self.User(DB.DBNTEST, username='alice').setproperties(username='zed', realname='Zed')
+        self.User(DB.DBNTEST, username='bob').remove()
+        self.assertEqual([u.username for u in self.User.findusers(DB.DBNTEST, 'al')[0]], 
+            ['Alan', 'albert'])
+        self.assertEqual([u.username for u in self.User.findusers(DB.DBNTEST, 
+            by='realname')[0]], ['Alan', 'zed'])
+        self.assertEqual(self.User.verifyindexes(DB.DBNTEST), [])
+        with DB(DB.DBNTEST) as db:
+            db.r.delete(User.KEY_SITE_REALNAMEINDEX)
+        self.assertEqual(len(self.User.verifyindexes(DB.DBNTEST)), 2)
+        self.User.rebuildindexes(DB.DBNTEST)
+        self.assertEqual([u.username for u in self.User.findusers(DB.DBNTEST, 
+            by='realname')[0]], ['Alan', 'zed'])
+        
+    def test_nearcache(self):
+        self.User.configurecache(100)
+        try:
+            s = self.User(DB.DBNTEST)
+            s.setproperties(username='alice', email='alice@gmail.com', realname='Alice')
+            self.User(DB.DBNTEST, username='alice')
+            self.User(DB.DBNTEST, email='alice@gmail.com')
+            Metrics.beginrequest()
+            self.assertEqual(self.User(DB.DBNTEST, username='alice').realname, 'Alice')
+            self.assertEqual(self.User(DB.DBNTEST, email='alice@gmail.com').userid, s.userid)
+            self.assertEqual(Metrics.endrequest('test', 0), [])
+            self.User.configurecache(100)
+            self.User(DB.DBNTEST, userid=s.userid, fields=('username',))
+            Metrics.beginrequest()
+            self.assertEqual(self.User(DB.DBNTEST, userid=s.userid, 
+                fields=self.User.ALL_FIELDS).email, 'alice@gmail.com')
+            self.assertEqual(Metrics.endrequest('test', 0), [])
+            s.setproperties(username='alice2', realname='Alice Again')
+            self.assertFalse(self.User(DB.DBNTEST, username='alice').isvalid)
+            self.assertEqual(self.User(DB.DBNTEST, username='alice2').realname, 'Alice Again')
+            s.setlevel(User.LEVEL_COACH)
+            self.assertEqual(self.User(DB.DBNTEST, userid=s.userid).level, User.LEVEL_COACH)
+            with DB(DB.DBNTEST) as db:
+                # a write made by another process, which then publishes
+                db.r.hset(s.key, s.fieldprefix + User.HKEY_REALNAME, 'Elsewhere')
+                self.assertEqual(self.User(DB.DBNTEST, userid=s.userid).realname, 'Alice Again')
+                db.r.publish(db.channel(Invalidator.CHANNEL + str(DB.DBNTEST)), 
+                    User.CACHE_USERS + ' ' + s.userid)
+            for i in range(50):
+                if self.User(DB.DBNTEST, userid=s.userid).realname == 'Elsewhere':
+                    break
+                time.sleep(0.02)
+            self.assertEqual(self.User(DB.DBNTEST, userid=s.userid).realname, 'Elsewhere')
+            s.remove()
+            self.assertFalse(self.User(DB.DBNTEST, email='alice@gmail.com').isvalid)
+            self.assertFalse(self.User(DB.DBNTEST, userid=s.userid).isvalid)
+        finally:
+            self.User.configurecache(0)
+
+    def test_migratelayout(self):
+        with DB(DB.DBNTEST) as db:
+            layout = self.User._getlayout(db)
+        other = User.LAYOUT_BUCKETS if layout == User.LAYOUT_KEYS else User.LAYOUT_KEYS
+        s = self.User(DB.DBNTEST)
+        s.setproperties(username='alice', email='alice@gmail.com', password='letmein')
+        s.setlevel(User.LEVEL_COACH)
+        self.User(DB.DBNTEST).setproperties(username='bob')
+        with DB(DB.DBNTEST) as db:
+            value = db.r.config_get('hash-max-ziplist-value')['hash-max-ziplist-value']
+            db.r.config_set('hash-max-ziplist-value', 64)
+            try:
+                self.assertTrue(User.checkbuckets(DB.DBNTEST))
+                self.assertRaises(ValueError, User.migratelayout, DB.DBNTEST, 
+                    User.LAYOUT_BUCKETS)
+                self.assertEqual(User._getlayout(db), layout)
+                db.r.config_set('hash-max-ziplist-value', User.BUCKETVALUE)
+                self.assertEqual(User.checkbuckets(DB.DBNTEST), [])
+                self.migrateboth(s, layout, other)
+            finally:
+                db.r.config_set('hash-max-ziplist-value', value)
+        report = self.User.memoryusage(DB.DBNTEST)
+        self.assertEqual((report['layout'], report['users']), (layout, 2))
+        self.assertTrue(report['records'] and report['lookups'] and report['indexes'])
+    
+    def migrateboth(self, s, layout, other):
+        for target in (other, layout):
+            uidmap = self.User.migratelayout(DB.DBNTEST, target, batchsize=1)
+            alice = self.User(DB.DBNTEST, email='alice@gmail.com')
+            self.assertEqual(uidmap.get(s.userid, s.userid), alice.userid)
+            self.assertEqual((alice.username, alice.level), ('alice', User.LEVEL_COACH))
+            self.assertTrue(alice.checkpassword('letmein'))
+            self.assertEqual(alice.key.startswith(User.KEY_USER_BUCKET), 
+                target == User.LAYOUT_BUCKETS)
+            self.assertEqual(self.User.verifyindexes(DB.DBNTEST), [])
+            self.assertEqual(sorted(u.username for u in self.User.getusers(DB.DBNTEST)),
+                ['alice', 'bob'])
+            s = alice
+        
+        
+class TestBucketLayout(TestSequenceFunctions):
+    
+    '''
+    The User suite, run with users stored in the buckets layout
+    '''
+    
+    def setUp(self):
+        User.migratelayout(DB.DBNTEST, User.LAYOUT_BUCKETS, force=True)
+        super(TestBucketLayout, self).setUp()
     
 
         
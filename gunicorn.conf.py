@@ -0,0 +1,27 @@
+'''
+gunicorn settings for the web process (see Procfile):
+
+    gunicorn -c gunicorn.conf.py hscpcweb:app
+
+The app is imported once, in the master, and prefork() does the shared
+start-up work there before any worker is forked. Each worker then runs
+postfork() to open its own connections and warm its caches before it
+accepts requests. Workers are gevent's, so the live pages' open event 
+streams (/events) each hold a greenlet rather than a whole worker.
+'''
+import multiprocessing
+import os
+
+if 'PORT' in os.environ:
+    bind = '0.0.0.0:' + os.environ['PORT']
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+preload_app = True
+
+def when_ready(server):
+    from hscpcweb import prefork
+    prefork(server.app.wsgi())
+
+def post_fork(server, worker):
+    from hscpcweb import postfork
+    postfork(server.app.wsgi())
@@ -0,0 +1,316 @@
+import gevent
+import gevent.queue
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import unittest
+from dbtools import Metrics
+from gevent import monkey
+from gevent.threadpool import ThreadPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+def _generate(args):
+    return generate_password_hash(*args)
+
+def _serve(jobs, replies):
+    '''
+    Body of a _GeventPool process: run each (func, args) received on jobs
+    and send back (True, result) or (False, the exception it raised), until
+    the process that started it is gone (its siblings hold copies of the 
+    pipe, so jobs may never see EOF)
+    '''
+    parent = os.getppid()
+    while os.getppid() == parent:
+        if not jobs.poll(1):
+            continue
+        try:
+            func, args = jobs.recv()
+        except EOFError:
+            return
+        try:
+            replies.send((True, func(*args)))
+        except Exception as e:
+            replies.send((False, e))
+
+class _GeventResult(object):
+    '''
+    Wraps a greenlet running _GeventPool._apply so get() returns or raises
+    what the job did, and times out, like multiprocessing's results
+    '''
+    def __init__(self, greenlet):
+        self._greenlet = greenlet
+
+    def get(self, timeout=None):
+        try:
+            ok, result = self._greenlet.get(timeout=timeout)
+        except gevent.Timeout:
+            raise multiprocessing.TimeoutError()
+        if not ok:
+            raise result
+        return result
+
+class _GeventPool(object):
+    '''
+    The part of multiprocessing.Pool that HashPool uses, for processes
+    where gevent has patched threading (under gunicorn's gevent worker): 
+    there, multiprocessing.Pool's helper threads would become greenlets 
+    blocked on its pipes and stall the whole worker. Jobs still run in 
+    worker processes, each fed through its own pipe; the greenlet that 
+    sent one waits for the reply on one of gevent's OS threads, so the 
+    hashing itself never holds this process's CPU or GIL. (The pipes are
+    one-way ones, since gevent makes the socket pairs of two-way pipes
+    non-blocking.)
+    '''
+    def __init__(self, workers):
+        self._waiters = ThreadPool(workers)
+        self._idle = gevent.queue.Queue()
+        self._pids = []
+        for i in range(workers):
+            jobs, send = multiprocessing.Pipe(False)
+            receive, replies = multiprocessing.Pipe(False)
+            pid = os.fork()
+            if not pid:
+                try:
+                    for signum in (signal.SIGTERM, signal.SIGINT):
+                        signal.signal(signum, signal.SIG_DFL)
+                    _serve(jobs, replies)
+                finally:
+                    os._exit(0)
+            jobs.close()
+            replies.close()
+            self._pids.append(pid)
+            self._idle.put((send, receive))
+
+    def apply_async(self, func, args):
+        return _GeventResult(gevent.spawn(self._apply, func, args))
+
+    def map(self, func, iterable, chunksize=None):
+        return [result.get() for result in 
+            [self.apply_async(func, (arg,)) for arg in iterable]]
+
+    def terminate(self):
+        self._waiters.kill()
+        for pid in self._pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+    def _apply(self, func, args):
+        # a job that times out still finishes, then frees its process
+        send, receive = self._idle.get()
+        try:
+            send.send((func, args))
+            return self._waiters.apply(receive.recv)
+        finally:
+            self._idle.put((send, receive))
+
+class HashPoolBusy(Exception):
+    '''
+    Raised when too many hash jobs are already waiting; callers should ask
+    the client to retry shortly.
+    '''
+    pass
+
+class HashPool(object):
+    '''
+    Runs password hashing in a process pool, so a burst of logins can't tie
+    up a web worker's CPU (or, under gevent, stall its other greenlets). 
+    The pool is created on first use in each process (i.e. after gunicorn 
+    forks) and configured from the environment unless overridden with 
+    HashPool.configure:
+
+        HASH_METHOD         werkzeug method, pbkdf2:<digest>:<iterations>
+        HASH_SALTLENGTH     salt length in characters
+        HASH_WORKERS        pool processes (0 hashes inline)
+        HASH_MAXQUEUE       jobs in flight before HashPoolBusy is raised
+        HASH_TIMEOUT        seconds to wait for a job
+    '''
+    _config = {}
+    _pool = None
+    _poolpid = None
+    _slots = None
+    _lock = threading.Lock()
+
+    DEFAULTS = {'method':('HASH_METHOD', 'pbkdf2:sha1:1000'),
+        'saltlength':('HASH_SALTLENGTH', 8),
+        'workers':('HASH_WORKERS', 2),
+        'maxqueue':('HASH_MAXQUEUE', 16),
+        'timeout':('HASH_TIMEOUT', 10)}
+
+    @classmethod
+    def configure(cls, **kwargs):
+        '''
+        Override settings (method, saltlength, workers, maxqueue, timeout).
+        The pool is rebuilt on next use.
+        '''
+        with cls._lock:
+            cls._config.update(kwargs)
+            cls._shutdown()
+
+    @classmethod
+    def getsetting(cls, name):
+        if name in cls._config:
+            return cls._config[name]
+        envname, default = cls.DEFAULTS[name]
+        value = os.getenv(envname)
+        if value is None:
+            return default
+        return value if name == 'method' else int(value)
+
+    @classmethod
+    def generate(cls, password):
+        '''
+        Return a hash of password using the configured method
+        '''
+        return cls._run(generate_password_hash, password,
+            cls.getsetting('method'), cls.getsetting('saltlength'))
+
+    @classmethod
+    def generatemany(cls, passwords):
+        '''
+        Return a list of hashes of passwords, computed in parallel across the 
+        whole pool. Meant for bulk tools, so it waits rather than raising
+        HashPoolBusy.
+        '''
+        args = [(password, cls.getsetting('method'), cls.getsetting('saltlength'))
+            for password in passwords]
+        pool, slots = cls._getpool()
+        if pool is None:
+            return [_generate(arg) for arg in args]
+        chunksize = max(1, len(args) // (4 * cls.getsetting('workers')))
+        return pool.map(_generate, args, chunksize)
+
+    @classmethod
+    def check(cls, pwhash, password):
+        '''
+        Return True if password matches pwhash
+        '''
+        if pwhash.count('$') < 2:
+            return False
+        return cls._run(check_password_hash, pwhash, password)
+
+    @classmethod
+    def needsrehash(cls, pwhash):
+        '''
+        Return True if pwhash was made with other than the configured method
+        or salt length
+        '''
+        if pwhash.count('$') < 2:
+            return False
+        method, salt = pwhash.split('$')[:2]
+        return method != cls.getsetting('method') or \
+            len(salt) != cls.getsetting('saltlength')
+
+    @classmethod
+    def start(cls):
+        '''
+        Start this process's hashing workers now rather than on first use
+        '''
+        cls._getpool()
+
+    @classmethod
+    def _run(cls, func, *args):
+        pool, slots = cls._getpool()
+        start = time.time()
+        if pool is None:
+            result = func(*args)
+        else:
+            if not slots.acquire(False):
+                Metrics.increment('hscpc_password_hash_busy_total')
+                raise HashPoolBusy()
+            try:
+                result = pool.apply_async(func, args).get(cls.getsetting('timeout'))
+            except multiprocessing.TimeoutError:
+                Metrics.increment('hscpc_password_hash_busy_total')
+                raise HashPoolBusy()
+            finally:
+                slots.release()
+        Metrics.observe('hscpc_password_hash_seconds', time.time() - start,
+            operation=func.__name__)
+        return result
+
+    @classmethod
+    def _getpool(cls):
+        with cls._lock:
+            if cls._poolpid != os.getpid():
+                cls._pool = None     # inherited from the parent; not ours
+                cls._poolpid = os.getpid()
+            if cls._pool is None and cls.getsetting('workers'):
+                poolclass = _GeventPool if monkey.is_module_patched('threading') \
+                    else multiprocessing.Pool
+                cls._pool = poolclass(cls.getsetting('workers'))
+                cls._slots = threading.BoundedSemaphore(cls.getsetting('maxqueue'))
+            return cls._pool, cls._slots
+
+    @classmethod
+    def _shutdown(cls):
+        if cls._pool is not None and cls._poolpid == os.getpid():
+            cls._pool.terminate()
+        cls._pool = None
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    '''
+    Every method named test_<name> will be executed as a unit test
+    '''
+
+    def tearDown(self):
+        HashPool.configure(method=HashPool.DEFAULTS['method'][1], maxqueue=16,
+            timeout=HashPool.DEFAULTS['timeout'][1])
+
+    def test_hashcheck(self):
+        h = HashPool.generate('letmein')
+        self.assertNotEqual(h, 'letmein')
+        self.assertTrue(HashPool.check(h, 'letmein'))
+        self.assertFalse(HashPool.check(h, 'letmeinx'))
+        self.assertFalse(HashPool.check('', 'letmein'))
+
+    def test_generatemany(self):
+        hashes = HashPool.generatemany(['a', 'b', 'c'])
+        self.assertEqual(len(set(hashes)), 3)
+        self.assertTrue(HashPool.check(hashes[1], 'b'))
+
+    def test_rehash(self):
+        h = HashPool.generate('letmein')
+        self.assertFalse(HashPool.needsrehash(h))
+        HashPool.configure(method='pbkdf2:sha1:2000')
+        self.assertTrue(HashPool.needsrehash(h))
+        self.assertTrue(HashPool.check(h, 'letmein'))
+        self.assertFalse(HashPool.needsrehash(HashPool.generate('letmein')))
+
+    def test_busy(self):
+        key = ('hscpc_password_hash_busy_total', ())
+        busy = Metrics._counters.get(key, 0)
+        HashPool.configure(maxqueue=0)
+        self.assertRaises(HashPoolBusy, HashPool.generate, 'letmein')
+        HashPool.configure(maxqueue=16, method='pbkdf2:sha1:1000000', timeout=0)
+        self.assertRaises(HashPoolBusy, HashPool.generate, 'letmein')
+        self.assertEqual(Metrics._counters[key], busy + 2)
+
+    def test_geventpool(self):
+        pool = _GeventPool(2)
+        try:
+            h = pool.apply_async(generate_password_hash, ('letmein',)).get(10)
+            self.assertTrue(check_password_hash(h, 'letmein'))
+            self.assertEqual(len(set(pool.map(_generate, [('a',), ('b',)], 1))), 2)
+            self.assertRaises(multiprocessing.TimeoutError, 
+                pool.apply_async(time.sleep, (0.5,)).get, 0.01)
+            self.assertRaises(ValueError, pool.apply_async(int, ('x',)).get, 10)
+            # the hashing is done elsewhere while this process's greenlets run
+            cpu = time.clock()
+            results = [pool.apply_async(generate_password_hash, 
+                ('letmein', 'pbkdf2:sha1:50000')) for i in range(2)]
+            ticks = 0
+            while not all(result._greenlet.ready() for result in results):
+                gevent.sleep(0.005)
+                ticks += 1
+            self.assertTrue(time.clock() - cpu < 0.2)
+            self.assertTrue(ticks > 10)
+        finally:
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    unittest.main()
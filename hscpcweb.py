@@ -1,22 +1,188 @@
+import hashlib
+import json
+import logging
 import os
-from flask import Flask, redirect, url_for, render_template, request, session
+from flask import Flask, redirect, url_for, render_template, request, session, g, Markup, \
+    Response, jsonify, make_response, current_app
 import redis
+import shutil
+import tempfile
+import time
 import unittest
-from dbtools import DB
+from dbcontest import Contest
+from dbevents import EventHub
+from dbjudge import JudgeQueue
+from dbtools import DB, Invalidator, LocalCache, Metrics, Script
 from dbsite import Site
+from dbthrottle import LoginThrottle
 from dbuser import User
+from hashpool import HashPool, HashPoolBusy
+from werkzeug.contrib.fixers import ProxyFix
 
 
-app = Flask(__name__)
-# secret key for session storage with cookies
-# set SECRET_KEY environment variable in heroku to something SECRET
-app.secret_key = os.environ.get('SECRET_KEY', 'development_fallback')
-app.config['db'] = 0
+class Config(object):
+    '''
+    Settings for create_app. Any not given as keyword arguments are read
+    from the environment when the Config is made:
+
+        SECRET_KEY          for signing session cookies; set it to something
+                            SECRET in heroku (SECRET_KEY)
+        DB                  redis db number
+        SLOW_REQUEST_MS     log requests slower than this, with the redis 
+                            commands they ran (SLOW_REQUEST_MS)
+        REDIS               dict of DB.configure settings (REDISTOGO_URL and
+                            the REDIS_* variables)
+        TRUSTED_PROXIES     proxies in front of the app (1 on heroku, for 
+                            its router) whose X-Forwarded-For entries give
+                            the client address (TRUSTED_PROXIES)
+    '''
+    def __init__(self, **settings):
+        self.SECRET_KEY = os.environ.get('SECRET_KEY', 'development_fallback')
+        self.DB = DB.DBN
+        self.SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 0)) or None
+        self.TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+        self.REDIS = dict((name, DB.getsetting(name)) for name in DB.SETTINGS)
+        self.__dict__.update(settings)
+
+# (rule, view function, options) for each route, added by create_app
+routes = []
+
+def route(rule, **options):
+    def register(func):
+        routes.append((rule, func, options))
+        return func
+    return register
+
+# rendered pages, keyed on everything that goes into them
+CACHE_PAGES = 'pages'
+pages = Invalidator.register(CACHE_PAGES, LocalCache(maxsize=256, ttl=300))
+STATIC_MAX_AGE = 365 * 24 * 3600    # for fingerprinted static urls
+
+def digestfiles(folder):
+    '''
+    Return a digest of the contents of every file under folder (or of the
+    file folder)
+    '''
+    digest = hashlib.sha1()
+    if os.path.isfile(folder):
+        with open(folder, 'rb') as f:
+            digest.update(f.read())
+        return digest.hexdigest()
+    for path, dirs, files in sorted(os.walk(folder)):
+        for filename in sorted(files):
+            with open(os.path.join(path, filename), 'rb') as f:
+                digest.update(filename + f.read())
+    return digest.hexdigest()
+
+templatesdigest = digestfiles(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+    'templates'))
+staticdigest = digestfiles(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+    'static'))
+staticdigests = {}
+
+def renderpage(template, site, **context):
+    '''
+    Render template for the viewer through the page cache. Pages are keyed
+    on site version (and generation, since a reset restarts the version),
+    template, viewer level and context, and the ETag is
+    derived from that key, so a browser revalidating a page it already
+    has gets a 304 without anything being rendered. The ETag also covers
+    the templates and static files, since a page embeds the fingerprinted
+    urls of the latter.
+    '''
+    user = sessionuser()
+    level = user[1] if user else None
+    key = (site.dbnumber, site.generation, site.version, template, level, 
+        tuple(sorted(context.items())))
+    etag = hashlib.sha1(templatesdigest + staticdigest + repr(key)).hexdigest()
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        page = pages.get(key)
+        if page is None:
+            page = render_template(template, name=site.name, **context)
+            pages.put(key, page)
+        response = make_response(page)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' if level is None \
+        else 'private, no-cache'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+def fingerprint(endpoint, values):
+    '''
+    Add a digest of the file's contents to static urls, so they can be 
+    cached forever and still change when the file does
+    '''
+    if endpoint == 'static' and 'filename' in values:
+        filename = values['filename']
+        if filename not in staticdigests:
+            path = os.path.join(current_app.static_folder, filename)
+            staticdigests[filename] = digestfiles(path)[:12] \
+                if os.path.isfile(path) else None
+        if staticdigests[filename]:
+            values.setdefault('v', staticdigests[filename])
 
 def loggedin():
-    return session.get('loggedin', None)
+    return session.get('loggedin', None) if sessionuser() else None
+
+def sessionuser():
+    '''
+    Return (uid, level) for the logged in user, straight from the signed 
+    session cookie, or None. The session is honored only while its 
+    credential version matches the user's, so bumping the version (password
+    or level change, removal) revokes it.
+    '''
+    uid = session.get('uid', None)
+    if uid is None:
+        return None
+    versions = User.getcredversions(current_app.config['db'], [uid])
+    if versions[uid] != session.get('credver'):
+        return None
+    return uid, session['level']
+
+def startsession(u):
+    session['loggedin'] = u.username
+    session['uid'] = u.userid
+    session['level'] = u.level
+    session['credver'] = u.credversion
+
+def endsession():
+    for key in ('loggedin', 'uid', 'level', 'credver'):
+        session.pop(key, None)
+
+def beginrequest():
+    g.starttime = time.time()
+    Metrics.beginrequest()
+    DB.beginsession(session.get('replpos'))
 
-@app.route('/')
+def endrequest(response):
+    elapsed = time.time() - g.starttime
+    if request.endpoint == 'static' and request.args.get('v') and \
+        request.args['v'] == staticdigests.get(request.view_args.get('filename')):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.expires = int(time.time() + STATIC_MAX_AGE)
+    position = DB.endsession()
+    if position is None:
+        session.pop('replpos', None)
+    else:
+        session['replpos'] = position   # read your own writes from replicas
+    commands = Metrics.endrequest(request.endpoint or 'none', elapsed)
+    slow = current_app.config['SLOW_REQUEST_MS']
+    if slow and elapsed * 1000 > slow:
+        current_app.logger.warning('slow request %s %.1fms: %s', request.path, 
+            elapsed * 1000, ', '.join('%s %.1fms' % (command, seconds * 1000)
+                for command, seconds in commands))
+    return response
+
+def hashpoolbusy(error):
+    '''
+    Password hashing is saturated; shed the request quickly
+    '''
+    return 'Server busy, please try again', 503, {'Retry-After':'2'}
+
+@route('/')
 def root():
     '''
     Root page does one of several things
@@ -24,66 +190,229 @@ def root():
     - Home page for a non-logged-in viewer
     - Redirect to root user creation if no users exist
     '''
-    dbnumber=app.config['db']
+    dbnumber=current_app.config['db']
     s = Site(dbnumber)
     s.start()
     if not User.getuserscount(dbnumber):
         return redirect(url_for('rootuser'))
     else:
-        return render_template('index.html', name=s.name, user=loggedin())
+        return renderpage('index.html', s, user=loggedin())
         
-@app.route('/createrootuser', methods=['GET','POST'])
+@route('/createrootuser', methods=['GET','POST'])
 def rootuser():
     '''
     rootuser page does one of several things
     - root userid/password entry for virgin system
     - root userid/password submit destination for virgin system
     '''
-    dbnumber=app.config['db']
+    dbnumber=current_app.config['db']
     s = Site(dbnumber)
     s.start()
     if not User.getuserscount(dbnumber): 
         if request.method == 'POST'and \
             request.form['password'] == request.form['passwordcheck']:
             ru = User(dbnumber)
-            ru.setusername(request.form['username'])
-            ru.setproperties(password=request.form['password'])
-            ru.setlevel(User.LEVEL_ROOT)
+            try:
+                # the password is hashed before anything is written
+                ru.setproperties(username=request.form['username'],
+                    password=request.form['password'])
+                ru.setlevel(User.LEVEL_ROOT)
+            except Exception:
+                ru.remove()     # or no root user could ever be created
+                raise
             if not ru.isvalid:
                 ru.remove()
             return redirect(url_for('root'))
         else:
-            return render_template('rootuser.html', name=s.name, user=None)
+            return renderpage('rootuser.html', s, user=None)
     else:
         return redirect(url_for('root'))
 
-@app.route('/login', methods=['POST','GET'])
+@route('/login', methods=['POST','GET'])
 def login():
     '''
-    Used for login and logging out (if no username is passed)
+    Used for login and logging out (if no username is passed). Failed
+    attempts are throttled per username and per client address (found 
+    through Config.TRUSTED_PROXIES).
     '''
-    dbnumber=app.config['db']
-    username = request.form.get('username', None)
+    dbnumber=current_app.config['db']
+    username = request.form.get('username', None) or ''
     if request.method == 'POST':
-        u = User(dbnumber, username = username)
+        address = request.remote_addr or 'unknown'
+        attempt, attemptid = LoginThrottle.attempt(dbnumber, username, address)
+        if attempt == LoginThrottle.BLOCKED:
+            return 'Too many login attempts, please wait', 429, {'Retry-After':
+                str(LoginThrottle.getsetting('window'))}
+        elif attempt == LoginThrottle.UNKNOWN:
+            return redirect(url_for('root'))
+        u = User(dbnumber, username = username, fields = User.ALL_FIELDS)
         if u.isvalid and u.checkpassword(request.form['password']):
-            session['loggedin'] = u.username
+            LoginThrottle.succeeded(dbnumber, username, address, attemptid)
+            startsession(u)
     else:
-        session['loggedin'] = None
+        endsession()
     return redirect(url_for('root'))
 
-@app.route('/resetsystem')
+@route('/scoreboard/<contestid>')
+def scoreboard(contestid):
+    '''
+    Contest scoreboard: the shared table, rebuilt at most once per 
+    Contest.BOARD_INTERVAL, and the viewer's own place
+    '''
+    dbnumber=current_app.config['db']
+    s = Site(dbnumber)
+    s.start()
+    contest = Contest(dbnumber, contestid)
+    if not contest.isvalid:
+        return 'No such contest', 404
+    board = contest.scoreboard(lambda rows, built: 
+        render_template('scoreboardtable.html', rows=rows, built=built))
+    user = sessionuser()
+    mine = contest.standings(0, user[0])[1] if user else None
+    return render_template('scoreboard.html', name=s.name, user=loggedin(),
+        contest=contest, board=Markup(board), mine=mine)
+
+@route('/events')
+def events():
+    '''
+    Server-sent events for live pages: scoreboard changes and 
+    announcements. Each open stream holds a greenlet of the gevent worker
+    (see gunicorn.conf.py) for as long as the page stays open. A page 
+    passes since=<unix time> to be sent what it missed after it was built.
+    '''
+    client = EventHub.connect(current_app.config['db'], 
+        request.args.get('since', None, type=float))
+    return Response(client.stream(), mimetype='text/event-stream',
+        headers={'Cache-Control':'no-cache', 'X-Accel-Buffering':'no'})
+
+@route('/submit/<contestid>', methods=['POST'])
+def submit(contestid):
+    '''
+    Queue an answer for the judge workers; the response names the 
+    submission to poll with /submission/<sid>
+    '''
+    dbnumber=current_app.config['db']
+    user = sessionuser()
+    if not user:
+        return 'Forbidden', 403
+    if not Contest(dbnumber, contestid).isvalid:
+        return 'No such contest', 404
+    sid = JudgeQueue.submit(dbnumber, contestid, user[0], 
+        request.form.get('puzzle', ''), request.form.get('answer', ''))
+    return jsonify(submission=sid), 202
+
+@route('/submission/<sid>')
+def submission(sid):
+    '''
+    Status of one of the viewer's submissions
+    '''
+    user = sessionuser()
+    found = JudgeQueue.getsubmission(current_app.config['db'], sid)
+    if not user or found.get(JudgeQueue.HKEY_USERID) != user[0]:
+        return 'Not found', 404
+    return jsonify(submission=sid, status=found[JudgeQueue.HKEY_STATUS])
+
+@route('/metrics')
+def metrics():
+    '''
+    Prometheus metrics; admins only. Series labelled worker="<pid>" are
+    this worker process's own (see Metrics); the login and judge series
+    come from Redis and cover the whole site
+    '''
+    user = sessionuser()
+    if not user or user[1] > User.LEVEL_ADMIN:
+        return 'Forbidden', 403
+    lines = ['# TYPE hscpc_login_attempts_total counter']
+    for outcome, count in sorted(LoginThrottle.getstats(current_app.config['db']).items()):
+        lines.append('hscpc_login_attempts_total{outcome="%s"} %s' % (outcome, count))
+    judge = JudgeQueue.getstats(current_app.config['db'])
+    for name, key in (('queue_depth', 'depth'), ('judging', 'judging'), 
+        ('dead_letters', 'dead')):
+        lines.append('# TYPE hscpc_judge_%s gauge' % name)
+        lines.append('hscpc_judge_%s %s' % (name, judge[key]))
+    lines.append('# TYPE hscpc_judge_submissions_total counter')
+    for outcome in (JudgeQueue.STATUS_ACCEPTED, JudgeQueue.STATUS_REJECTED):
+        lines.append('hscpc_judge_submissions_total{outcome="%s"} %d' % 
+            (outcome, judge.get(outcome, 0)))
+    for name in ('wait', 'judge'):
+        lines.append('# TYPE hscpc_judge_%s_seconds_total counter' % name)
+        lines.append('hscpc_judge_%s_seconds_total %s' % (name, judge.get(name, 0)))
+    lines.append('# TYPE hscpc_judge_seconds histogram')
+    lines.extend(Metrics.histogramlines('hscpc_judge_seconds', judge['seconds']))
+    return Metrics.render() + '\n'.join(lines) + '\n', 200, \
+        {'Content-Type':'text/plain; version=0.0.4'}
+
+@route('/resetsystem')
 def resetsystem():
     '''
-    Clear the database entirely
+    Clear the database entirely. The old data is swept away in the
+    background.
     '''
-    dbnumber=app.config['db']
-    u = User(dbnumber, username = loggedin())
-    if u.isvalid and u.level == User.LEVEL_ROOT:
+    dbnumber=current_app.config['db']
+    user = sessionuser()
+    if user and user[1] == User.LEVEL_ROOT:
         with DB(dbnumber) as db:
             db.reset()
     return redirect(url_for('root'))
 
+def create_app(config=None):
+    '''
+    Build the web app with config (default Config()), which also sets up
+    the data store connections
+    '''
+    config = config or Config()
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config['db'] = config.DB
+    DB.configure(**config.REDIS)
+    app.before_request(beginrequest)
+    app.after_request(endrequest)
+    app.errorhandler(HashPoolBusy)(hashpoolbusy)
+    app.url_defaults(fingerprint)
+    for rule, func, options in routes:
+        app.add_url_rule(rule, func.__name__, func, **options)
+    if config.TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, config.TRUSTED_PROXIES)
+    return app
+
+def prefork(app):
+    '''
+    Work done once in the gunicorn master, so the forked workers share it: 
+    compile every template and fingerprint every static file. Nothing here
+    may open a connection or start a thread.
+    '''
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    for path, dirs, files in os.walk(app.static_folder):
+        for filename in files:
+            filename = os.path.relpath(os.path.join(path, filename), app.static_folder)
+            staticdigests[filename] = digestfiles(os.path.join(app.static_folder, 
+                filename))[:12]
+
+def postfork(app):
+    '''
+    Ready a newly forked worker before it takes traffic: open its own 
+    connection pool, load the Lua scripts, start the password hashing pool,
+    and warm the site and user layout caches (which starts the 
+    invalidation listener). A step that fails is logged and skipped, so the
+    worker still boots and does that work on its first requests instead.
+    '''
+    dbnumber = app.config['db']
+    def loadscripts():
+        with DB(dbnumber) as db:
+            db.loadscripts()
+    def loadlayout():
+        with DB(dbnumber) as db:
+            User._getlayout(db)
+    for step in (loadscripts, loadlayout, HashPool.start, Site(dbnumber).start):
+        try:
+            step()
+        except Exception:
+            app.logger.exception('worker warm-up: %s failed, starting cold', 
+                step.__name__)
+
+app = create_app()
+
 #
 # Unit Test 
 #
@@ -139,6 +468,211 @@ class TestSequenceFunctions(unittest.TestCase):
         rv = self.app.get('/resetsystem', follow_redirects=True)  # can't reset if not logged in
         assert 'Please enter ROOT USER credentials' in rv.data 
 
+    def test_loginthrottle(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        proxied = create_app(Config(DB=DB.DBNTEST, TRUSTED_PROXIES=1)).test_client()
+        def login(password, address):
+            return proxied.post('/login', data=dict(username='rootuser', 
+                password=password), headers={'X-Forwarded-For':address}).status_code
+        LoginThrottle.configure(usernamelimit=3, addresslimit=2)
+        try:
+            for i in range(5):
+                self.assertEqual(login('rootpass', '10.0.0.1'), 302)
+            self.assertEqual(login('nuthin', '10.0.0.1'), 302)
+            self.assertEqual(login('nuthin', '10.0.0.1'), 302)
+            self.assertEqual(login('rootpass', '10.0.0.1'), 429)
+            self.assertEqual(login('rootpass', '10.0.0.2'), 302)
+            self.assertEqual(login('nuthin', '10.0.0.3'), 302)
+            self.assertEqual(login('nuthin', '10.0.0.3'), 302)
+            self.assertEqual(login('rootpass', '10.0.0.4'), 302)
+        finally:
+            LoginThrottle.configure(usernamelimit=LoginThrottle.DEFAULTS[
+                'usernamelimit'][1], addresslimit=LoginThrottle.DEFAULTS[
+                'addresslimit'][1])
+
+    def test_metrics(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 403)
+        rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+        rv = self.app.get('/metrics')
+        worker = os.getpid()
+        assert 'hscpc_request_seconds_count{route="login",worker="%d"}' % worker in rv.data
+        assert 'hscpc_redis_command_seconds_count{command="EVALSHA",worker="%d"}' % \
+            worker in rv.data
+        assert 'hscpc_password_hash_seconds_count{operation="check_password_hash",' \
+            'worker="%d"}' % worker in rv.data
+        assert 'hscpc_login_attempts_total{outcome="allowed"} 1' in rv.data
+
+    def test_hashpoolbusy(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        HashPool.configure(maxqueue=0)
+        try:
+            rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+            self.assertEqual(rv.status_code, 503)
+        finally:
+            HashPool.configure(maxqueue=HashPool.DEFAULTS['maxqueue'][1])
+
+    def test_rootuserbusy(self):
+        HashPool.configure(maxqueue=0)
+        try:
+            rv = self.app.post('/createrootuser', 
+                data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+            self.assertEqual(rv.status_code, 503)
+        finally:
+            HashPool.configure(maxqueue=HashPool.DEFAULTS['maxqueue'][1])
+        self.assertEqual(User.getuserscount(DB.DBNTEST), 0)
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        self.assertTrue(User(DB.DBNTEST, username='rootuser').isvalid)
+
+    def test_revokedsession(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+        u = User(DB.DBNTEST, username='rootuser')
+        u.setproperties(password='newpass')     # revokes the session
+        rv = self.app.get('/resetsystem', follow_redirects=True)
+        assert 'Please enter ROOT USER credentials' not in rv.data 
+
+    def test_scoreboard(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+        contest = Contest.create(DB.DBNTEST, 'Spring')
+        contest.recordattempt(User(DB.DBNTEST, username='rootuser'), 'p1', True)
+        rv = self.app.get('/scoreboard/' + contest.contestid)
+        assert '<td>rootuser</td>' in rv.data
+        assert 'data-built="' in rv.data
+        assert 'You are ranked 1 with 1 solved' in rv.data
+        self.assertEqual(self.app.get('/scoreboard/nothing').status_code, 404)
+
+    def test_submit(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        contest = Contest.create(DB.DBNTEST, 'Spring')
+        contest.setpuzzle('p1', '42')
+        rv = self.app.post('/submit/' + contest.contestid, data=dict(puzzle='p1', answer='42'))
+        self.assertEqual(rv.status_code, 403)
+        rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+        rv = self.app.post('/submit/' + contest.contestid, data=dict(puzzle='p1', answer='42'))
+        self.assertEqual(rv.status_code, 202)
+        sid = json.loads(rv.data)['submission']
+        rv = self.app.get('/metrics')
+        assert 'hscpc_judge_queue_depth 1' in rv.data
+        JudgeQueue.judgeone(DB.DBNTEST)
+        rv = self.app.get('/submission/' + sid)
+        self.assertEqual(json.loads(rv.data)['status'], 'accepted')
+        rv = self.app.get('/metrics')
+        assert 'hscpc_judge_seconds_count 1' in rv.data
+        assert 'hscpc_judge_seconds_bucket{le="+Inf"} 1' in rv.data
+        self.assertEqual(self.app.get('/submission/nothing').status_code, 404)
+
+    def test_pagecache(self):
+        rv = self.app.post('/createrootuser', 
+            data=dict(username='rootuser',password='rootpass',passwordcheck='rootpass'))
+        rv = self.app.get('/')
+        etag = rv.headers['ETag']
+        rv = self.app.get('/', headers={'If-None-Match':etag})
+        self.assertEqual((rv.status_code, rv.data), (304, ''))
+        Site(DB.DBNTEST).setname('Renamed')
+        rv = self.app.get('/', headers={'If-None-Match':etag})
+        self.assertEqual(rv.status_code, 200)
+        assert 'Renamed' in rv.data
+        rv = self.app.post('/login', data=dict(username='rootuser', password='rootpass'))
+        rv = self.app.get('/', headers={'If-None-Match':etag})
+        self.assertNotEqual(rv.headers['ETag'], etag)
+        assert 'rootuser' in rv.data
+
+    def test_resetetag(self):
+        def sitepage(name):
+            site = Site(DB.DBNTEST)
+            site.start()
+            site.setname(name)
+            site.start()
+            return site.version, self.app.get('/createrootuser')
+        version, rv = sitepage('Before')
+        etag = rv.headers['ETag']
+        with DB(DB.DBNTEST) as db:
+            db.reset()
+        # as many site changes, so the same site version, but a new page
+        self.assertEqual(sitepage('After')[0], version)
+        rv = self.app.get('/createrootuser', headers={'If-None-Match':etag})
+        self.assertEqual(rv.status_code, 200)
+        assert 'After' in rv.data
+
+    def test_static(self):
+        rv = self.app.get('/', follow_redirects=True)
+        with app.test_request_context():
+            url = url_for('static', filename='bootstrap.css')
+        assert '?v=' in url and url in rv.data
+        rv = self.app.get(url)
+        self.assertEqual(rv.cache_control.max_age, STATIC_MAX_AGE)
+        rv = self.app.get('/static/bootstrap.css')
+        self.assertNotEqual(rv.cache_control.max_age, STATIC_MAX_AGE)
+
+    def test_staticetag(self):
+        global staticdigest
+        rv = self.app.get('/createrootuser')
+        etag = rv.headers['ETag']
+        deployed = staticdigest
+        folder = tempfile.mkdtemp()
+        try:
+            # a deploy that only changes a stylesheet
+            shutil.copytree(app.static_folder, os.path.join(folder, 'static'))
+            with open(os.path.join(folder, 'static', 'bootstrap.css'), 'a') as f:
+                f.write('\nbody { color: red; }\n')
+            staticdigest = digestfiles(os.path.join(folder, 'static'))
+            rv = self.app.get('/createrootuser', headers={'If-None-Match':etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotEqual(rv.headers['ETag'], etag)
+        finally:
+            staticdigest = deployed
+            shutil.rmtree(folder)
+
+    def test_events(self):
+        rv = self.app.get('/events')
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        stream = iter(rv.response)
+        self.assertEqual(next(stream), 'retry: 3000\n\n')
+        self.assertEqual(next(stream), 'event: resync\ndata: null\n\n')
+        contest = Contest.create(DB.DBNTEST, 'Spring')
+        contest.announce('go')
+        assert '"text": "go"' in next(stream)
+        rv.close()
+
+    def test_factory(self):
+        other = create_app(Config(DB=DB.DBNTEST, SECRET_KEY='other'))
+        self.assertIsNot(other, app)
+        self.assertEqual(other.secret_key, 'other')
+        prefork(other)
+        self.assertTrue(staticdigests['bootstrap.css'])
+        postfork(other)
+        self.assertEqual(Site._cache.get((DB.DBNTEST, Site.CACHE_NAME))[:2], 
+            (Site.VALUE_SITE_DEFAULTNAME, 1))
+        with DB(DB.DBNTEST) as db:
+            self.assertTrue(all(db.r.script_exists(*[script.sha 
+                for script in Script.registered])))
+        rv = other.test_client().get('/')
+        self.assertEqual(rv.status_code, 302)
+
+    def test_postforkcold(self):
+        other = create_app(Config(DB=DB.DBNTEST, SECRET_KEY='other'))
+        url = DB.getsetting('url')
+        DB.configure(url='redis://localhost:%d' % 
+            (DB.getpool(DB.DBNTEST).connection_kwargs['port'] + 13))
+        try:
+            with open(os.devnull, 'w') as devnull:
+                other.logger.handlers = [logging.StreamHandler(devnull)]
+                postfork(other)
+        finally:
+            DB.configure(url=url)
+        rv = other.test_client().get('/createrootuser')
+        self.assertEqual(rv.status_code, 200)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,55 @@
+'''
+Judge worker for the HSCPC submission queue. Run from the project
+directory with the same environment (REDISTOGO_URL etc.) as the web app:
+
+    python judge.py [--db N] [--workers N]
+
+Starts --workers judging processes (default JUDGE_WORKERS, or 2) and
+restarts any that exit, until it is sent SIGTERM or SIGINT.
+'''
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+from dbjudge import JudgeQueue
+from dbtools import DB
+
+
+def startworker(dbnumber, stop):
+    worker = multiprocessing.Process(target=JudgeQueue.work, args=(dbnumber, stop))
+    worker.daemon = True
+    worker.start()
+    return worker
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HSCPC judge worker')
+    parser.add_argument('--db', type=int, default=DB.DBN,
+        help='redis database number')
+    parser.add_argument('--workers', type=int,
+        default=int(os.getenv('JUDGE_WORKERS', 2)),
+        help='judging processes')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    stop = multiprocessing.Event()
+    def shutdown(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    workers = [startworker(args.db, stop) for i in range(args.workers)]
+    logging.info('judging db %d with %d worker(s)', args.db, len(workers))
+    while not stop.is_set():
+        for i, worker in enumerate(workers):
+            worker.join(1.0 / len(workers))
+            if not worker.is_alive() and not stop.is_set():
+                logging.warning('judge worker %d exited (%s); restarting',
+                    worker.pid, worker.exitcode)
+                workers[i] = startworker(args.db, stop)
+    for worker in workers:
+        worker.join(JudgeQueue.LEASE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())